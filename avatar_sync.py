@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Sincronización de la foto de perfil de Moodle como avatar de Discourse.
+
+La imagen (profileimageurl) se descarga en streaming y cada bloque se reenvía
+directamente como cuerpo multipart de POST /uploads.json, sin cargar el
+archivo completo en memoria; mientras pasa se calcula su SHA-1 (el mismo hash
+con el que Discourse deduplica los uploads).
+
+Por cada usuario se guarda en sync_avatars_{ENV}.json la URL de la imagen, su
+ETag y el hash del contenido:
+
+- si la URL no cambió (Moodle incluye la revisión de la imagen en la URL) no
+  se descarga nada;
+- si la URL no trae revisión, se pide con If-None-Match / If-Modified-Since;
+- si ya hay un hash guardado (aunque la URL haya cambiado) se compara antes de
+  subir, y la imagen pasa por un archivo temporal en lugar de ir directa;
+- si Discourse devuelve el mismo upload que la vez anterior no se vuelve a
+  elegir como avatar.
+
+Las subidas corren en su propia etapa (AvatarStage) con AVATAR_CONCURRENCY
+hilos, separada del procesamiento de perfiles; el estado se guarda cada
+AVATAR_SAVE_EVERY resultados y al cerrar la etapa.
+"""
+
+import hashlib
+import re
+import tempfile
+import threading
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import settings
+import http_client
+from sync_state import StateStore, default_avatar_state_filename
+
+# Imagen por defecto de Moodle (usuario sin foto): theme/image.php/.../core/.../u/f1
+DEFAULT_PICTURE_RE = re.compile(r"/u/f[123](\?|$)")
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _url(path):
+    return f"{settings.DISCOURSE_URL.rstrip('/')}/{path.lstrip('/')}"
+
+
+def _headers():
+    return {
+        "Api-Key": settings.DISCOURSE_API_KEY,
+        "Api-Username": settings.DISCOURSE_API_USER
+    }
+
+
+def has_picture(profileimageurl):
+    """False si el usuario no tiene foto (URL vacía o imagen por defecto del tema)"""
+    return bool(profileimageurl) and not DEFAULT_PICTURE_RE.search(profileimageurl)
+
+
+def download_url(profileimageurl):
+    """
+    URL de descarga con el token del web service: las imágenes de
+    pluginfile.php solo son accesibles por webservice/pluginfile.php.
+    """
+    url = profileimageurl
+    if "/pluginfile.php" in url and "/webservice/pluginfile.php" not in url:
+        url = url.replace("/pluginfile.php", "/webservice/pluginfile.php", 1)
+    separator = "&" if "?" in url else "?"
+    return f"{url}{separator}{urlencode({'token': settings.MOODLE_TOKEN})}"
+
+
+class _HashingChunks:
+    """Iterador sobre los bloques de la descarga que calcula el SHA-1 y el tamaño al pasar"""
+
+    def __init__(self, response, max_bytes):
+        self._chunks = response.iter_content(chunk_size=CHUNK_SIZE)
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+        self.max_bytes = max_bytes
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            self.size += len(chunk)
+            if self.size > self.max_bytes:
+                raise ValueError(f"la imagen supera AVATAR_MAX_BYTES ({self.max_bytes} bytes)")
+            self.sha1.update(chunk)
+            yield chunk
+
+
+def _multipart_parts(fields, filename, content_type, boundary):
+    """Encabezado (campos + cabecera del archivo) y cierre del cuerpo multipart"""
+    head = b"".join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        for name, value in fields.items()
+    )
+    head += (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+             f'Content-Type: {content_type}\r\n\r\n').encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    return head, tail
+
+
+def _stream_body(head, chunks, tail):
+    yield head
+    yield from chunks
+    yield tail
+
+
+def _spool(chunks):
+    """Copia la descarga a un archivo temporal (en memoria hasta 1 MB) para decidir antes de subir"""
+    spool = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    for chunk in chunks:
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+
+def _iter_file(f):
+    return iter(lambda: f.read(CHUNK_SIZE), b"")
+
+
+class AvatarState(StateStore):
+    """Última imagen sincronizada por ID de Moodle: {'url', 'etag', 'last_modified', 'sha1', 'upload_id'}"""
+
+    def __init__(self, filename=None):
+        super().__init__(filename or default_avatar_state_filename())
+
+    def lookup(self, moodle_id):
+        return self.get(str(moodle_id))
+
+    def record(self, moodle_id, **entry):
+        self.set(str(moodle_id), entry)
+
+
+def sync_avatar(moodle_user, discourse_id, discourse_username, state, dry_run=True):
+    """
+    Sube la foto de Moodle de un usuario como su avatar de Discourse si cambió.
+
+    Devuelve el resultado: 'NO_PICTURE', 'UNCHANGED', 'DRY_RUN', 'UPLOADED',
+    'SAME_UPLOAD' o 'ERROR'.
+    """
+    moodle_id = moodle_user.get("id")
+    profileimageurl = moodle_user.get("profileimageurl")
+    if not has_picture(profileimageurl):
+        return 'NO_PICTURE'
+
+    entry = state.lookup(moodle_id) or {}
+    same_url = entry.get("url") == profileimageurl
+    if same_url and "rev=" in profileimageurl:
+        return 'UNCHANGED'
+    if dry_run:
+        print(f"   - [Dry-run] SUBIRÍA avatar de {discourse_username} desde {profileimageurl}")
+        return 'DRY_RUN'
+
+    headers = {}
+    if same_url and entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if same_url and entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+
+    max_bytes = getattr(settings, 'AVATAR_MAX_BYTES', 5 * 1024 * 1024)
+    try:
+        with http_client.get(download_url(profileimageurl), headers=headers, stream=True) as image:
+            if image.status_code == 304:
+                return 'UNCHANGED'
+            content_type = image.headers.get("Content-Type", "").split(";")[0]
+            if image.status_code != 200 or not content_type.startswith("image/"):
+                print(f"   [WARNING] No se pudo descargar la foto de {discourse_username}: "
+                      f"{image.status_code} ({content_type or 'sin tipo'})")
+                return 'ERROR'
+            length = image.headers.get("Content-Length")
+            if length and int(length) > max_bytes:
+                print(f"   [WARNING] Foto de {discourse_username} demasiado grande ({length} bytes), se omite")
+                return 'ERROR'
+
+            etag = image.headers.get("ETag")
+            last_modified = image.headers.get("Last-Modified")
+            chunks = _HashingChunks(image, max_bytes)
+            body = chunks
+            if entry.get("sha1"):
+                # Ya se subió una imagen: comparar el contenido antes de subir (una revisión
+                # nueva en la URL no implica que la foto haya cambiado)
+                spool = _spool(chunks)
+                if chunks.sha1.hexdigest() == entry["sha1"]:
+                    spool.close()
+                    state.record(moodle_id, **dict(entry, url=profileimageurl, etag=etag,
+                                                   last_modified=last_modified))
+                    return 'UNCHANGED'
+                body = _iter_file(spool)
+                length = chunks.size
+
+            boundary = uuid.uuid4().hex
+            extension = content_type.split("/")[-1]
+            head, tail = _multipart_parts(
+                {"type": "avatar", "user_id": discourse_id, "synchronous": "true"},
+                f"avatar_{moodle_id}.{extension}", content_type, boundary)
+            upload_headers = dict(_headers(), **{"Content-Type": f"multipart/form-data; boundary={boundary}"})
+            if length:
+                # Tamaño conocido: se envía con Content-Length en lugar de chunked
+                upload_headers["Content-Length"] = str(len(head) + int(length) + len(tail))
+            r = http_client.post(_url("/uploads.json"), headers=upload_headers,
+                                 data=_stream_body(head, body, tail))
+            if body is not chunks:
+                spool.close()
+
+        if r.status_code != 200:
+            print(f"   [ERROR] Error subiendo el avatar de {discourse_username}: {r.status_code} - {r.text[:200]}")
+            return 'ERROR'
+        upload_id = r.json().get("id")
+        result = 'SAME_UPLOAD'
+        if upload_id != entry.get("upload_id"):
+            r = http_client.put(_url(f"/u/{discourse_username}/preferences/avatar/pick.json"),
+                                headers=_headers(), json={"upload_id": upload_id, "type": "uploaded"})
+            if r.status_code != 200:
+                print(f"   [ERROR] Error eligiendo el avatar de {discourse_username}: {r.status_code} - {r.text[:200]}")
+                return 'ERROR'
+            result = 'UPLOADED'
+    except Exception as e:
+        # Incluye una respuesta 200 que no es JSON: el resultado se cuenta igual como error
+        print(f"   [ERROR] Excepción sincronizando el avatar de {discourse_username}: {e}")
+        return 'ERROR'
+
+    sha1 = chunks.sha1.hexdigest()
+    state.record(moodle_id, url=profileimageurl, etag=etag, last_modified=last_modified,
+                 sha1=sha1, upload_id=upload_id)
+    return result
+
+
+class AvatarStage:
+    """
+    Etapa de avatares con su propio pool de AVATAR_CONCURRENCY hilos: la
+    sincronización de perfiles encola usuarios con submit() y sigue sin esperar.
+    """
+
+    def __init__(self, resolve, dry_run=True, max_workers=None, state=None):
+        """resolve(moodle_user) devuelve (ID, username) del usuario en Discourse, o None"""
+        self.resolve = resolve
+        self.dry_run = dry_run
+        self.state = state or AvatarState()
+        self.results = Counter()
+        self.save_every = max(1, getattr(settings, 'AVATAR_SAVE_EVERY', 50))
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or getattr(settings, 'AVATAR_CONCURRENCY', 2),
+            thread_name_prefix="avatar")
+
+    def submit(self, moodle_user):
+        if has_picture(moodle_user.get("profileimageurl")):
+            self._executor.submit(self._run, moodle_user)
+
+    def _run(self, moodle_user):
+        target = self.resolve(moodle_user)
+        result = sync_avatar(moodle_user, *target, self.state, dry_run=self.dry_run) if target else 'NOT_MAPPED'
+        with self._lock:
+            self.results[result] += 1
+            done = sum(self.results.values())
+        if not self.dry_run and done % self.save_every == 0:
+            # Guardado periódico: si la ejecución se corta no se vuelven a subir las imágenes ya enviadas
+            self.state.save()
+
+    def close(self):
+        """Espera a que terminen las subidas pendientes, guarda el estado y devuelve los resultados"""
+        self._executor.shutdown(wait=True)
+        if not self.dry_run:
+            self.state.save()
+        return dict(self.results)
@@ -2,8 +2,16 @@
 """
 Mapeo de códigos ISO 3166-1 alfa-2 a nombres de países
 Basado en la información de https://es.wikipedia.org/wiki/ISO_3166-1
+
+Incluye además un índice inverso (nombres en inglés y en español, y alias como
+"USA" o "EE.UU.") normalizado sin mayúsculas ni acentos, que usa
+resolve_country() para reconocer el país de una ubicación escrita a mano.
 """
 
+import re
+import unicodedata
+from functools import lru_cache
+
 COUNTRY_CODES = {
     'AD': 'Andorra',
     'AE': 'United Arab Emirates',
@@ -257,6 +265,222 @@ COUNTRY_CODES = {
 }
 
 
+# Nombres en español que difieren del nombre en inglés
+COUNTRY_NAMES_ES = {
+    'AE': 'Emiratos Árabes Unidos',
+    'AF': 'Afganistán',
+    'AG': 'Antigua y Barbuda',
+    'AL': 'Albania',
+    'AQ': 'Antártida',
+    'AS': 'Samoa Americana',
+    'AX': 'Islas Åland',
+    'AZ': 'Azerbaiyán',
+    'BA': 'Bosnia y Herzegovina',
+    'BD': 'Bangladés',
+    'BE': 'Bélgica',
+    'BH': 'Baréin',
+    'BJ': 'Benín',
+    'BL': 'San Bartolomé',
+    'BM': 'Bermudas',
+    'BN': 'Brunéi',
+    'BR': 'Brasil',
+    'BT': 'Bután',
+    'BW': 'Botsuana',
+    'BY': 'Bielorrusia',
+    'BZ': 'Belice',
+    'CA': 'Canadá',
+    'CD': 'República Democrática del Congo',
+    'CF': 'República Centroafricana',
+    'CG': 'República del Congo',
+    'CH': 'Suiza',
+    'CI': 'Costa de Marfil',
+    'CK': 'Islas Cook',
+    'CM': 'Camerún',
+    'CV': 'Cabo Verde',
+    'CY': 'Chipre',
+    'CZ': 'República Checa',
+    'DE': 'Alemania',
+    'DJ': 'Yibuti',
+    'DK': 'Dinamarca',
+    'DO': 'República Dominicana',
+    'DZ': 'Argelia',
+    'EE': 'Estonia',
+    'EG': 'Egipto',
+    'EH': 'Sahara Occidental',
+    'ES': 'España',
+    'ET': 'Etiopía',
+    'FI': 'Finlandia',
+    'FK': 'Islas Malvinas',
+    'FO': 'Islas Feroe',
+    'FR': 'Francia',
+    'GA': 'Gabón',
+    'GB': 'Reino Unido',
+    'GF': 'Guayana Francesa',
+    'GL': 'Groenlandia',
+    'GP': 'Guadalupe',
+    'GQ': 'Guinea Ecuatorial',
+    'GR': 'Grecia',
+    'GW': 'Guinea-Bisáu',
+    'HT': 'Haití',
+    'HR': 'Croacia',
+    'HU': 'Hungría',
+    'IE': 'Irlanda',
+    'IQ': 'Irak',
+    'IR': 'Irán',
+    'IS': 'Islandia',
+    'IT': 'Italia',
+    'JO': 'Jordania',
+    'JP': 'Japón',
+    'KE': 'Kenia',
+    'KG': 'Kirguistán',
+    'KH': 'Camboya',
+    'KM': 'Comoras',
+    'KN': 'San Cristóbal y Nieves',
+    'KP': 'Corea del Norte',
+    'KR': 'Corea del Sur',
+    'KY': 'Islas Caimán',
+    'KZ': 'Kazajistán',
+    'LB': 'Líbano',
+    'LC': 'Santa Lucía',
+    'LS': 'Lesoto',
+    'LT': 'Lituania',
+    'LU': 'Luxemburgo',
+    'LV': 'Letonia',
+    'LY': 'Libia',
+    'MA': 'Marruecos',
+    'MC': 'Mónaco',
+    'MF': 'San Martín',
+    'MH': 'Islas Marshall',
+    'MK': 'Macedonia del Norte',
+    'MQ': 'Martinica',
+    'MR': 'Mauritania',
+    'MU': 'Mauricio',
+    'MV': 'Maldivas',
+    'MX': 'México',
+    'MY': 'Malasia',
+    'NC': 'Nueva Caledonia',
+    'NE': 'Níger',
+    'NL': 'Países Bajos',
+    'NO': 'Noruega',
+    'NZ': 'Nueva Zelanda',
+    'OM': 'Omán',
+    'PA': 'Panamá',
+    'PE': 'Perú',
+    'PF': 'Polinesia Francesa',
+    'PG': 'Papúa Nueva Guinea',
+    'PH': 'Filipinas',
+    'PK': 'Pakistán',
+    'PL': 'Polonia',
+    'PR': 'Puerto Rico',
+    'QA': 'Catar',
+    'RE': 'Reunión',
+    'RO': 'Rumania',
+    'RU': 'Rusia',
+    'RW': 'Ruanda',
+    'SA': 'Arabia Saudita',
+    'SB': 'Islas Salomón',
+    'SD': 'Sudán',
+    'SE': 'Suecia',
+    'SG': 'Singapur',
+    'SH': 'Santa Elena',
+    'SI': 'Eslovenia',
+    'SK': 'Eslovaquia',
+    'SL': 'Sierra Leona',
+    'SR': 'Surinam',
+    'SS': 'Sudán del Sur',
+    'ST': 'Santo Tomé y Príncipe',
+    'SY': 'Siria',
+    'SZ': 'Esuatini',
+    'TD': 'Chad',
+    'TH': 'Tailandia',
+    'TJ': 'Tayikistán',
+    'TL': 'Timor Oriental',
+    'TM': 'Turkmenistán',
+    'TN': 'Túnez',
+    'TR': 'Turquía',
+    'TT': 'Trinidad y Tobago',
+    'TW': 'Taiwán',
+    'UA': 'Ucrania',
+    'US': 'Estados Unidos',
+    'UZ': 'Uzbekistán',
+    'VA': 'Ciudad del Vaticano',
+    'VC': 'San Vicente y las Granadinas',
+    'VG': 'Islas Vírgenes Británicas',
+    'VI': 'Islas Vírgenes de los Estados Unidos',
+    'YE': 'Yemen',
+    'ZA': 'Sudáfrica',
+    'ZW': 'Zimbabue',
+}
+
+# Otras formas habituales de escribir un país (se comparan sin mayúsculas ni acentos)
+COUNTRY_ALIASES = {
+    'AE': ['UAE', 'Emiratos Arabes'],
+    'BO': ['Estado Plurinacional de Bolivia'],
+    'CD': ['RDC', 'DR Congo', 'Congo-Kinshasa'],
+    'CG': ['Congo', 'Congo-Brazzaville'],
+    'CI': ["Ivory Coast", "Cote d'Ivoire"],
+    'CZ': ['Czechia', 'Chequia'],
+    'GB': ['UK', 'U.K.', 'Great Britain', 'Gran Bretaña', 'England', 'Inglaterra', 'Scotland',
+           'Escocia', 'Wales', 'Gales', 'Northern Ireland', 'Irlanda del Norte'],
+    'KR': ['Korea', 'Corea', 'Republic of Korea'],
+    'MK': ['Macedonia'],
+    'MM': ['Burma', 'Birmania'],
+    'NL': ['Holland', 'Holanda', 'The Netherlands'],
+    'PS': ['Palestina', 'State of Palestine'],
+    'RU': ['Russian Federation', 'Federación Rusa'],
+    'SZ': ['Swaziland', 'Suazilandia'],
+    'TR': ['Türkiye'],
+    'US': ['USA', 'U.S.A.', 'U.S.', 'United States of America', 'EEUU', 'EE.UU.', 'EE. UU.',
+           'Estados Unidos de América', 'Norteamérica'],
+    'VA': ['Vaticano', 'Holy See', 'Santa Sede'],
+    'VE': ['República Bolivariana de Venezuela'],
+    'VN': ['Viet Nam'],
+}
+
+# Abreviaturas de estados de EE. UU. y provincias de Canadá: tras "Ciudad, " un
+# código de dos letras como CA, CO o MA suele ser una de ellas, no un país
+_SUBDIVISION_CODES = frozenset("""
+    AL AK AZ AR CA CO CT DE DC FL GA HI ID IL IN IA KS KY LA ME MD MA MI MN MS MO
+    MT NE NV NH NJ NM NY NC ND OH OK OR PA RI SC SD TN TX UT VT VA WA WV WI WY
+    AB BC MB NB NL NS NT NU ON PE QC SK YT
+""".split())
+
+# Lugares cuyo nombre termina en el de un país sin serlo ("New Mexico", "New Jersey")
+_NON_COUNTRY_PLACES = frozenset([
+    'new mexico', 'nuevo mexico', 'new jersey', 'nueva jersey', 'new england', 'nueva inglaterra',
+    'new south wales', 'nueva gales del sur', 'new guinea', 'nueva guinea',
+])
+
+# Separadores entre las partes de una ubicación ("Roma, Italia", "Lima / Perú", "Quito - Ecuador")
+_LOCATION_SEPARATORS = re.compile(r"\s*[,;/|()]\s*|\s+[-–]\s+")
+
+
+def _fold(text):
+    """Normaliza un texto para compararlo: sin acentos, en minúsculas y sin puntuación"""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    text = re.sub(r"[^\w\s]", "", re.sub(r"[-–]", " ", text.casefold()))
+    return " ".join(text.split())
+
+
+def _build_country_index():
+    index = {}
+    for code, name in COUNTRY_CODES.items():
+        index[_fold(name)] = code
+    for code, name in COUNTRY_NAMES_ES.items():
+        index[_fold(name)] = code
+    for code, aliases in COUNTRY_ALIASES.items():
+        for alias in aliases:
+            index[_fold(alias)] = code
+    return index
+
+
+# Nombre normalizado (inglés, español o alias) -> código ISO, calculado una sola vez
+COUNTRY_INDEX = _build_country_index()
+# Palabras del nombre más largo del índice (límite al buscar un país al final de un texto)
+_MAX_NAME_WORDS = max(len(name.split()) for name in COUNTRY_INDEX)
+
+
 def get_country_name(country_code):
     """
     Convierte un código de país ISO 3166-1 alfa-2 a su nombre completo.
@@ -281,7 +505,7 @@ def get_country_code(country_name):
     Convierte un nombre de país a su código ISO 3166-1 alfa-2.
     
     Args:
-        country_name (str): Nombre del país
+        country_name (str): Nombre del país (en inglés o español, o un alias)
     
     Returns:
         str: Código de país de 2 letras o el nombre original si no se encuentra
@@ -289,13 +513,91 @@ def get_country_code(country_name):
     if not country_name:
         return country_name
     
-    # Buscar el código por nombre (búsqueda case-insensitive)
-    country_name = country_name.strip()
-    for code, name in COUNTRY_CODES.items():
-        if name.lower() == country_name.lower():
+    # Buscar el código en el índice (sin distinguir mayúsculas ni acentos)
+    return COUNTRY_INDEX.get(_fold(country_name), country_name.strip())
+
+def _is_iso_code(text):
+    return len(text) == 2 and text.isupper() and text in COUNTRY_CODES
+
+
+def _match_trailing(words):
+    """
+    Código del país nombrado por las últimas palabras, o None. No acepta un
+    país que sea el final de un lugar más largo ("Albuquerque New Mexico").
+    """
+    for size in range(min(_MAX_NAME_WORDS, len(words)), 0, -1):
+        code = COUNTRY_INDEX.get(" ".join(words[-size:]))
+        if code:
+            if any(" ".join(words[-longer:]) in _NON_COUNTRY_PLACES
+                   for longer in range(size + 1, len(words) + 1)):
+                return None
             return code
-    
-    return country_name
+    return None
+
+
+@lru_cache(maxsize=4096)
+def resolve_country_code(location):
+    """
+    Reconoce el país de una ubicación escrita a mano y devuelve su código ISO.
+
+    Prueba el texto completo y luego cada parte (separadas por comas, barras,
+    etc.) de la última a la primera, así "Roma, Italia", "Bogotá, Colombia",
+    "USA" y "Madrid, ES" se reconocen. Si ninguna parte coincide, busca un
+    nombre de país al final del texto ("Bogotá Colombia").
+
+    Un código ISO suelto solo cuenta si es toda la ubicación (ahí también en
+    minúsculas, "es") o su última parte, y en ese caso no si también es la
+    abreviatura de un estado o provincia ("Los Angeles, CA" no es Canadá). Tampoco cuenta un país que sea el final
+    del nombre de otro lugar ("Newark, New Jersey" no es Jersey).
+
+    Args:
+        location (str): Ubicación (o código o nombre de país)
+
+    Returns:
+        str: Código de país de 2 letras, o None si no se reconoce
+    """
+    if not location:
+        return None
+    location = location.strip()
+    # Un código suelto puede venir en minúsculas (campo país de Moodle: 'ca', 'es')
+    if _is_iso_code(location.upper()):
+        return location.upper()
+    code = COUNTRY_INDEX.get(_fold(location))
+    if code:
+        return code
+
+    parts = [part for part in _LOCATION_SEPARATORS.split(location) if part]
+    for position, part in enumerate(reversed(parts)):
+        code = COUNTRY_INDEX.get(_fold(part))
+        if code and _fold(part) not in _NON_COUNTRY_PLACES:
+            return code
+        if position == 0 and _is_iso_code(part) and part not in _SUBDIVISION_CODES:
+            return part
+
+    # Nombre de país al final del texto, probando primero los más largos
+    return _match_trailing(_fold(location).split())
+
+
+def resolve_country(location):
+    """
+    Nombre canónico del país de una ubicación (el de COUNTRY_CODES).
+
+    Acepta códigos ISO, nombres en inglés o español, alias y ubicaciones del
+    tipo "Ciudad, País". Si no reconoce el país devuelve la última parte de la
+    ubicación tal como está escrita (None si la ubicación está vacía).
+
+    Args:
+        location (str): Ubicación, código o nombre de país
+
+    Returns:
+        str: Nombre del país
+    """
+    if not location or not location.strip():
+        return None
+    code = resolve_country_code(location.strip())
+    if code:
+        return COUNTRY_CODES[code]
+    return location.split(",")[-1].strip() or location.strip()
 
 
 def list_all_countries():
@@ -320,3 +622,13 @@ if __name__ == "__main__":
     print(f"XX -> {get_country_name('XX')}")  # Código inexistente
     print(f"'' -> '{get_country_name('')}'")  # Código vacío
     print(f"None -> {get_country_name(None)}")  # None
+    print(f"'Roma, Italia' -> {resolve_country('Roma, Italia')}")
+    print(f"'USA' -> {resolve_country('USA')}")
+    print(f"'Bogotá Colombia' -> {resolve_country('Bogotá Colombia')}")
+
+    # Los códigos en minúsculas del campo país de Moodle también se reconocen
+    assert resolve_country('ca') == 'Canada', resolve_country('ca')
+    assert resolve_country(' es ') == 'Spain', resolve_country(' es ')
+    assert resolve_country_code('it') == 'IT'
+    assert resolve_country_code('Los Angeles, CA') is None
+    print("✅ Códigos en minúsculas: OK")
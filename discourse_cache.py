@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Caché de consultas de usuarios de Discourse compartido por toda la ejecución.
+
+Guarda tanto los usuarios encontrados (registros DiscourseUser) como los 404
+confirmados (caché negativo, con TTL), y se actualiza o invalida con las
+escrituras que hace el propio script, de modo que el mismo usuario no se
+consulta varias veces durante una creación o actualización.
+
+DiscourseUserIndex complementa al caché con el listado completo de usuarios
+(por username y por email), cargado una sola vez por ejecución.
+"""
+
+import threading
+import time
+
+import settings
+from user_records import DiscourseUser
+
+# Resultado de lookup() para un usuario confirmado como inexistente
+NOT_FOUND = object()
+
+
+class DiscourseUserCache:
+    """Caché de usuarios de Discourse por username, con índice por ID y caché negativo"""
+
+    def __init__(self, negative_ttl=None):
+        self.negative_ttl = negative_ttl if negative_ttl is not None else getattr(settings, 'LOOKUP_NEGATIVE_TTL', 300)
+        self._users = {}
+        self._by_id = {}
+        self._missing = {}  # username -> momento en que se confirmó el 404
+        self._lock = threading.RLock()
+        self.stats = {'hits': 0, 'negative_hits': 0, 'misses': 0}
+
+    def lookup(self, username):
+        """Devuelve el DiscourseUser cacheado, NOT_FOUND si se sabe que no existe, o None si no se sabe"""
+        with self._lock:
+            user = self._users.get(username)
+            if user is not None:
+                self.stats['hits'] += 1
+                return user
+            missing_since = self._missing.get(username)
+            if missing_since is not None:
+                if time.monotonic() - missing_since < self.negative_ttl:
+                    self.stats['negative_hits'] += 1
+                    return NOT_FOUND
+                del self._missing[username]
+            self.stats['misses'] += 1
+            return None
+
+    def store(self, username, user):
+        """Guarda un usuario encontrado en Discourse"""
+        user = DiscourseUser.from_json(user)
+        with self._lock:
+            self._missing.pop(username, None)
+            self._users[username] = user
+            if user.id is not None:
+                self._by_id[user.id] = username
+        return user
+
+    def store_missing(self, username):
+        """Registra un usuario confirmado como inexistente (404)"""
+        with self._lock:
+            self._drop(username)
+            self._missing[username] = time.monotonic()
+
+    def invalidate(self, username):
+        """Olvida todo lo que se sabe de un usuario (se volverá a consultar)"""
+        with self._lock:
+            self._drop(username)
+            self._missing.pop(username, None)
+
+    def update_fields(self, username, fields):
+        """Aplica a la copia cacheada los campos que se acaban de escribir en Discourse"""
+        with self._lock:
+            user = self._users.get(username)
+            if user is None:
+                return
+            for key, value in fields.items():
+                if key in user.__slots__:
+                    setattr(user, key, value)
+
+    def update_fields_by_id(self, user_id, fields):
+        """Como update_fields, pero identificando al usuario por su ID de Discourse"""
+        with self._lock:
+            username = self._by_id.get(user_id)
+            if username is not None:
+                self.update_fields(username, fields)
+
+    def get(self, username, default=None):
+        """Compatibilidad con dict: el usuario cacheado o default (también para los 404)"""
+        with self._lock:
+            user = self._users.get(username)
+            return default if user is None else user
+
+    def _drop(self, username):
+        user = self._users.pop(username, None)
+        if user is not None and user.id is not None:
+            self._by_id.pop(user.id, None)
+
+    def __contains__(self, username):
+        with self._lock:
+            return username in self._users
+
+    def __len__(self):
+        with self._lock:
+            return len(self._users)
+
+
+class DiscourseUserIndex:
+    """
+    Índice de todos los usuarios de Discourse por username y por email.
+
+    Se construye una vez por ejecución (listado de administración o exportación
+    CSV) y se usa para saber qué usuarios existen y para detectar conflictos de
+    email sin volver a descargar la lista completa. Expira tras `ttl` segundos.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl if ttl is not None else getattr(settings, 'DISCOURSE_INDEX_TTL', 900)
+        self._by_username = {}
+        self._by_email = {}
+        self._loaded_at = None
+        self._lock = threading.RLock()
+
+    def load(self, users):
+        """Reemplaza el contenido del índice con los usuarios dados (dicts o DiscourseUser)"""
+        by_username = {}
+        by_email = {}
+        for user in users:
+            user = DiscourseUser.from_json(user)
+            if not user.username:
+                continue
+            by_username[user.username] = user
+            if user.email:
+                by_email[user.email.lower()] = user
+        with self._lock:
+            self._by_username = by_username
+            self._by_email = by_email
+            self._loaded_at = time.monotonic()
+
+    def is_fresh(self):
+        """True si el índice está cargado y no expiró"""
+        with self._lock:
+            return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def add(self, user):
+        """Agrega un usuario recién creado por el script"""
+        user = DiscourseUser.from_json(user)
+        with self._lock:
+            self._by_username[user.username] = user
+            if user.email:
+                self._by_email[user.email.lower()] = user
+
+    def users(self):
+        """Lista de todos los usuarios del índice"""
+        with self._lock:
+            return list(self._by_username.values())
+
+    def by_username(self, username):
+        with self._lock:
+            return self._by_username.get(username)
+
+    def by_email(self, email):
+        with self._lock:
+            return self._by_email.get(email.lower()) if email else None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._by_username)
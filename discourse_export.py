@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Snapshot completo de usuarios de Discourse mediante la exportación CSV de administración.
+
+En foros grandes, recorrer /admin/users/list/*.json cuesta miles de peticiones
+y choca con el rate limit. Discourse puede generar en segundo plano un CSV con
+todos los usuarios (Admin > Usuarios > Exportar): se solicita la exportación,
+se espera el mensaje privado del sistema con el enlace de descarga, se
+descarga el ZIP en streaming y se lee el CSV fila a fila.
+
+Un snapshot completo cuesta así unas pocas peticiones.
+"""
+
+import csv
+import io
+import os
+import re
+import tempfile
+import time
+import zipfile
+from datetime import datetime, timezone
+
+import settings
+import http_client
+from user_records import DiscourseUser
+
+# Enlace al adjunto .zip en el HTML del mensaje de "exportación completada"
+ATTACHMENT_RE = re.compile(r'href="([^"]+\.zip)"')
+
+
+def _url(path):
+    return f"{settings.DISCOURSE_URL.rstrip('/')}/{path.lstrip('/')}"
+
+
+def _headers():
+    return {
+        "Api-Key": settings.DISCOURSE_API_KEY,
+        "Api-Username": settings.DISCOURSE_API_USER
+    }
+
+
+def request_user_list_export():
+    """Solicita a Discourse la exportación CSV de la lista de usuarios (tarea en segundo plano)"""
+    r = http_client.post(_url("/export_csv/export_entity.json"), headers=_headers(), data={"entity": "user_list"})
+    if r.status_code != 200:
+        raise RuntimeError(f"Discourse rechazó la exportación de usuarios: {r.status_code} - {r.text[:200]}")
+
+
+def _parse_time(value):
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except (AttributeError, ValueError):
+        return 0
+
+
+def find_export_download_url(requested_at):
+    """
+    Busca, entre los mensajes privados del usuario de la API, el aviso de
+    exportación completada posterior a requested_at y devuelve la URL del ZIP.
+    """
+    username = settings.DISCOURSE_API_USER
+    r = http_client.get(_url(f"/topics/private-messages/{username}.json"), headers=_headers())
+    r.raise_for_status()
+    topics = r.json().get("topic_list", {}).get("topics", [])
+    # Margen por diferencias de reloj entre este host y Discourse
+    recent = [t for t in topics if _parse_time(t.get("created_at")) >= requested_at - 60]
+    for topic in sorted(recent, key=lambda t: _parse_time(t.get("created_at")), reverse=True):
+        r = http_client.get(_url(f"/t/{topic['id']}.json"), headers=_headers())
+        if r.status_code != 200:
+            continue
+        posts = r.json().get("post_stream", {}).get("posts", [])
+        match = ATTACHMENT_RE.search(posts[0].get("cooked", "")) if posts else None
+        if match:
+            href = match.group(1)
+            return href if href.startswith("http") else _url(href)
+    return None
+
+
+def wait_for_export(requested_at, timeout=None, poll_interval=None):
+    """Espera (consultando cada poll_interval segundos) a que la exportación esté lista"""
+    timeout = timeout or getattr(settings, 'DISCOURSE_EXPORT_TIMEOUT', 600)
+    poll_interval = poll_interval or getattr(settings, 'DISCOURSE_EXPORT_POLL_INTERVAL', 10)
+    deadline = time.monotonic() + timeout
+    while True:
+        download_url = find_export_download_url(requested_at)
+        if download_url:
+            return download_url
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"La exportación de usuarios de Discourse no estuvo lista en {timeout} segundos")
+        time.sleep(poll_interval)
+
+
+def download_export(download_url, filename):
+    """Descarga el ZIP de la exportación en streaming a un archivo local"""
+    r = http_client.get(download_url, headers=_headers(), stream=True)
+    r.raise_for_status()
+    with open(filename, 'wb') as f:
+        for chunk in r.iter_content(chunk_size=64 * 1024):
+            f.write(chunk)
+    r.close()
+
+
+def row_to_discourse_user(row):
+    """Convierte una fila del CSV de exportación en un DiscourseUser (None si no tiene username)"""
+    if not row.get("username"):
+        return None
+    try:
+        user_id = int(row.get("id"))
+    except (TypeError, ValueError):
+        user_id = None
+    return DiscourseUser(
+        id=user_id,
+        username=row.get("username"),
+        name=row.get("name") or None,
+        email=row.get("email") or None,
+        location=row.get("location") or None,
+        active=str(row.get("active")).lower() == "true",
+    )
+
+
+def iter_export_file(filename):
+    """Genera los DiscourseUser de un ZIP (o CSV) de exportación, leyendo fila a fila"""
+    if zipfile.is_zipfile(filename):
+        with zipfile.ZipFile(filename) as archive:
+            member = next(name for name in archive.namelist() if name.endswith(".csv"))
+            with archive.open(member) as raw:
+                for row in csv.DictReader(io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")):
+                    user = row_to_discourse_user(row)
+                    if user is not None:
+                        yield user
+        return
+    with open(filename, 'r', encoding='utf-8-sig', newline='') as f:
+        for row in csv.DictReader(f):
+            user = row_to_discourse_user(row)
+            if user is not None:
+                yield user
+
+
+def iter_user_list_export():
+    """
+    Snapshot completo de usuarios de Discourse: solicita la exportación, espera a
+    que esté lista, la descarga y genera los usuarios a medida que se leen.
+    """
+    requested_at = datetime.now(timezone.utc).timestamp()
+    print("[SNAPSHOT] Solicitando exportación CSV de usuarios a Discourse...")
+    request_user_list_export()
+    download_url = wait_for_export(requested_at)
+    print(f"[SNAPSHOT] Exportación lista, descargando {download_url}")
+
+    fd, filename = tempfile.mkstemp(prefix="discourse_user_list_", suffix=".zip")
+    os.close(fd)
+    try:
+        download_export(download_url, filename)
+        yield from iter_export_file(filename)
+    finally:
+        os.remove(filename)
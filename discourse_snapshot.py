@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Snapshot local de los usuarios de Discourse para los scripts de reportes.
+
+discourse_users_by_country.py, list_users_discourse.py y view_user_discourse.py
+leen por defecto este snapshot en lugar de descargar los usuarios del foro en
+cada ejecución. El snapshot se guarda en un archivo NDJSON (una línea de
+metadatos y un usuario por línea) y se actualiza:
+
+- de forma incremental cuando tiene más de SNAPSHOT_TTL segundos: solo se
+  recorren las páginas del listado de administración ordenado por última
+  visita y por fecha de creación hasta llegar a usuarios que no cambiaron;
+- por completo cuando tiene más de SNAPSHOT_FULL_INTERVAL segundos (para
+  reflejar bajas), con --full, o al sincronizar con la exportación CSV.
+
+Uso:
+    python discourse_snapshot.py           # actualizar si está vencido
+    python discourse_snapshot.py --full    # regenerar completo
+    python discourse_snapshot.py --info    # mostrar antigüedad y tamaño
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import settings
+import http_client
+
+# Campos guardados por usuario
+SNAPSHOT_FIELDS = ("id", "username", "name", "email", "location", "active", "last_seen_at", "created_at")
+
+# Margen (segundos) al comparar fechas de Discourse con la última actualización
+REFRESH_MARGIN = 300
+
+
+def default_snapshot_filename():
+    """Nombre del archivo de snapshot para el entorno actual"""
+    env = getattr(settings, 'ENV', 'unknown')
+    return getattr(settings, 'SNAPSHOT_FILE', f"discourse_users_snapshot_{env}.ndjson")
+
+
+def _url(path):
+    return f"{settings.DISCOURSE_URL.rstrip('/')}/{path.lstrip('/')}"
+
+
+def _headers():
+    return {
+        "Api-Key": settings.DISCOURSE_API_KEY,
+        "Api-Username": settings.DISCOURSE_API_USER
+    }
+
+
+def _parse_time(value):
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except (AttributeError, ValueError):
+        return 0
+
+
+def _compact(user):
+    return {field: user.get(field) for field in SNAPSHOT_FIELDS}
+
+
+class UserSnapshot:
+    """Usuarios de Discourse por username, con la fecha de la última actualización"""
+
+    def __init__(self, filename=None):
+        self.filename = filename or default_snapshot_filename()
+        self.users = {}
+        self.refreshed_at = None
+        self.full_refreshed_at = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Carga el snapshot desde disco. Devuelve False si no existe"""
+        if not os.path.exists(self.filename):
+            return False
+        with open(self.filename, 'r', encoding='utf-8') as f:
+            self._read_meta(f)
+            self.users = {}
+            for line in f:
+                if line.strip():
+                    user = json.loads(line)
+                    self.users[user["username"]] = user
+        return True
+
+    def _read_meta(self, f):
+        meta = json.loads(f.readline() or "{}")
+        self.refreshed_at = meta.get("refreshed_at")
+        self.full_refreshed_at = meta.get("full_refreshed_at")
+
+    def load_meta(self):
+        """Lee solo la línea de metadatos (fechas de actualización). Devuelve False si no existe"""
+        if not os.path.exists(self.filename):
+            return False
+        with open(self.filename, 'r', encoding='utf-8') as f:
+            self._read_meta(f)
+        return True
+
+    def iter_users(self):
+        """Genera los usuarios guardados en disco uno a uno, sin cargarlos en memoria"""
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'r', encoding='utf-8') as f:
+            f.readline()
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def save(self):
+        """Escribe el snapshot de forma atómica (archivo temporal + rename)"""
+        tmp_filename = f"{self.filename}.tmp"
+        with open(tmp_filename, 'w', encoding='utf-8') as f:
+            meta = {"refreshed_at": self.refreshed_at, "full_refreshed_at": self.full_refreshed_at,
+                    "count": len(self.users)}
+            f.write(json.dumps(meta) + "\n")
+            for user in self.users.values():
+                f.write(json.dumps(user, ensure_ascii=False) + "\n")
+        os.replace(tmp_filename, self.filename)
+
+    def age(self):
+        """Segundos desde la última actualización (None si nunca se generó)"""
+        return time.time() - self.refreshed_at if self.refreshed_at else None
+
+    def replace_all(self, users):
+        """Reemplaza el contenido con un listado completo de usuarios"""
+        self.users = {user["username"]: _compact(user) for user in users if user.get("username")}
+        self.refreshed_at = self.full_refreshed_at = time.time()
+
+    def merge(self, user):
+        """Agrega o actualiza un usuario conservando los campos que el nuevo dato no trae"""
+        with self._lock:
+            current = self.users.setdefault(user["username"], {field: None for field in SNAPSHOT_FIELDS})
+            for field in SNAPSHOT_FIELDS:
+                if user.get(field) is not None:
+                    current[field] = user[field]
+
+    def __len__(self):
+        return len(self.users)
+
+
+def fetch_listing_page(page, order=None):
+    """Una página del listado de administración de usuarios activos (con email)"""
+    params = {"page": page, "show_emails": "true"}
+    if order:
+        params["order"] = order
+    r = http_client.get(_url("/admin/users/list/active.json"), headers=_headers(), params=params)
+    r.raise_for_status()
+    return r.json()
+
+
+def fetch_user_details(username):
+    """Perfil de un usuario (incluye location, que el listado no trae)"""
+    r = http_client.hedged_get(_url(f"/u/{username}.json"), headers=_headers())
+    if r.status_code != 200:
+        return None
+    return r.json().get("user", {})
+
+
+def fill_details(snapshot, usernames, max_workers=None):
+    """Completa name/location de los usuarios indicados con peticiones en paralelo"""
+    max_workers = max_workers or getattr(settings, 'SNAPSHOT_CONCURRENCY', 8)
+    usernames = list(usernames)
+    if not usernames:
+        return
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="snapshot") as executor:
+        for details in executor.map(fetch_user_details, usernames):
+            if details and details.get("username"):
+                snapshot.merge(details)
+
+
+def full_refresh(snapshot):
+    """Regenera el snapshot completo (exportación CSV o listado paginado + perfiles)"""
+    if getattr(settings, 'DISCOURSE_SNAPSHOT_STRATEGY', 'list') == 'csv_export':
+        from discourse_export import iter_user_list_export
+        snapshot.replace_all(user.to_dict() for user in iter_user_list_export())
+        return
+    users = []
+    page = 1
+    while True:
+        batch = fetch_listing_page(page, order="created")
+        if not batch:
+            break
+        users.extend(batch)
+        page += 1
+    snapshot.replace_all(users)
+    # El listado no trae la ubicación: pedir el perfil de cada usuario
+    fill_details(snapshot, snapshot.users.keys())
+
+
+def incremental_refresh(snapshot):
+    """
+    Actualiza solo los usuarios nuevos o con actividad desde la última
+    actualización, recorriendo el listado ordenado por última visita y por
+    fecha de creación hasta la primera página sin cambios.
+    """
+    since = (snapshot.refreshed_at or 0) - REFRESH_MARGIN
+    started_at = time.time()
+    changed = set()
+    for order, field in (("seen", "last_seen_at"), ("created", "created_at")):
+        page = 1
+        while True:
+            batch = fetch_listing_page(page, order=order)
+            recent = [user for user in batch if _parse_time(user.get(field)) >= since]
+            for user in recent:
+                snapshot.merge(_compact(user))
+                changed.add(user["username"])
+            if len(recent) < len(batch) or not batch:
+                break
+            page += 1
+    fill_details(snapshot, changed)
+    snapshot.refreshed_at = started_at
+    return len(changed)
+
+
+def get_snapshot(refresh=True, filename=None):
+    """
+    Devuelve el snapshot de usuarios, actualizándolo antes si está vencido.
+
+    Con refresh=False se usa tal cual está en disco (o vacío si no existe).
+    """
+    snapshot = UserSnapshot(filename)
+    snapshot.load()
+    if refresh:
+        refresh_snapshot(snapshot)
+    return snapshot
+
+
+def iter_snapshot_users(refresh=True, filename=None):
+    """
+    Genera los usuarios del snapshot leyendo el archivo línea a línea. Si está
+    vencido se actualiza antes (eso sí carga el snapshot); después se lee de
+    disco sin guardar los usuarios en memoria.
+    """
+    snapshot = UserSnapshot(filename)
+    snapshot.load_meta()
+    if refresh and refresh_due(snapshot):
+        snapshot.load()
+        refresh_snapshot(snapshot)
+        snapshot = UserSnapshot(snapshot.filename)
+    yield from snapshot.iter_users()
+
+
+def refresh_due(snapshot, full=False):
+    """'full', 'incremental' o None según las fechas de actualización del snapshot"""
+    ttl = getattr(settings, 'SNAPSHOT_TTL', 3600)
+    full_interval = getattr(settings, 'SNAPSHOT_FULL_INTERVAL', 7 * 86400)
+    full_age = time.time() - snapshot.full_refreshed_at if snapshot.full_refreshed_at else None
+    if full or full_age is None or full_age > full_interval:
+        return 'full'
+    if snapshot.age() > ttl:
+        return 'incremental'
+    return None
+
+
+def refresh_snapshot(snapshot, full=False):
+    """Actualiza el snapshot si venció (incremental) o si corresponde una regeneración completa"""
+    due = refresh_due(snapshot, full)
+    start = time.time()
+
+    if due == 'full':
+        print("🔄 Generando snapshot completo de usuarios de Discourse...")
+        full_refresh(snapshot)
+        snapshot.save()
+        print(f"💾 Snapshot guardado: {len(snapshot)} usuarios en {time.time() - start:.1f}s ({snapshot.filename})")
+    elif due == 'incremental':
+        changed = incremental_refresh(snapshot)
+        snapshot.save()
+        print(f"🔄 Snapshot actualizado: {changed} usuarios nuevos o modificados en {time.time() - start:.1f}s")
+    return snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Genera o actualiza el snapshot local de usuarios de Discourse")
+    parser.add_argument("--full", action="store_true", help="Regenera el snapshot completo")
+    parser.add_argument("--info", action="store_true", help="Muestra la antigüedad y el tamaño del snapshot y termina")
+    args = parser.parse_args()
+
+    snapshot = UserSnapshot()
+    if args.info:
+        if not snapshot.load():
+            print(f"❌ No existe el snapshot {snapshot.filename}")
+            return
+        print(f"📄 {snapshot.filename}: {len(snapshot)} usuarios, actualizado hace {snapshot.age() / 60:.1f} min")
+        return
+    snapshot.load()
+    refresh_snapshot(snapshot, full=args.full)
+    print(f"✅ Snapshot al día: {len(snapshot)} usuarios")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,30 @@
 """
 Script para obtener usuarios de Discourse agrupados por país
 Muestra estadísticas y distribución geográfica de los usuarios
+
+Por defecto lee el snapshot local de usuarios (discourse_snapshot.py), que se
+actualiza de forma incremental si está vencido; con --live consulta la API.
+Con --data-explorer el agrupamiento lo calcula el servidor con la consulta
+queries/users_by_country.sql del plugin Data Explorer.
+
+Con --stream cada usuario se escribe a NDJSON/CSV (con --gzip, comprimidos)
+apenas se obtiene, sin juntar el reporte completo en memoria.
 """
 
-import requests
+import argparse
+import time
 import settings
-from collections import defaultdict, Counter
+import http_client
+from collections import defaultdict, deque, Counter
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import gzip
 import json
+import os
+from tqdm import tqdm
+from user_records import ReportUser
+from country_codes import resolve_country
+from discourse_snapshot import get_snapshot, iter_snapshot_users, fetch_listing_page
 
 
 def get_all_discourse_users():
@@ -19,7 +37,7 @@ def get_all_discourse_users():
     }
     
     try:
-        r = requests.get(url, headers=headers)
+        r = http_client.get(url, headers=headers)
         if r.status_code == 200:
             return r.json()
         else:
@@ -30,6 +48,21 @@ def get_all_discourse_users():
         return []
 
 
+def iter_all_discourse_users():
+    """Genera los usuarios de Discourse página a página del listado, sin juntarlos en memoria"""
+    page = 1
+    while True:
+        try:
+            batch = fetch_listing_page(page)
+        except Exception as e:
+            print(f"❌ Error obteniendo la página {page} de usuarios de Discourse: {e}")
+            return
+        if not batch:
+            return
+        yield from batch
+        page += 1
+
+
 def get_user_details(username):
     """Obtiene detalles completos de un usuario específico"""
     url = f"{settings.DISCOURSE_URL}/u/{username}.json"
@@ -39,7 +72,7 @@ def get_user_details(username):
     }
     
     try:
-        r = requests.get(url, headers=headers)
+        r = http_client.get(url, headers=headers)
         if r.status_code == 200:
             return r.json().get("user", {})
         else:
@@ -49,68 +82,290 @@ def get_user_details(username):
         return {}
 
 
+def iter_users_details(users, max_workers=None):
+    """
+    Genera (usuario, detalles) en el orden del listado, pidiendo los detalles en
+    paralelo (REPORT_CONCURRENCY) y solo para los usuarios cuyo listado no trae
+    ya la ubicación. Nunca hay más de unas pocas peticiones por hilo en vuelo,
+    así cada resultado se puede escribir apenas llega. Muestra una barra de
+    progreso y el rendimiento.
+
+    `users` puede ser una lista o un generador (reporte en streaming); con un
+    generador la barra de progreso no conoce el total.
+    """
+    max_workers = max_workers or getattr(settings, 'REPORT_CONCURRENCY', 8)
+    pending = None
+    if isinstance(users, list):
+        pending = sum(1 for user in users if "location" not in user)
+        if not pending:
+            print("📍 El listado ya incluye la ubicación, no se piden detalles")
+            for user in users:
+                yield user, user
+            return
+
+    start = time.time()
+    window = max_workers * 4
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, \
+            tqdm(total=pending, desc="Obteniendo detalles", unit="usuario") as progress_bar:
+        def take():
+            user, future = in_flight.popleft()
+            if future is None:
+                return user, user
+            progress_bar.update(1)
+            # Si falla el detalle, usar lo que trae el listado
+            return user, future.result() or user
+
+        requested = 0
+        for user in users:
+            future = None
+            if "location" not in user:
+                future = executor.submit(get_user_details, user.get("username", "N/A"))
+                requested += 1
+            in_flight.append((user, future))
+            if len(in_flight) > window:
+                yield take()
+        while in_flight:
+            yield take()
+    elapsed = time.time() - start
+    print(f"⚡ {requested} perfiles obtenidos en {elapsed:.1f}s "
+          f"({requested / elapsed if elapsed else 0:.1f} usuarios/s, {max_workers} en paralelo)")
+
+
+def fetch_users_details(users, max_workers=None):
+    """Devuelve los detalles de cada usuario en el mismo orden (ver iter_users_details)"""
+    return [details for _, details in iter_users_details(users, max_workers)]
+
+
 def extract_country_from_location(location):
-    """Extrae el país de la ubicación del usuario"""
-    if not location:
-        return "Sin ubicación"
-    
-    # Si la ubicación contiene una coma, tomar la última parte (país)
-    if "," in location:
-        parts = location.split(",")
-        country = parts[-1].strip()
-        return country
-    
-    # Si no hay coma, asumir que es solo el país
-    return location.strip()
+    """Extrae el país de la ubicación del usuario (nombre canónico, ver resolve_country)"""
+    return resolve_country(location) or "Sin ubicación"
 
 
-def group_users_by_country():
-    """Agrupa usuarios por país"""
-    print("🔍 Obteniendo usuarios de Discourse...")
-    users = get_all_discourse_users()
-    
+def get_report_users(live=False):
+    """Listado de usuarios a reportar (snapshot local, o la API con live=True)"""
+    if live:
+        print("🔍 Obteniendo usuarios de Discourse...")
+        users = get_all_discourse_users()
+    else:
+        print("📄 Leyendo snapshot local de usuarios de Discourse...")
+        users = list(get_snapshot().users.values())
+    if users:
+        print(f"📊 Total de usuarios encontrados: {len(users)}")
+    return users
+
+
+def iter_report_source(live=False):
+    """Como get_report_users, pero genera los usuarios de a uno (páginas del listado o filas del snapshot)"""
+    if live:
+        print("🔍 Obteniendo usuarios de Discourse página a página...")
+        return iter_all_discourse_users()
+    print("📄 Leyendo snapshot local de usuarios de Discourse...")
+    return iter_snapshot_users()
+
+
+def iter_report_users(users, live=False):
+    """Genera un ReportUser por usuario, a medida que se obtienen sus detalles"""
+    if live:
+        print("🔍 Obteniendo detalles de ubicación...")
+        details = iter_users_details(users)
+    else:
+        # El snapshot ya incluye la ubicación
+        details = ((user, user) for user in users)
+
+    for user, user_details in details:
+        username = user.get("username", "N/A")
+        location = user_details.get("location") or ""
+        name = user_details.get("name") or username
+        email = user_details.get("email") or "Sin email"
+        active = user_details.get("active") or False
+
+        # Registro compacto con la información relevante
+        yield ReportUser(
+            username=username,
+            name=name,
+            email=email,
+            location=location,
+            active=active,
+            country=extract_country_from_location(location)
+        )
+
+
+def group_users_by_country(live=False):
+    """Agrupa usuarios por país (desde el snapshot local, o desde la API con live=True)"""
+    users = get_report_users(live)
     if not users:
         print("❌ No se pudieron obtener usuarios")
-        return
-    
-    print(f"📊 Total de usuarios encontrados: {len(users)}")
-    print("🔍 Obteniendo detalles de ubicación...")
+        return {}, Counter()
     
     # Diccionario para agrupar por país
     users_by_country = defaultdict(list)
     country_stats = Counter()
     
-    for i, user in enumerate(users, 1):
-        username = user.get("username", "N/A")
-        print(f"   Procesando {i}/{len(users)}: {username}")
-        
-        # Obtener detalles completos del usuario
-        user_details = get_user_details(username)
-        location = user_details.get("location", "")
-        name = user_details.get("name", username)
-        email = user_details.get("email", "Sin email")
-        active = user_details.get("active", False)
-        
-        # Extraer país de la ubicación
-        country = extract_country_from_location(location)
-        
-        # Crear objeto de usuario con información relevante
-        user_info = {
-            "username": username,
-            "name": name,
-            "email": email,
-            "location": location,
-            "active": active,
-            "country": country
-        }
-        
-        # Agrupar por país
-        users_by_country[country].append(user_info)
-        country_stats[country] += 1
+    for user_info in iter_report_users(users, live):
+        users_by_country[user_info.country].append(user_info)
+        country_stats[user_info.country] += 1
     
     return users_by_country, country_stats
 
 
+class StreamingReportWriter:
+    """
+    Escribe cada registro del reporte apenas se obtiene, en NDJSON y/o CSV
+    (comprimidos con gzip si el nombre termina en .gz), y lleva el conteo por
+    país sin guardar los usuarios en memoria.
+
+    Cada REPORT_FLUSH_EVERY registros vuelca los archivos a disco: si el proceso
+    se interrumpe, lo escrito hasta ese momento queda legible.
+    """
+
+    CSV_HEADER = ['Username', 'Name', 'Email', 'Location', 'Country', 'Active']
+
+    def __init__(self, ndjson_filename=None, csv_filename=None, flush_every=None):
+        self.flush_every = flush_every or getattr(settings, 'REPORT_FLUSH_EVERY', 500)
+        self.country_stats = Counter()
+        self.filenames = [name for name in (ndjson_filename, csv_filename) if name]
+        self._ndjson = self._open(ndjson_filename) if ndjson_filename else None
+        self._csv_file = self._open(csv_filename) if csv_filename else None
+        self._csv = None
+        if self._csv_file:
+            self._csv = csv.writer(self._csv_file)
+            self._csv.writerow(self.CSV_HEADER)
+
+    @staticmethod
+    def _open(filename):
+        if filename.endswith(".gz"):
+            return gzip.open(filename, 'wt', encoding='utf-8', newline='')
+        return open(filename, 'w', encoding='utf-8', newline='')
+
+    def write(self, user):
+        """Escribe un ReportUser y actualiza el conteo de su país"""
+        if self._ndjson:
+            self._ndjson.write(json.dumps(user.to_dict(), ensure_ascii=False, separators=(",", ":")) + "\n")
+        if self._csv:
+            self._csv.writerow([user.username, user.name, user.email, user.location, user.country, user.active])
+        self.country_stats[user.country] += 1
+        if self.count % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        # En los .gz, flush() cierra un bloque completo (Z_SYNC_FLUSH)
+        for f in (self._ndjson, self._csv_file):
+            if f:
+                f.flush()
+
+    @property
+    def count(self):
+        return sum(self.country_stats.values())
+
+    def close(self):
+        for f in (self._ndjson, self._csv_file):
+            if f:
+                f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def stream_users_by_country(ndjson_filename=None, csv_filename=None, live=False):
+    """
+    Genera el reporte por país escribiendo cada usuario a los archivos a medida
+    que se obtiene. Devuelve el conteo por país (también si se interrumpe).
+
+    Los usuarios se leen de a uno (páginas del listado o filas del snapshot),
+    así la memoria no crece con la cantidad de usuarios del foro.
+    """
+    with StreamingReportWriter(ndjson_filename, csv_filename) as writer:
+        try:
+            for user_info in iter_report_users(iter_report_source(live), live):
+                writer.write(user_info)
+        except KeyboardInterrupt:
+            print(f"\n⚠️ Interrumpido: {writer.count} usuarios ya escritos")
+    if not writer.count:
+        print("❌ No se pudieron obtener usuarios")
+        return Counter()
+    for filename in writer.filenames:
+        print(f"💾 {writer.count} usuarios exportados a: {filename}")
+    return writer.country_stats
+
+
+DATA_EXPLORER_SQL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "queries", "users_by_country.sql")
+
+
+def install_data_explorer_query():
+    """Crea en Data Explorer la consulta de queries/users_by_country.sql y devuelve su ID"""
+    with open(DATA_EXPLORER_SQL, 'r', encoding='utf-8') as f:
+        sql = f.read()
+    url = f"{settings.DISCOURSE_URL}/admin/plugins/explorer/queries.json"
+    headers = {
+        "Api-Key": settings.DISCOURSE_API_KEY,
+        "Api-Username": settings.DISCOURSE_API_USER
+    }
+    r = http_client.post(url, headers=headers, json={
+        "query": {"name": "Usuarios por país (sync_moodle_discourse)", "sql": sql}
+    })
+    r.raise_for_status()
+    return r.json().get("query", {}).get("id")
+
+
+def group_users_by_country_server(query_id=None, only_active=True):
+    """
+    Agrupa usuarios por país ejecutando la consulta de Data Explorer
+    (DATA_EXPLORER_QUERY_ID) en el servidor, en una sola llamada.
+
+    El servidor solo agrupa por el texto tras la última coma de la ubicación;
+    el país de cada usuario se vuelve a calcular aquí con resolve_country,
+    así que devuelve las mismas estructuras (y países) que group_users_by_country.
+    """
+    query_id = query_id or getattr(settings, 'DATA_EXPLORER_QUERY_ID', None)
+    if not query_id:
+        print("❌ Falta DATA_EXPLORER_QUERY_ID en settings.py (crear la consulta con --install-query)")
+        return {}, Counter()
+
+    url = f"{settings.DISCOURSE_URL}/admin/plugins/explorer/queries/{query_id}/run.json"
+    headers = {
+        "Api-Key": settings.DISCOURSE_API_KEY,
+        "Api-Username": settings.DISCOURSE_API_USER
+    }
+    print(f"🔍 Ejecutando consulta {query_id} de Data Explorer...")
+    try:
+        r = http_client.post(url, headers=headers, data={
+            "params": json.dumps({"only_active": str(only_active).lower()}),
+            "limit": "ALL",
+        })
+        r.raise_for_status()
+        result = r.json()
+    except Exception as e:
+        print(f"❌ Error ejecutando la consulta de Data Explorer: {e}")
+        return {}, Counter()
+
+    columns = result.get("columns", [])
+    users_by_country = defaultdict(list)
+    country_stats = Counter()
+    for row in result.get("rows", []):
+        data = dict(zip(columns, row))
+        users = data.get("users") or []
+        if isinstance(users, str):
+            users = json.loads(users)
+        for user in users:
+            location = user.get("location") or ""
+            country = extract_country_from_location(location)
+            users_by_country[country].append(ReportUser(
+                username=user.get("username"),
+                name=user.get("name") or user.get("username"),
+                email=user.get("email") or "Sin email",
+                location=location,
+                active=user.get("active") or False,
+                country=country
+            ))
+            country_stats[country] += 1
+    print(f"📊 Total de usuarios encontrados: {sum(country_stats.values())}")
+    return users_by_country, country_stats
+
+
 def print_country_statistics(users_by_country, country_stats):
     """Imprime estadísticas por país"""
     print("\n" + "="*80)
@@ -145,10 +400,10 @@ def print_detailed_users_by_country(users_by_country):
         print("-" * 50)
         
         for user in users:
-            status = "✅ Activo" if user["active"] else "❌ Inactivo"
-            print(f"  👤 {user['username']} ({user['name']})")
-            print(f"     📧 {user['email']}")
-            print(f"     📍 {user['location']}")
+            status = "✅ Activo" if user.active else "❌ Inactivo"
+            print(f"  👤 {user.username} ({user.name})")
+            print(f"     📧 {user.email}")
+            print(f"     📍 {user.location}")
             print(f"     {status}")
             print()
 
@@ -156,8 +411,11 @@ def print_detailed_users_by_country(users_by_country):
 def export_to_json(users_by_country, filename="discourse_users_by_country.json"):
     """Exporta los datos a un archivo JSON"""
     try:
-        # Convertir defaultdict a dict normal para JSON
-        export_data = dict(users_by_country)
+        # Convertir defaultdict de registros a dict normal para JSON
+        export_data = {
+            country: [user.to_dict() for user in users]
+            for country, users in users_by_country.items()
+        }
         
         with open(filename, 'w', encoding='utf-8') as f:
             json.dump(export_data, f, indent=2, ensure_ascii=False)
@@ -170,8 +428,6 @@ def export_to_json(users_by_country, filename="discourse_users_by_country.json")
 def export_to_csv(users_by_country, filename="discourse_users_by_country.csv"):
     """Exporta los datos a un archivo CSV"""
     try:
-        import csv
-        
         with open(filename, 'w', newline='', encoding='utf-8') as f:
             writer = csv.writer(f)
             
@@ -182,12 +438,12 @@ def export_to_csv(users_by_country, filename="discourse_users_by_country.csv"):
             for country, users in users_by_country.items():
                 for user in users:
                     writer.writerow([
-                        user['username'],
-                        user['name'],
-                        user['email'],
-                        user['location'],
-                        user['country'],
-                        user['active']
+                        user.username,
+                        user.name,
+                        user.email,
+                        user.location,
+                        user.country,
+                        user.active
                     ])
         
         print(f"💾 Datos exportados a: {filename}")
@@ -197,11 +453,46 @@ def export_to_csv(users_by_country, filename="discourse_users_by_country.csv"):
 
 def main():
     """Función principal"""
+    parser = argparse.ArgumentParser(description="Reporte de usuarios de Discourse por país")
+    parser.add_argument("--live", action="store_true",
+                        help="Consulta la API de Discourse en lugar del snapshot local")
+    parser.add_argument("--data-explorer", action="store_true",
+                        help="Agrupa por país en el servidor con la consulta de Data Explorer (DATA_EXPLORER_QUERY_ID)")
+    parser.add_argument("--install-query", action="store_true",
+                        help="Crea la consulta de queries/users_by_country.sql en Data Explorer, muestra su ID y termina")
+    parser.add_argument("--stream", action="store_true",
+                        help="Escribe cada usuario a NDJSON/CSV apenas se obtiene (memoria constante)")
+    parser.add_argument("--format", choices=["ndjson", "csv", "both"], default="both",
+                        help="Formato de --stream (por defecto ambos)")
+    parser.add_argument("--gzip", action="store_true",
+                        help="Comprime con gzip los archivos de --stream")
+    args = parser.parse_args()
+    if args.stream and args.data_explorer:
+        parser.error("--stream no se puede combinar con --data-explorer")
+
+    if args.install_query:
+        query_id = install_data_explorer_query()
+        print(f"✅ Consulta creada en Data Explorer con ID {query_id}: agregar DATA_EXPLORER_QUERY_ID = {query_id} a settings.py")
+        return
+
     print("🚀 Script de análisis de usuarios de Discourse por país")
     print("="*60)
     
+    if args.stream:
+        suffix = ".gz" if args.gzip else ""
+        ndjson_filename = f"discourse_users_by_country.ndjson{suffix}" if args.format in ("ndjson", "both") else None
+        csv_filename = f"discourse_users_by_country.csv{suffix}" if args.format in ("csv", "both") else None
+        country_stats = stream_users_by_country(ndjson_filename, csv_filename, live=args.live)
+        if country_stats:
+            print_country_statistics(None, country_stats)
+            print("\n✅ Análisis completado!")
+        return
+
     # Obtener y agrupar usuarios
-    users_by_country, country_stats = group_users_by_country()
+    if args.data_explorer:
+        users_by_country, country_stats = group_users_by_country_server()
+    else:
+        users_by_country, country_stats = group_users_by_country(live=args.live)
     
     if not users_by_country:
         print("❌ No se encontraron usuarios para analizar")
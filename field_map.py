@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Mapeo declarativo de campos Moodle -> Discourse.
+
+Qué campos se sincronizan se define en settings.FIELD_MAP (por defecto,
+DEFAULT_FIELD_MAP): una lista de reglas con
+
+- source:    campo de MoodleUser ('fullname', 'email', ...), un campo de perfil
+             personalizado como 'profile_field_<shortname>', o una lista de campos
+             (la transformación recibe todos los valores);
+- target:    campo de Discourse ('name', 'location', 'bio_raw', 'email', 'title',
+             'website', ...) o un campo de usuario personalizado 'user_fields.<id>';
+- transform: opcional, nombre de TRANSFORMS o una función;
+- policy:    'if_empty' (por defecto, solo completa campos vacíos en Discourse),
+             'always' (sobrescribe si es distinto) o 'never'.
+
+Las reglas se compilan una sola vez (FieldMap) y diff() calcula en una pasada
+los cambios de un usuario, que se envían juntos en una sola escritura.
+"""
+
+import settings
+from country_codes import resolve_country
+from user_records import MoodleUser
+
+DEFAULT_FIELD_MAP = [
+    {'source': 'fullname', 'target': 'name'},
+    {'source': ['city', 'country'], 'target': 'location', 'transform': 'location'},
+    {'source': 'description', 'target': 'bio_raw'},
+    {'source': 'email', 'target': 'email'},
+]
+
+POLICIES = ('if_empty', 'always', 'never')
+
+# Prefijo de los campos de perfil personalizados de Moodle (como en la descarga de usuarios)
+CUSTOM_FIELD_PREFIX = "profile_field_"
+# Prefijo de los campos de usuario personalizados de Discourse
+USER_FIELD_PREFIX = "user_fields."
+
+
+def is_field_empty(value):
+    """Verifica si un campo está vacío (None, string vacío, o solo espacios)"""
+    if value is None:
+        return True
+    if isinstance(value, str):
+        return value.strip() == ""
+    return False
+
+
+def _location(city, country):
+    """Ciudad y nombre del país ("Ciudad, País"), o lo que haya de los dos"""
+    country_name = resolve_country(country)
+    return ", ".join(part for part in (city, country_name) if part) or None
+
+
+def _first(*values):
+    return next((value for value in values if not is_field_empty(value)), None)
+
+
+TRANSFORMS = {
+    'strip': lambda value: value.strip() if isinstance(value, str) else value,
+    'lower': lambda value: value.lower() if isinstance(value, str) else value,
+    'title': lambda value: value.title() if isinstance(value, str) else value,
+    'country_name': resolve_country,
+    'location': _location,
+    'first': _first,
+}
+
+
+def _custom_field(moodle_user, shortname):
+    for field in moodle_user.get("customfields") or []:
+        if field.get("shortname") == shortname:
+            return field.get("value")
+    return None
+
+
+class FieldRule:
+    """Regla compilada: de dónde sale el valor, cómo se transforma y cuándo se escribe"""
+
+    __slots__ = ("sources", "target", "transform", "policy", "multiple")
+
+    def __init__(self, source, target, transform=None, policy='if_empty'):
+        self.multiple = isinstance(source, (list, tuple))
+        self.sources = tuple(source) if self.multiple else (source,)
+        for name in self.sources:
+            if name not in MoodleUser.__slots__ and not name.startswith(CUSTOM_FIELD_PREFIX):
+                raise ValueError(f"FIELD_MAP: campo de Moodle desconocido '{name}'")
+        if not target:
+            raise ValueError(f"FIELD_MAP: falta 'target' en la regla de {source}")
+        if policy not in POLICIES:
+            raise ValueError(f"FIELD_MAP: policy '{policy}' no válida para {target} (usar {', '.join(POLICIES)})")
+        if isinstance(transform, str):
+            if transform not in TRANSFORMS:
+                raise ValueError(f"FIELD_MAP: transformación desconocida '{transform}' para {target}")
+            transform = TRANSFORMS[transform]
+        if self.multiple and transform is None:
+            raise ValueError(f"FIELD_MAP: {target} combina varios campos y necesita 'transform'")
+        self.target = target
+        self.transform = transform
+        self.policy = policy
+
+    def value(self, moodle_user):
+        """Valor de Moodle para el campo de destino, ya transformado"""
+        values = [
+            _custom_field(moodle_user, name[len(CUSTOM_FIELD_PREFIX):]) if name.startswith(CUSTOM_FIELD_PREFIX)
+            else moodle_user.get(name)
+            for name in self.sources
+        ]
+        if self.transform is None:
+            return values[0]
+        return self.transform(*values)
+
+    def current(self, discourse_user):
+        """Valor actual del campo en Discourse"""
+        if self.target.startswith(USER_FIELD_PREFIX):
+            return (discourse_user.get("user_fields") or {}).get(self.target[len(USER_FIELD_PREFIX):])
+        return discourse_user.get(self.target)
+
+
+class UserDiff:
+    """Cambios de un usuario: los que se escriben y los que la política conserva"""
+
+    __slots__ = ("changes", "preserved")
+
+    def __init__(self):
+        self.changes = {}    # target -> valor nuevo
+        self.preserved = {}  # target -> (valor en Discourse, valor en Moodle)
+
+    def __bool__(self):
+        return bool(self.changes)
+
+
+class FieldMap:
+    """Lista de reglas compiladas a partir de FIELD_MAP"""
+
+    def __init__(self, entries):
+        self.rules = [FieldRule(**entry) for entry in entries]
+
+    def diff(self, moodle_user, discourse_user, skip_targets=()):
+        """Compara un usuario de Moodle con el de Discourse aplicando todas las reglas"""
+        result = UserDiff()
+        for rule in self.rules:
+            if rule.policy == 'never' or rule.target in skip_targets:
+                continue
+            new_value = rule.value(moodle_user)
+            if is_field_empty(new_value):
+                continue
+            old_value = rule.current(discourse_user)
+            if old_value == new_value:
+                continue
+            if rule.policy == 'always' or is_field_empty(old_value):
+                result.changes[rule.target] = new_value
+            else:
+                result.preserved[rule.target] = (old_value, new_value)
+        return result
+
+
+_field_map = None
+
+
+def get_field_map():
+    """FieldMap de settings.FIELD_MAP (o DEFAULT_FIELD_MAP), compilado una sola vez"""
+    global _field_map
+    if _field_map is None:
+        _field_map = FieldMap(getattr(settings, 'FIELD_MAP', DEFAULT_FIELD_MAP))
+    return _field_map
+
+
+def build_profile_payload(changes, discourse_user=None):
+    """
+    Convierte los cambios en el cuerpo de PUT /u/{username}.json: los
+    'user_fields.<id>' se agrupan en user_fields (conservando los demás campos
+    personalizados que ya tiene el usuario).
+    """
+    payload = {}
+    user_fields = None
+    for target, value in changes.items():
+        if target.startswith(USER_FIELD_PREFIX) or target == "user_fields":
+            if user_fields is None:
+                user_fields = dict((discourse_user.get("user_fields") if discourse_user else None) or {})
+            if target == "user_fields":
+                user_fields.update(value)
+            else:
+                user_fields[target[len(USER_FIELD_PREFIX):]] = value
+        else:
+            payload[target] = value
+    if user_fields is not None:
+        payload["user_fields"] = user_fields
+    return payload
@@ -0,0 +1,57 @@
+-- Esquema mínimo de Moodle para probar la fuente de base de datos (moodle_db.py).
+-- Solo incluye las tablas y columnas que lee la sincronización. Compatible con
+-- SQLite y PostgreSQL:
+--
+--   sqlite3 moodle_fixture.db < fixtures/moodle_schema.sql
+--   psql moodle_fixture < fixtures/moodle_schema.sql
+
+CREATE TABLE mdl_user (
+    id BIGINT PRIMARY KEY,
+    auth VARCHAR(20) NOT NULL DEFAULT 'manual',
+    confirmed SMALLINT NOT NULL DEFAULT 0,
+    deleted SMALLINT NOT NULL DEFAULT 0,
+    suspended SMALLINT NOT NULL DEFAULT 0,
+    username VARCHAR(100) NOT NULL DEFAULT '',
+    firstname VARCHAR(100) NOT NULL DEFAULT '',
+    lastname VARCHAR(100) NOT NULL DEFAULT '',
+    email VARCHAR(100) NOT NULL DEFAULT '',
+    city VARCHAR(120) NOT NULL DEFAULT '',
+    country VARCHAR(2) NOT NULL DEFAULT '',
+    description TEXT,
+    timemodified BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE INDEX mdl_user_timemodified_ix ON mdl_user (timemodified);
+
+CREATE TABLE mdl_user_info_field (
+    id BIGINT PRIMARY KEY,
+    shortname VARCHAR(255) NOT NULL DEFAULT 'shortname',
+    name TEXT NOT NULL
+);
+
+CREATE TABLE mdl_user_info_data (
+    id BIGINT PRIMARY KEY,
+    userid BIGINT NOT NULL DEFAULT 0,
+    fieldid BIGINT NOT NULL DEFAULT 0,
+    data TEXT NOT NULL
+);
+
+CREATE INDEX mdl_user_info_data_userid_ix ON mdl_user_info_data (userid);
+
+INSERT INTO mdl_user (id, auth, confirmed, deleted, suspended, username, firstname, lastname, email, city, country, description, timemodified) VALUES
+    (1, 'manual', 1, 0, 0, 'guest', 'Guest user', ' ', 'root@localhost', '', '', 'Usuario invitado', 1700000000),
+    (2, 'manual', 1, 0, 0, 'admin', 'Admin', 'User', 'admin@example.org', 'Madrid', 'ES', NULL, 1700000000),
+    (3, 'manual', 1, 0, 0, 'maria.garcia', 'María', 'García', 'maria@example.org', 'Lima', 'PE', 'Docente de matemáticas', 1710000000),
+    (4, 'manual', 1, 0, 0, 'Juan_Perez', 'Juan', 'Pérez', 'juan@example.org', 'Bogotá', 'CO', '', 1720000000),
+    (5, 'manual', 1, 0, 1, 'suspendido', 'Usuario', 'Suspendido', 'susp@example.org', '', '', NULL, 1720000000),
+    (6, 'manual', 1, 1, 0, 'eliminado', 'Usuario', 'Eliminado', 'del@example.org', '', '', NULL, 1720000000),
+    (7, 'manual', 0, 0, 0, 'sinconfirmar', 'Sin', 'Confirmar', 'pend@example.org', '', '', NULL, 1720000000);
+
+INSERT INTO mdl_user_info_field (id, shortname, name) VALUES
+    (1, 'institution', 'Institución'),
+    (2, 'program', 'Programa');
+
+INSERT INTO mdl_user_info_data (id, userid, fieldid, data) VALUES
+    (1, 3, 1, 'Universidad Nacional'),
+    (2, 3, 2, 'Maestría en Educación'),
+    (3, 4, 2, 'Diplomado');
@@ -0,0 +1,532 @@
+# -*- coding: utf-8 -*-
+"""
+Cliente HTTP compartido para las llamadas a Moodle y Discourse.
+
+Todas las peticiones pasan por una única requests.Session con un pool de
+conexiones persistente, de modo que las ejecuciones largas (modo daemon)
+reutilizan las conexiones TCP/TLS en lugar de abrir una nueva por llamada.
+
+Cada petición lleva timeouts de conexión/lectura según el servicio (moodle o
+discourse) y pasa por un circuit breaker por servicio: tras varios fallos
+consecutivos el circuito se abre, las peticiones fallan de inmediato con
+CircuitOpenError y, pasado el tiempo de recuperación, se deja pasar una
+petición de prueba que decide si el circuito se cierra o vuelve a abrirse.
+
+Con RATE_LIMITS cada servicio tiene además un presupuesto de peticiones por
+segundo (token bucket): las peticiones que lo superan esperan su turno en
+lugar de provocar respuestas 429.
+
+Con DISCOURSE_API_KEYS las peticiones a Discourse se reparten entre varias
+API keys (cada una con su propio token bucket, por lo que el ritmo total crece
+con la cantidad de keys, y esas peticiones no consumen el presupuesto de
+RATE_LIMITS['discourse']): una key que recibe 429 queda en pausa el tiempo que
+indica Discourse y una key revocada (401/403 de credenciales) se descarta; en
+ambos casos la petición se repite con otra key.
+
+Las lecturas idempotentes pueden hacerse con hedged_get(): si la respuesta no
+llega antes del percentil de latencia configurado (HEDGE_PERCENTILE), se envía
+una petición duplicada y se usa la primera respuesta que llegue.
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import settings
+
+_session = None
+_session_lock = threading.Lock()
+_breakers = {}
+_rate_limiters = {}
+_credential_pool = None
+
+# Hedging: None = usar settings.HEDGE_ENABLED; --hedge lo fuerza a True
+hedging_enabled = None
+_hedge_executor = None
+_latencies = {}  # servicio -> deque con las últimas latencias (segundos)
+_hedge_lock = threading.Lock()
+_hedge_metrics = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'saved_seconds': 0.0}
+
+# Timeouts (conexión, lectura) en segundos por servicio si settings no define HTTP_TIMEOUTS
+DEFAULT_TIMEOUTS = {
+    'moodle': (5, 120),
+    'discourse': (5, 30),
+}
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """La petición no se envió porque el circuito del servicio está abierto"""
+
+
+class CircuitBreaker:
+    """Circuit breaker simple: closed -> open (tras N fallos) -> half_open (prueba) -> closed"""
+
+    def __init__(self, name, failure_threshold=5, recovery_timeout=60):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_started_at = None  # token de la única petición de prueba en curso (half_open)
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        """True mientras el circuito está abierto y aún no corresponde probar la recuperación"""
+        with self._lock:
+            return self.state == "open" and time.monotonic() - self.opened_at < self.recovery_timeout
+
+    def seconds_until_probe(self):
+        """Segundos que faltan para la próxima petición de prueba (0 si el circuito no está abierto)"""
+        with self._lock:
+            if self.state != "open":
+                return 0
+            return max(0.0, self.recovery_timeout - (time.monotonic() - self.opened_at))
+
+    def before_request(self):
+        """
+        Lanza CircuitOpenError si la petición no debe enviarse. Con el circuito
+        en prueba pasa una sola petición; si esa prueba nunca informa su
+        resultado, pasado recovery_timeout se concede el token a otra.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "open":
+                if now - self.opened_at < self.recovery_timeout:
+                    raise CircuitOpenError(f"Circuito de {self.name} abierto, petición no enviada")
+                # Pasó el tiempo de recuperación: dejar pasar una petición de prueba
+                self.state = "half_open"
+                self.probe_started_at = now
+                print(f"[CIRCUIT] Probando recuperación de {self.name}...")
+            elif self.state == "half_open":
+                if self.probe_started_at is not None and now - self.probe_started_at < self.recovery_timeout:
+                    raise CircuitOpenError(f"Circuito de {self.name} en prueba, petición no enviada")
+                self.probe_started_at = now
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                print(f"[CIRCUIT] {self.name} respondió, circuito cerrado")
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self.probe_started_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == "half_open" or (
+                    self.state == "closed" and self.consecutive_failures >= self.failure_threshold):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.probe_started_at = None
+                print(f"[CIRCUIT] Circuito de {self.name} abierto tras {self.consecutive_failures} fallos "
+                      f"consecutivos, nueva prueba en {self.recovery_timeout}s")
+
+
+class TokenBucket:
+    """Token bucket: `rate` peticiones por segundo con ráfagas de hasta `burst`"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1.0, self.rate))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self):
+        """Consume un token si hay; si no, devuelve los segundos de espera hasta el próximo"""
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """Espera hasta obtener un token"""
+        while True:
+            wait_time = self.try_acquire()
+            if not wait_time:
+                return
+            time.sleep(wait_time)
+
+
+class ApiCredential:
+    """API key de Discourse del pool, con su presupuesto y su estado"""
+
+    __slots__ = ("key", "username", "bucket", "throttled_until", "revoked", "requests", "throttles")
+
+    def __init__(self, key, username, rate, burst=None):
+        self.key = key
+        self.username = username
+        self.bucket = TokenBucket(rate, burst)
+        self.throttled_until = 0.0
+        self.revoked = False
+        self.requests = 0
+        self.throttles = 0
+
+    def label(self):
+        """Identifica la key en los mensajes sin mostrarla completa"""
+        return f"{self.username}/…{self.key[-4:]}"
+
+
+class CredentialPool:
+    """Reparte las peticiones entre varias API keys en round robin, según el presupuesto de cada una"""
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Devuelve la siguiente key con presupuesto disponible, esperando si todas
+        están agotadas o en pausa por 429. None si todas fueron revocadas.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                min_wait = None
+                for offset in range(len(self.credentials)):
+                    index = (self._next + offset) % len(self.credentials)
+                    credential = self.credentials[index]
+                    if credential.revoked:
+                        continue
+                    if credential.throttled_until > now:
+                        wait_time = credential.throttled_until - now
+                    else:
+                        wait_time = credential.bucket.try_acquire()
+                    if not wait_time:
+                        self._next = (index + 1) % len(self.credentials)
+                        credential.requests += 1
+                        return credential
+                    min_wait = wait_time if min_wait is None else min(min_wait, wait_time)
+                if min_wait is None:
+                    return None
+            time.sleep(min_wait)
+
+    def throttle(self, credential, seconds):
+        with self._lock:
+            credential.throttles += 1
+            credential.throttled_until = time.monotonic() + seconds
+        print(f"[RATE] API key {credential.label()} limitada por Discourse, en pausa {seconds:.0f}s")
+
+    def revoke(self, credential):
+        with self._lock:
+            credential.revoked = True
+            remaining = sum(1 for c in self.credentials if not c.revoked)
+        print(f"[WARNING] API key {credential.label()} rechazada por Discourse (revocada o inválida), "
+              f"se descarta; quedan {remaining}")
+
+    def metrics(self):
+        """Peticiones y pausas por key"""
+        with self._lock:
+            return {
+                credential.label(): {'requests': credential.requests, 'throttles': credential.throttles,
+                                     'revoked': credential.revoked}
+                for credential in self.credentials
+            }
+
+    def __len__(self):
+        return len(self.credentials)
+
+
+def service_for_url(url):
+    """Identifica a qué servicio (moodle o discourse) va dirigida una URL"""
+    moodle_endpoint = getattr(settings, 'MOODLE_ENDPOINT', None)
+    if moodle_endpoint and url.startswith(moodle_endpoint):
+        return 'moodle'
+    return 'discourse'
+
+
+def get_timeout(service):
+    """Tupla (timeout de conexión, timeout de lectura) configurada para un servicio"""
+    timeouts = getattr(settings, 'HTTP_TIMEOUTS', None) or {}
+    return tuple(timeouts.get(service, DEFAULT_TIMEOUTS[service]))
+
+
+def get_breaker(service):
+    """Devuelve el circuit breaker de un servicio, creándolo la primera vez"""
+    with _session_lock:
+        if service not in _breakers:
+            _breakers[service] = CircuitBreaker(
+                service,
+                failure_threshold=getattr(settings, 'CIRCUIT_FAILURE_THRESHOLD', 5),
+                recovery_timeout=getattr(settings, 'CIRCUIT_RECOVERY_TIMEOUT', 60),
+            )
+        return _breakers[service]
+
+
+def get_rate_limiter(service):
+    """Token bucket del servicio según RATE_LIMITS, o None si no tiene límite"""
+    with _session_lock:
+        if service not in _rate_limiters:
+            limit = (getattr(settings, 'RATE_LIMITS', None) or {}).get(service)
+            if isinstance(limit, (tuple, list)):
+                _rate_limiters[service] = TokenBucket(*limit)
+            else:
+                _rate_limiters[service] = TokenBucket(limit) if limit else None
+        return _rate_limiters[service]
+
+
+def get_credential_pool():
+    """
+    Pool de API keys de DISCOURSE_API_KEYS, o None si no se configuró.
+
+    Cada elemento es una tupla (key, username) o un dict con 'key', 'username'
+    y opcionalmente 'rate' y 'burst' (por defecto API_KEY_RATE).
+    """
+    global _credential_pool
+    with _session_lock:
+        if _credential_pool is None:
+            entries = getattr(settings, 'DISCOURSE_API_KEYS', None) or []
+            default_rate = getattr(settings, 'API_KEY_RATE', (1.0, 10))
+            credentials = []
+            for entry in entries:
+                if not isinstance(entry, dict):
+                    entry = dict(zip(("key", "username"), entry))
+                if not entry.get("key") or not entry.get("username"):
+                    raise ValueError("DISCOURSE_API_KEYS: cada key necesita 'key' y 'username'")
+                credentials.append(ApiCredential(entry["key"], entry["username"],
+                                                 entry.get("rate", default_rate[0]),
+                                                 entry.get("burst", default_rate[1])))
+            _credential_pool = CredentialPool(credentials) if credentials else False
+        return _credential_pool or None
+
+
+def credential_metrics():
+    """Métricas del pool de API keys (dict vacío si no hay pool)"""
+    pool = get_credential_pool()
+    return pool.metrics() if pool is not None else {}
+
+
+def get_session():
+    """Devuelve la sesión HTTP compartida, creándola la primera vez"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                pool_size = getattr(settings, 'HTTP_POOL_SIZE', 10)
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def close_session():
+    """Cierra la sesión compartida y libera las conexiones del pool"""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def request(method, url, **kwargs):
+    """
+    Realiza una petición HTTP usando la sesión compartida, con el timeout y el
+    circuit breaker del servicio de destino.
+
+    Los timeouts y errores de conexión se propagan como excepciones de requests
+    (igual que antes); las respuestas 5xx se devuelven normalmente pero cuentan
+    como fallo para el circuit breaker.
+    """
+    service = service_for_url(url)
+    breaker = get_breaker(service)
+    kwargs.setdefault('timeout', get_timeout(service))
+
+    if service == 'discourse' and "Api-Key" in (kwargs.get('headers') or {}):
+        pool = get_credential_pool()
+        if pool is not None:
+            return _request_with_pool(pool, service, breaker, method, url, kwargs)
+    return _send(service, breaker, method, url, kwargs)
+
+
+def _send(service, breaker, method, url, kwargs, rate_limited=True):
+    """
+    Envía una petición respetando el circuit breaker y el presupuesto del
+    servicio; con rate_limited=False no usa el presupuesto (la petición ya
+    esperó en el token bucket de su API key).
+    """
+    breaker.before_request()
+    limiter = get_rate_limiter(service) if rate_limited else None
+    if limiter is not None:
+        limiter.acquire()
+    try:
+        response = get_session().request(method, url, **kwargs)
+    except Exception:
+        # Cualquier error (no solo timeouts): si era la prueba, el circuito no queda en half_open
+        breaker.record_failure()
+        raise
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return response
+
+
+def _retry_after(response):
+    """Segundos de pausa que pide Discourse en un 429 (Retry-After o extras.wait_seconds)"""
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return float(response.json().get("extras", {}).get("wait_seconds"))
+    except (ValueError, TypeError, AttributeError):
+        return getattr(settings, 'API_KEY_THROTTLE_DEFAULT', 10)
+
+
+def _is_rejected_key(response):
+    """401, o 403 de Discourse por API key/username inválidos (no por falta de permisos sobre el recurso)"""
+    if response.status_code == 401:
+        return True
+    return response.status_code == 403 and "key is invalid" in response.text
+
+
+def _request_with_pool(pool, service, breaker, method, url, kwargs):
+    """
+    Envía la petición con una key del pool y, si Discourse la limita (429) o la
+    rechaza, la repite con otra. Los cuerpos en streaming no se pueden reenviar:
+    en ese caso se devuelve la respuesta tal cual.
+    """
+    data = kwargs.get('data')
+    replayable = data is None or isinstance(data, (bytes, str, dict, list, tuple))
+    response = None
+    for _ in range(len(pool) + 1):
+        credential = pool.acquire()
+        if credential is None:
+            if response is None:
+                # Todas las keys del pool revocadas: usar las cabeceras originales
+                return _send(service, breaker, method, url, kwargs)
+            return response
+        headers = dict(kwargs['headers'], **{"Api-Key": credential.key, "Api-Username": credential.username})
+        response = _send(service, breaker, method, url, dict(kwargs, headers=headers), rate_limited=False)
+        if response.status_code == 429:
+            pool.throttle(credential, _retry_after(response))
+        elif _is_rejected_key(response):
+            pool.revoke(credential)
+        else:
+            return response
+        if not replayable:
+            return response
+    return response
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def _timed_request(service, method, url, kwargs):
+    """Ejecuta una petición y registra su latencia para el cálculo del percentil"""
+    start = time.monotonic()
+    response = request(method, url, **kwargs)
+    elapsed = time.monotonic() - start
+    with _hedge_lock:
+        _latencies.setdefault(service, deque(maxlen=500)).append(elapsed)
+    return response, start, elapsed
+
+
+def hedge_delay(service):
+    """Espera antes de enviar el duplicado: percentil HEDGE_PERCENTILE de las latencias recientes"""
+    with _hedge_lock:
+        samples = sorted(_latencies.get(service, ()))
+    if len(samples) < getattr(settings, 'HEDGE_MIN_SAMPLES', 20):
+        return getattr(settings, 'HEDGE_DEFAULT_DELAY', 1.0)
+    percentile = getattr(settings, 'HEDGE_PERCENTILE', 95)
+    index = min(len(samples) - 1, int(len(samples) * percentile / 100))
+    return samples[index]
+
+
+def _get_hedge_executor():
+    global _hedge_executor
+    with _hedge_lock:
+        if _hedge_executor is None:
+            _hedge_executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'HEDGE_MAX_WORKERS', 8), thread_name_prefix="hedge")
+        return _hedge_executor
+
+
+def hedged_get(url, **kwargs):
+    """
+    GET idempotente con hedging: si no hay respuesta antes del percentil de
+    latencia configurado, envía un duplicado y devuelve la primera respuesta.
+
+    Si el hedging está desactivado equivale a get().
+    """
+    enabled = hedging_enabled if hedging_enabled is not None else getattr(settings, 'HEDGE_ENABLED', False)
+    service = service_for_url(url)
+    if not enabled:
+        return _timed_request(service, "GET", url, kwargs)[0]
+
+    executor = _get_hedge_executor()
+    with _hedge_lock:
+        _hedge_metrics['requests'] += 1
+
+    primary = executor.submit(_timed_request, service, "GET", url, kwargs)
+    done, _ = wait([primary], timeout=hedge_delay(service))
+    if done:
+        return primary.result()[0]
+
+    # La respuesta tarda más que el percentil: enviar un duplicado
+    with _hedge_lock:
+        _hedge_metrics['hedged'] += 1
+    hedge_start = time.monotonic()
+    hedge = executor.submit(_timed_request, service, "GET", url, kwargs)
+    pending = {primary, hedge}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                response, _, _ = future.result()
+            except Exception as e:
+                error = e
+                continue
+            if future is hedge:
+                _record_hedge_win(primary, hedge_start)
+            return response
+    raise error
+
+
+def _record_hedge_win(primary, hedge_start):
+    """Cuando gana el duplicado, mide cuánto se ahorró respecto de la petición original"""
+    hedge_finished = time.monotonic()
+    with _hedge_lock:
+        _hedge_metrics['hedge_wins'] += 1
+
+    def on_primary_done(future):
+        if future.exception() is not None:
+            return
+        _, primary_start, primary_elapsed = future.result()
+        saved = (primary_start + primary_elapsed) - hedge_finished
+        if saved > 0:
+            with _hedge_lock:
+                _hedge_metrics['saved_seconds'] += saved
+
+    primary.add_done_callback(on_primary_done)
+
+
+def hedge_metrics():
+    """Copia de las métricas de hedging (peticiones, duplicadas, ganadas, segundos ahorrados)"""
+    with _hedge_lock:
+        return dict(_hedge_metrics)
+
+
+def put(url, **kwargs):
+    return request("PUT", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
@@ -1,22 +1,29 @@
+import sys
 import requests
 import settings
+from discourse_snapshot import get_snapshot
 
 # Verificar lista actualizada de usuarios en Discourse
-url = f'{settings.DISCOURSE_URL}/admin/users/list/active.json'
-headers = {
-    'Api-Key': settings.DISCOURSE_API_KEY,
-    'Api-Username': settings.DISCOURSE_API_USER
-}
+# Por defecto usa el snapshot local (discourse_snapshot.py); con --live consulta la API
+if '--live' in sys.argv:
+    url = f'{settings.DISCOURSE_URL}/admin/users/list/active.json'
+    headers = {
+        'Api-Key': settings.DISCOURSE_API_KEY,
+        'Api-Username': settings.DISCOURSE_API_USER
+    }
 
-r = requests.get(url, headers=headers)
-if r.status_code == 200:
+    r = requests.get(url, headers=headers)
+    if r.status_code != 200:
+        print(f'Error: {r.status_code} - {r.text}')
+        sys.exit(1)
     users = r.json()
-    print(f'Total de usuarios en Discourse: {len(users)}')
-    print('\nUsuarios encontrados:')
-    for user in users:
-        username = user.get('username', 'N/A')
-        name = user.get('name', 'N/A')
-        active = user.get('active', 'N/A')
-        print(f'  - {username} ({name}) - Active: {active}')
 else:
-    print(f'Error: {r.status_code} - {r.text}')
+    users = list(get_snapshot().users.values())
+
+print(f'Total de usuarios en Discourse: {len(users)}')
+print('\nUsuarios encontrados:')
+for user in users:
+    username = user.get('username', 'N/A')
+    name = user.get('name', 'N/A')
+    active = user.get('active', 'N/A')
+    print(f'  - {username} ({name}) - Active: {active}')
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Fuente de usuarios de Moodle leyendo directamente la base de datos (solo lectura).
+
+Pensado para una réplica de lectura: evita la capa de web services de Moodle,
+que serializa cada usuario con todos sus campos en PHP. Lee mdl_user junto con
+los campos de perfil personalizados (mdl_user_info_data / mdl_user_info_field)
+con un cursor en streaming y devuelve los mismos MoodleUser que
+get_moodle_users.
+
+Motores soportados (settings.MOODLE_DB['engine']):
+- 'sqlite': módulo sqlite3 de la biblioteca estándar (útil con el esquema de
+  fixtures/moodle_schema.sql).
+- 'postgres': requiere psycopg2; usa un cursor con nombre (server-side) para no
+  traer todos los usuarios de una vez.
+"""
+
+import itertools
+import sqlite3
+
+import settings
+from user_records import MoodleUser
+
+USER_COLUMNS = ("id", "username", "firstname", "lastname", "email", "city", "country", "description", "timemodified")
+
+
+def get_db_config():
+    """Configuración de la base de Moodle (settings.MOODLE_DB)"""
+    config = getattr(settings, 'MOODLE_DB', None)
+    if not config:
+        raise RuntimeError("MOODLE_DB no está definido en settings.py")
+    return config
+
+
+def connect(config=None):
+    """Abre una conexión de solo lectura. Devuelve (conexión, placeholder de parámetros)"""
+    config = config or get_db_config()
+    engine = config.get('engine', 'postgres')
+    if engine == 'sqlite':
+        conn = sqlite3.connect(f"file:{config['path']}?mode=ro", uri=True)
+        return conn, "?"
+    if engine == 'postgres':
+        try:
+            import psycopg2
+        except ImportError:
+            raise RuntimeError("Para leer Moodle desde PostgreSQL instala psycopg2: pip install psycopg2-binary")
+        conn = psycopg2.connect(config['dsn'])
+        conn.set_session(readonly=True)
+        return conn, "%s"
+    raise ValueError(f"Motor de base de datos no soportado: {engine} (usar 'sqlite' o 'postgres')")
+
+
+def build_users_query(prefix, placeholder, modified_since=None):
+    """
+    Consulta de usuarios activos con sus campos de perfil personalizados.
+
+    Cada usuario aparece en tantas filas como campos personalizados tenga (al
+    menos una), ordenadas por ID para poder agruparlas sin cargarlas todas.
+    """
+    columns = ", ".join(f"u.{column}" for column in USER_COLUMNS)
+    sql = (
+        f"SELECT {columns}, f.shortname, f.name, d.data "
+        f"FROM {prefix}user u "
+        f"LEFT JOIN {prefix}user_info_data d ON d.userid = u.id "
+        f"LEFT JOIN {prefix}user_info_field f ON f.id = d.fieldid "
+        f"WHERE u.deleted = 0 AND u.suspended = 0 AND u.confirmed = 1 AND u.username <> 'guest'"
+    )
+    params = []
+    if modified_since:
+        sql += f" AND u.timemodified >= {placeholder}"
+        params.append(int(modified_since))
+    sql += " ORDER BY u.id"
+    return sql, params
+
+
+def rows_to_moodle_user(rows):
+    """Convierte las filas de un mismo usuario en un MoodleUser con sus customfields"""
+    first = dict(zip(USER_COLUMNS, rows[0][:len(USER_COLUMNS)]))
+    customfields = [
+        {"shortname": shortname, "name": name, "value": value}
+        for shortname, name, value in (row[len(USER_COLUMNS):] for row in rows)
+        if shortname is not None
+    ]
+    fullname = " ".join(part for part in (first['firstname'], first['lastname']) if part)
+    return MoodleUser(
+        id=first['id'],
+        username=first['username'],
+        fullname=fullname or None,
+        email=first['email'] or None,
+        city=first['city'] or None,
+        country=first['country'] or None,
+        description=first['description'] or None,
+        timemodified=first['timemodified'],
+        customfields=customfields,
+    )
+
+
+def iter_db_users(modified_since=None, config=None):
+    """
+    Genera los usuarios de Moodle leídos de la base de datos, en orden de ID.
+
+    Si se indica modified_since (timestamp), solo devuelve los usuarios
+    modificados desde ese momento.
+    """
+    config = config or get_db_config()
+    fetch_size = config.get('fetch_size', 2000)
+    conn, placeholder = connect(config)
+    try:
+        sql, params = build_users_query(config.get('prefix', 'mdl_'), placeholder, modified_since)
+        if config.get('engine', 'postgres') == 'postgres':
+            # Cursor con nombre: las filas se traen del servidor de a fetch_size
+            cursor = conn.cursor(name="sync_moodle_users")
+            cursor.itersize = fetch_size
+        else:
+            cursor = conn.cursor()
+            cursor.arraysize = fetch_size
+        cursor.execute(sql, params)
+        for _, rows in itertools.groupby(cursor, key=lambda row: row[0]):
+            yield rows_to_moodle_user(list(rows))
+        cursor.close()
+    finally:
+        conn.close()
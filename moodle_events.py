@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Receptor local de eventos de usuario de Moodle.
+
+Acepta por HTTP (POST /events) los eventos user_created, user_updated y
+user_deleted enviados por un webhook o plugin de reenvío de eventos de Moodle.
+Los eventos se agrupan por usuario con un debounce: varias modificaciones
+seguidas del mismo usuario generan una única sincronización.
+
+Formato aceptado (un objeto o una lista de objetos JSON):
+
+    {"eventname": "\\core\\event\\user_updated", "relateduserid": 123}
+    {"event": "user_updated", "userid": 123}
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SUPPORTED_EVENTS = ("user_created", "user_updated", "user_deleted")
+
+
+def parse_user_event(payload):
+    """
+    Extrae (tipo_evento, user_id) de un evento de Moodle.
+
+    Devuelve None si el evento no es de usuario o no trae un ID válido.
+    """
+    if not isinstance(payload, dict):
+        return None
+    eventname = payload.get("eventname") or payload.get("event") or ""
+    # "\core\event\user_updated" -> "user_updated"
+    event_type = eventname.replace("/", "\\").rsplit("\\", 1)[-1]
+    if event_type not in SUPPORTED_EVENTS:
+        return None
+    for key in ("relateduserid", "objectid", "userid"):
+        try:
+            user_id = int(payload.get(key))
+        except (TypeError, ValueError):
+            continue
+        if user_id > 0:
+            return event_type, user_id
+    return None
+
+
+class UserEventQueue:
+    """
+    Cola de eventos de usuario con debounce por usuario.
+
+    Cada evento nuevo de un usuario reemplaza al anterior y reinicia su
+    temporizador; el usuario queda listo para sincronizar cuando pasan
+    `debounce` segundos sin eventos nuevos.
+    """
+
+    def __init__(self, debounce=5):
+        self.debounce = debounce
+        self._pending = {}  # user_id -> (event_type, momento en que vence)
+        self._condition = threading.Condition()
+
+    def put(self, event_type, user_id):
+        with self._condition:
+            self._pending[user_id] = (event_type, time.monotonic() + self.debounce)
+            self._condition.notify()
+
+    def pop_due(self, timeout=1.0):
+        """Espera hasta `timeout` segundos y devuelve [(event_type, user_id)] ya vencidos"""
+        with self._condition:
+            now = time.monotonic()
+            if not any(due <= now for _, due in self._pending.values()):
+                next_due = min((due for _, due in self._pending.values()), default=now + timeout)
+                self._condition.wait(max(0.0, min(timeout, next_due - now)))
+                now = time.monotonic()
+            due_events = [(event_type, user_id) for user_id, (event_type, due) in self._pending.items() if due <= now]
+            for _, user_id in due_events:
+                del self._pending[user_id]
+            return due_events
+
+    def __len__(self):
+        with self._condition:
+            return len(self._pending)
+
+
+class EventRequestHandler(BaseHTTPRequestHandler):
+    """POST /events encola eventos; GET /status devuelve la profundidad de la cola"""
+
+    def _send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/status':
+            self.send_error(404)
+            return
+        self._send_json(200, {'queue_depth': len(self.server.event_queue), **self.server.event_stats})
+
+    def do_POST(self):
+        if self.path.split('?', 1)[0].rstrip('/') != '/events':
+            self.send_error(404)
+            return
+        secret = self.server.secret
+        if secret and self.headers.get("X-Sync-Token") != secret:
+            self._send_json(403, {'error': 'token inválido'})
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            payload = json.loads(self.rfile.read(length) or b"null")
+        except (ValueError, json.JSONDecodeError):
+            self._send_json(400, {'error': 'JSON inválido'})
+            return
+
+        events = payload if isinstance(payload, list) else [payload]
+        queued = 0
+        for event in events:
+            parsed = parse_user_event(event)
+            if parsed:
+                self.server.event_queue.put(*parsed)
+                queued += 1
+        self.server.event_stats['received'] += len(events)
+        self.server.event_stats['queued'] += queued
+        self._send_json(202, {'queued': queued, 'ignored': len(events) - queued})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_event_server(event_queue, port, secret=None, host="127.0.0.1"):
+    """Inicia el receptor de eventos en un hilo en segundo plano"""
+    server = ThreadingHTTPServer((host, port), EventRequestHandler)
+    server.event_queue = event_queue
+    server.secret = secret
+    server.event_stats = {'received': 0, 'queued': 0}
+    thread = threading.Thread(target=server.serve_forever, name="event-server", daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Lectura de exportaciones de usuarios de Moodle como fuente de la sincronización.
+
+Acepta el CSV de la descarga masiva de usuarios de Moodle (Administración del
+sitio > Usuarios > Acciones masivas > Descargar) o un archivo NDJSON con un
+usuario JSON por línea, opcionalmente comprimidos con gzip (.gz).
+
+El archivo se lee fila a fila: nunca se carga completo en memoria y cada fila
+se convierte a un MoodleUser compacto, con los mismos campos que devuelve
+core_user_get_users.
+"""
+
+import csv
+import gzip
+import io
+import json
+
+from user_records import MoodleUser
+
+# Prefijo de las columnas de campos de perfil personalizados en la descarga de Moodle
+CUSTOM_FIELD_PREFIX = "profile_field_"
+
+
+def detect_format(filename):
+    """Devuelve 'csv' o 'ndjson' según la extensión del archivo (ignorando .gz)"""
+    name = filename.lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    if name.endswith(('.ndjson', '.jsonl', '.json')):
+        return 'ndjson'
+    if name.endswith('.csv'):
+        return 'csv'
+    raise ValueError(f"Formato de exportación no reconocido: {filename} (usar .csv, .ndjson o .jsonl)")
+
+
+def open_export(filename):
+    """Abre el archivo en modo texto, descomprimiendo al vuelo si es .gz"""
+    if filename.lower().endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(filename, 'rb'), encoding='utf-8-sig', newline='')
+    return open(filename, 'r', encoding='utf-8-sig', newline='')
+
+
+def row_to_moodle_user(row):
+    """
+    Convierte una fila exportada en un MoodleUser.
+
+    La descarga de Moodle trae firstname/lastname en lugar de fullname y los
+    campos de perfil personalizados como columnas profile_field_<shortname>
+    (en NDJSON también se acepta la lista customfields del web service); las
+    filas sin username y las de usuarios suspendidos o eliminados se descartan (None).
+    """
+    customfields = row.get('customfields') or [
+        {"shortname": key.strip()[len(CUSTOM_FIELD_PREFIX):], "value": value}
+        for key, value in row.items()
+        if key and key.strip().lower().startswith(CUSTOM_FIELD_PREFIX) and value not in (None, '')
+    ]
+    row = {key.strip().lower(): value for key, value in row.items() if key}
+    if not row.get('username'):
+        return None
+    if str(row.get('suspended') or '0') not in ('0', 'false', 'False') or \
+            str(row.get('deleted') or '0') not in ('0', 'false', 'False'):
+        return None
+
+    fullname = row.get('fullname') or " ".join(
+        part for part in (row.get('firstname'), row.get('lastname')) if part)
+    try:
+        user_id = int(row.get('id')) if row.get('id') not in (None, '') else None
+        timemodified = int(row.get('timemodified')) if row.get('timemodified') not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+    return MoodleUser(
+        id=user_id,
+        username=row.get('username'),
+        fullname=fullname or None,
+        email=row.get('email') or None,
+        city=row.get('city') or None,
+        country=row.get('country') or None,
+        description=row.get('description') or None,
+        timemodified=timemodified,
+        customfields=customfields or None,
+    )
+
+
+def iter_export_rows(filename):
+    """Genera las filas del archivo como diccionarios, sin leerlo completo"""
+    export_format = detect_format(filename)
+    with open_export(filename) as f:
+        if export_format == 'csv':
+            yield from csv.DictReader(f)
+            return
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"[WARNING] Línea {line_number} de {filename} ignorada: JSON inválido ({e})")
+
+
+def iter_export_users(filename):
+    """Genera los MoodleUser válidos de una exportación, en el orden del archivo"""
+    for row in iter_export_rows(filename):
+        user = row_to_moodle_user(row)
+        if user is not None:
+            yield user
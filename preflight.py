@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Análisis previo (pre-flight) de un lote de usuarios de Moodle, antes de escribir en Discourse.
+
+Hasta ahora los conflictos aparecían de a uno durante la sincronización: un
+email que ya usa otro usuario de Discourse se descubría al intentar crear la
+cuenta. analyze_batch() recorre el lote completo una sola vez contra el índice
+de usuarios de Discourse (y el mapa de IDs) y decide la ruta de cada usuario
+antes de cualquier petición de escritura:
+
+- create: no existe en Discourse, se crea;
+- update: ya existe (por mapa de IDs o por username normalizado);
+- merge:  su email pertenece a otro usuario de Discourse, se actualiza ese usuario;
+- skip:   excluido, email repetido dentro del lote o username normalizado
+          que ya usa otro usuario del lote.
+
+Los conflictos encontrados se pueden guardar en un reporte CSV.
+"""
+
+import csv
+from collections import Counter
+
+ROUTES = ("create", "update", "merge", "skip")
+
+REPORT_FIELDNAMES = [
+    'moodle_id', 'moodle_username', 'normalized_username', 'email',
+    'route', 'target_username', 'conflict', 'detail'
+]
+
+
+def plan_key(moodle_user):
+    """Clave de un usuario de Moodle en el plan (ID, o username si no tiene ID)"""
+    moodle_id = moodle_user.get("id")
+    return moodle_id if moodle_id is not None else moodle_user.get("username")
+
+
+class PreflightPlan:
+    """Ruta decidida para cada usuario del lote y conflictos encontrados"""
+
+    def __init__(self):
+        self.routes = {}     # plan_key -> (ruta, username de destino en Discourse, conflicto)
+        self.conflicts = []  # filas del reporte (una por conflicto)
+        self.counts = Counter()
+
+    def add(self, moodle_user, normalized_username, route, target_username=None, conflict=None, detail=None):
+        self.routes[plan_key(moodle_user)] = (route, target_username, conflict)
+        self.counts[route] += 1
+        if conflict:
+            self.conflicts.append({
+                'moodle_id': moodle_user.get("id"),
+                'moodle_username': moodle_user.get("username"),
+                'normalized_username': normalized_username,
+                'email': moodle_user.get("email"),
+                'route': route,
+                'target_username': target_username,
+                'conflict': conflict,
+                'detail': detail,
+            })
+
+    def route_for(self, moodle_user):
+        """(ruta, username de destino, conflicto) de un usuario; None si no está en el plan"""
+        return self.routes.get(plan_key(moodle_user))
+
+    def conflict_counts(self):
+        return Counter(row['conflict'] for row in self.conflicts)
+
+    def write_report(self, filename):
+        """Guarda los conflictos en un CSV"""
+        with open(filename, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDNAMES)
+            writer.writeheader()
+            writer.writerows(self.conflicts)
+
+    def __len__(self):
+        return len(self.routes)
+
+
+def analyze_batch(moodle_users, excluded_users, discourse_index, normalize, id_map=None):
+    """
+    Decide la ruta de cada usuario del lote sin hacer peticiones.
+
+    Args:
+        moodle_users: usuarios de Moodle del lote (MoodleUser o dicts)
+        excluded_users: usernames excluidos, en minúsculas
+        discourse_index: DiscourseUserIndex ya cargado
+        normalize: función que convierte un username de Moodle al de Discourse
+        id_map: IdMap opcional (usuarios ya sincronizados)
+
+    Returns:
+        PreflightPlan
+    """
+    plan = PreflightPlan()
+    # Primer usuario del lote que reclama cada email y cada username normalizado
+    email_owner = {}
+    username_owner = {}
+
+    for mu in moodle_users:
+        original_username = mu.get("username") or ""
+        normalized_username = normalize(original_username)
+        email = (mu.get("email") or "").strip().lower()
+        moodle_id = mu.get("id")
+
+        if original_username.lower() in excluded_users:
+            plan.add(mu, normalized_username, "skip", conflict="EXCLUDED", detail="Usuario en lista de excluidos")
+            continue
+
+        mapped = id_map.lookup(moodle_id) if id_map is not None and moodle_id is not None else None
+        target_username = mapped['username'] if mapped else normalized_username
+
+        if email:
+            first = email_owner.setdefault(email, original_username)
+            if first != original_username:
+                plan.add(mu, normalized_username, "skip", conflict="DUPLICATE_EMAIL_MOODLE",
+                         detail=f"El email también lo usa {first} en Moodle")
+                continue
+
+        # Dos usuarios de Moodle distintos que terminan en el mismo username de Discourse
+        claimed_by = username_owner.setdefault(target_username, original_username)
+        if claimed_by != original_username and not mapped:
+            plan.add(mu, normalized_username, "skip", conflict="USERNAME_COLLISION",
+                     detail=f"{claimed_by} también se normaliza a {target_username}")
+            continue
+
+        existing = discourse_index.by_username(target_username)
+        email_user = discourse_index.by_email(email) if email else None
+
+        if mapped or existing:
+            conflict = detail = None
+            if email_user and email_user.username != target_username:
+                conflict = "EMAIL_OWNED_BY_OTHER"
+                detail = f"{target_username} existe, pero el email pertenece a {email_user.username}"
+            elif existing and existing.email and email and existing.email.lower() != email:
+                conflict = "USERNAME_EMAIL_MISMATCH"
+                detail = f"{target_username} existe en Discourse con otro email ({existing.email})"
+            plan.add(mu, normalized_username, "update", target_username, conflict, detail)
+        elif email_user:
+            plan.add(mu, normalized_username, "merge", email_user.username, "EMAIL_OWNED_BY_OTHER",
+                     f"El email pertenece a {email_user.username} en Discourse")
+        else:
+            plan.add(mu, normalized_username, "create", normalized_username)
+
+    return plan
@@ -0,0 +1,46 @@
+-- [params]
+-- boolean :only_active = true
+
+-- Usuarios de Discourse agrupados por ubicación, calculado en el servidor.
+--
+-- Consulta para el plugin Data Explorer que usa
+-- discourse_users_by_country.py --data-explorer. Aquí solo se agrupa por la
+-- última parte de `location` separada por comas ("Sin ubicación" si está
+-- vacía); no es el país definitivo: el script vuelve a calcular el país de
+-- cada usuario con resolve_country() (alias, nombres en español, "Ciudad País"
+-- sin coma...), como extract_country_from_location(). Devuelve una fila por
+-- grupo con la cantidad de usuarios y la lista de usuarios en JSON.
+
+WITH located AS (
+    SELECT
+        u.username,
+        u.name,
+        e.email,
+        COALESCE(p.location, '') AS location,
+        u.active,
+        CASE
+            WHEN TRIM(COALESCE(p.location, '')) = '' THEN 'Sin ubicación'
+            ELSE TRIM(REGEXP_REPLACE(p.location, '^.*,', ''))
+        END AS country
+    FROM users u
+    LEFT JOIN user_profiles p ON p.user_id = u.id
+    LEFT JOIN user_emails e ON e.user_id = u.id AND e."primary"
+    WHERE u.id > 0
+      AND NOT u.staged
+      AND (u.active OR NOT :only_active)
+)
+SELECT
+    country,
+    COUNT(*) AS user_count,
+    JSON_AGG(
+        JSON_BUILD_OBJECT(
+            'username', username,
+            'name', name,
+            'email', email,
+            'location', location,
+            'active', active
+        ) ORDER BY username
+    ) AS users
+FROM located
+GROUP BY country
+ORDER BY user_count DESC, country
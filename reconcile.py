@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Detección de usuarios huérfanos: cuentas de Discourse cuyo usuario de Moodle
+fue eliminado o suspendido.
+
+La sincronización solo recorre usuarios de Moodle, así que las bajas nunca
+llegaban a Discourse. find_orphans() compara el conjunto completo de usuarios
+vivos de Moodle con los de Discourse en una pasada lineal:
+
+- scope 'mapped' (por defecto): recorre el mapa de IDs y devuelve los usuarios
+  de Discourse vinculados a un ID de Moodle que ya no está vivo. Solo afecta a
+  cuentas que la sincronización creó o vinculó.
+- scope 'all': además recorre (ordenados por username, en un merge con los
+  usernames vivos de Moodle) todos los usuarios del índice de Discourse y
+  devuelve los que no tienen contraparte. Incluye a quienes se registraron
+  directamente en Discourse, por eso hay que usarlo con cuidado.
+
+Los usuarios del sistema (ID <= 0) y los de excluded_users nunca son huérfanos.
+"""
+
+ORPHAN_SCOPES = ("mapped", "all")
+
+
+def _orphan(discourse_user_id, username, email, moodle_id, reason):
+    return {
+        'discourse_id': discourse_user_id,
+        'username': username,
+        'email': email,
+        'moodle_id': moodle_id,
+        'reason': reason,
+    }
+
+
+def collect_live_moodle_users(moodle_users, normalize, id_map=None):
+    """
+    Recorre una vez los usuarios vivos de Moodle y devuelve (IDs vivos,
+    usernames de Discourse que les corresponden), sin guardar los registros.
+    """
+    live_ids = set()
+    claimed_usernames = set()
+    for mu in moodle_users:
+        moodle_id = mu.get("id")
+        if moodle_id is not None:
+            live_ids.add(str(moodle_id))
+            mapped = id_map.lookup(moodle_id) if id_map is not None else None
+            if mapped:
+                claimed_usernames.add(mapped['username'])
+        if mu.get("username"):
+            claimed_usernames.add(normalize(mu.get("username")))
+    return live_ids, claimed_usernames
+
+
+def find_orphans(moodle_users, discourse_users, normalize, id_map=None, excluded_users=(), scope="mapped"):
+    """
+    Devuelve la lista de usuarios de Discourse sin usuario vivo en Moodle.
+
+    Args:
+        moodle_users: todos los usuarios vivos de Moodle (iterable, se recorre una vez)
+        discourse_users: todos los usuarios de Discourse (DiscourseUser), para scope 'all'
+        normalize: función que convierte un username de Moodle al de Discourse
+        id_map: IdMap con los usuarios ya sincronizados
+        excluded_users: usernames que nunca se consideran huérfanos (en minúsculas)
+        scope: 'mapped' o 'all'
+
+    Returns:
+        list: dicts con discourse_id, username, email, moodle_id y reason
+    """
+    if scope not in ORPHAN_SCOPES:
+        raise ValueError(f"Alcance de huérfanos no soportado: {scope} (usar 'mapped' o 'all')")
+    live_ids, claimed_usernames = collect_live_moodle_users(moodle_users, normalize, id_map)
+    if not live_ids and not claimed_usernames:
+        raise RuntimeError("No se obtuvo ningún usuario vivo de Moodle: no se buscan huérfanos")
+
+    orphans = []
+    orphan_ids = set()
+
+    def protected(discourse_user_id, username):
+        return (discourse_user_id is not None and discourse_user_id <= 0) or \
+            (username or "").lower() in excluded_users
+
+    if id_map is not None:
+        for moodle_id, entry in id_map.entries():
+            if moodle_id in live_ids or protected(entry['discourse_id'], entry['username']):
+                continue
+            if entry['username'] in claimed_usernames:
+                # Otro usuario vivo de Moodle (ej: recreado con otro ID) usa esa cuenta
+                continue
+            orphans.append(_orphan(entry['discourse_id'], entry['username'], None, moodle_id, "MOODLE_USER_GONE"))
+            orphan_ids.add(entry['discourse_id'])
+
+    if scope == "all":
+        mapped_ids = id_map.discourse_ids() if id_map is not None else set()
+        # Merge de dos secuencias ordenadas por username
+        discourse_sorted = sorted((user for user in discourse_users if user.username), key=lambda user: user.username)
+        claimed_sorted = sorted(claimed_usernames)
+        i = 0
+        for user in discourse_sorted:
+            while i < len(claimed_sorted) and claimed_sorted[i] < user.username:
+                i += 1
+            if i < len(claimed_sorted) and claimed_sorted[i] == user.username:
+                continue
+            if user.id in orphan_ids or user.id in mapped_ids or protected(user.id, user.username):
+                # Los vinculados en el mapa ya se evaluaron por su ID de Moodle
+                continue
+            orphans.append(_orphan(user.id, user.username, user.email, None, "NO_MOODLE_USER"))
+    return orphans
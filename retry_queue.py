@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Cola persistente de reintentos para operaciones fallidas contra Discourse.
+
+Las operaciones que fallan por errores transitorios (timeouts, errores de
+conexión, 5xx o 429) se guardan en un archivo JSON con backoff exponencial y
+jitter por operación. Cada ejecución reintenta primero las operaciones
+vencidas; las que agotan sus intentos, o vuelven a fallar con un error
+permanente, pasan a un archivo dead-letter (JSONL) desde donde pueden
+relanzarse con --retry-failed.
+
+Los cambios se mantienen en memoria y la cola se escribe a disco cada
+RETRY_SAVE_EVERY cambios o al llamar a flush(), como en StateStore.
+"""
+
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import requests
+
+import settings
+
+def is_transient_error(status_code=None, exception=None):
+    """Indica si un fallo es transitorio (timeout, conexión, 5xx o 429) y vale la pena reintentarlo"""
+    if exception is not None:
+        return isinstance(exception, (requests.Timeout, requests.ConnectionError))
+    return status_code == 429 or (status_code is not None and status_code >= 500)
+
+
+def operation_key(operation, args):
+    """Clave estable de una operación (misma operación y argumentos -> misma clave)"""
+    raw = json.dumps([operation, args], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+
+
+class RetryQueue:
+    """Cola de reintentos persistida en JSON con archivo dead-letter"""
+
+    def __init__(self, filename=None, dead_letter_filename=None, max_attempts=None,
+                 base_delay=None, max_delay=None):
+        env = getattr(settings, 'ENV', 'unknown')
+        self.filename = filename or f"sync_retry_queue_{env}.json"
+        self.dead_letter_filename = dead_letter_filename or f"sync_dead_letter_{env}.jsonl"
+        self.max_attempts = max_attempts or getattr(settings, 'RETRY_MAX_ATTEMPTS', 5)
+        self.base_delay = base_delay or getattr(settings, 'RETRY_BASE_DELAY', 60)
+        self.max_delay = max_delay or getattr(settings, 'RETRY_MAX_DELAY', 6 * 3600)
+        self.save_every = max(1, getattr(settings, 'RETRY_SAVE_EVERY', 50))
+        self._lock = threading.RLock()
+        self._unsaved = 0
+        self._entries = {}
+        self._in_flight = {}
+        self._local = threading.local()
+        # Reintentos programados por record_failure en esta ejecución
+        self.scheduled_count = 0
+        self.load()
+
+    def load(self):
+        with self._lock:
+            self._entries = {}
+            if not os.path.exists(self.filename):
+                return
+            try:
+                with open(self.filename, 'r', encoding='utf-8') as f:
+                    for entry in json.load(f):
+                        self._entries[entry['key']] = entry
+            except Exception as e:
+                print(f"[WARNING] Error leyendo cola de reintentos {self.filename}: {e}")
+
+    def save(self):
+        with self._lock:
+            tmp_filename = f"{self.filename}.tmp"
+            with open(tmp_filename, 'w', encoding='utf-8') as f:
+                json.dump(list(self._entries.values()), f, ensure_ascii=False, indent=1)
+            os.replace(tmp_filename, self.filename)
+            self._unsaved = 0
+
+    def flush(self):
+        """Escribe la cola a disco si tiene cambios sin guardar"""
+        with self._lock:
+            if self._unsaved:
+                self.save()
+
+    def _changed(self):
+        """Cuenta un cambio y escribe la cola cada save_every cambios"""
+        self._unsaved += 1
+        if self._unsaved >= self.save_every:
+            self.save()
+
+    def backoff_delay(self, attempts):
+        """Backoff exponencial con jitter: entre la mitad y el total del retardo calculado"""
+        delay = min(self.max_delay, self.base_delay * (2 ** max(0, attempts - 1)))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def record_failure(self, operation, args, error):
+        """
+        Registra el fallo de una operación.
+
+        Si la operación ya estaba en la cola (o se está reintentando) incrementa
+        sus intentos; al superar max_attempts la mueve al archivo dead-letter.
+        Dentro de replaying() cualquier fallo se registra sobre la entrada que se
+        está reintentando, en lugar de encolar una operación nueva.
+        Devuelve True si quedó programado un reintento.
+        """
+        replaying = getattr(self._local, 'entry', None)
+        if replaying is not None:
+            operation, args = replaying['operation'], replaying['args']
+        key = operation_key(operation, args)
+        now = time.time()
+        with self._lock:
+            in_flight = self._in_flight.get(key)
+            if in_flight is not None:
+                if in_flight.get('failed'):
+                    # Ya se registró el fallo de este reintento (ej: la misma operación
+                    # repetida dentro de un sync_user); no contarlo dos veces
+                    return key in self._entries
+                in_flight['failed'] = True
+            previous = self._entries.get(key) or in_flight
+            attempts = (previous['attempts'] if previous else 0) + 1
+            entry = {
+                'key': key,
+                'operation': operation,
+                'args': args,
+                'attempts': attempts,
+                'first_failed_at': previous['first_failed_at'] if previous else datetime.now().isoformat(timespec='seconds'),
+                'last_error': str(error)[:500],
+                'next_attempt_at': now + self.backoff_delay(attempts),
+            }
+            if attempts >= self.max_attempts:
+                self._entries.pop(key, None)
+                self._write_dead_letter(entry)
+                self._changed()
+                return False
+            self._entries[key] = entry
+            self.scheduled_count += 1
+            self._changed()
+            return True
+
+    def record_permanent_failure(self, operation, args, error):
+        """
+        Registra un fallo que no vale la pena reintentar (4xx, validación): la
+        operación pasa directamente al archivo dead-letter. Dentro de replaying()
+        se aplica a la entrada que se está reintentando; fuera de un reintento
+        la operación nunca estuvo en la cola y no se registra.
+        """
+        replaying = getattr(self._local, 'entry', None)
+        if replaying is None:
+            return
+        key = replaying['key']
+        with self._lock:
+            in_flight = self._in_flight.get(key)
+            if in_flight is None or in_flight.get('failed'):
+                return
+            in_flight['failed'] = True
+            self._entries.pop(key, None)
+            self._write_dead_letter(dict(in_flight, attempts=in_flight['attempts'] + 1,
+                                         last_error=str(error)[:500]))
+            self._changed()
+
+    @contextmanager
+    def replaying(self, entry):
+        """Mientras dura, los fallos del hilo actual cuentan como fallos de `entry`"""
+        self._local.entry = entry
+        try:
+            yield
+        finally:
+            self._local.entry = None
+
+    def defer(self, operation, args, reason, save=True):
+        """
+        Encola una operación que no llegó a intentarse (circuito abierto, deadline
+        de la ejecución) para la próxima ejecución, sin contarla como intento fallido.
+        """
+        key = operation_key(operation, args)
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = {
+                    'key': key,
+                    'operation': operation,
+                    'args': args,
+                    'attempts': 0,
+                    'first_failed_at': datetime.now().isoformat(timespec='seconds'),
+                    'last_error': reason,
+                    'next_attempt_at': time.time(),
+                }
+            if save:
+                self.save()
+            else:
+                self._unsaved += 1
+
+    def _write_dead_letter(self, entry):
+        entry = dict(entry, dead_lettered_at=datetime.now().isoformat(timespec='seconds'))
+        with open(self.dead_letter_filename, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def pop_due(self, now=None):
+        """Quita de la cola y devuelve las operaciones cuyo reintento ya venció"""
+        now = now or time.time()
+        with self._lock:
+            due = [entry for entry in self._entries.values() if entry['next_attempt_at'] <= now]
+            due.sort(key=lambda entry: entry['next_attempt_at'])
+            for entry in due:
+                del self._entries[entry['key']]
+                self._in_flight[entry['key']] = entry
+            return due
+
+    def due_count(self, now=None):
+        """Cantidad de operaciones cuyo reintento ya venció"""
+        now = now or time.time()
+        with self._lock:
+            return sum(1 for entry in self._entries.values() if entry['next_attempt_at'] <= now)
+
+    def finish(self, entry):
+        """
+        Termina el reintento de una operación obtenida con pop_due.
+
+        Devuelve 'DONE' si no volvió a fallar de forma transitoria, 'RETRY_QUEUED'
+        si quedó programado otro reintento o 'DEAD_LETTER' si agotó sus intentos.
+        """
+        with self._lock:
+            in_flight = self._in_flight.pop(entry['key'], entry)
+            self._changed()
+            if entry['key'] in self._entries:
+                return 'RETRY_QUEUED'
+            if in_flight.get('failed'):
+                return 'DEAD_LETTER'
+            return 'DONE'
+
+    def requeue_dead_letters(self):
+        """
+        Devuelve a la cola, con los intentos reiniciados, todas las operaciones del
+        archivo dead-letter y vacía ese archivo. Devuelve la cantidad reencolada.
+        """
+        if not os.path.exists(self.dead_letter_filename):
+            return 0
+        count = 0
+        with self._lock:
+            with open(self.dead_letter_filename, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    entry = json.loads(line)
+                    entry.pop('dead_lettered_at', None)
+                    entry['attempts'] = 0
+                    entry['next_attempt_at'] = 0
+                    self._entries[entry['key']] = entry
+                    count += 1
+            open(self.dead_letter_filename, 'w', encoding='utf-8').close()
+            self.save()
+        return count
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
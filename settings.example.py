@@ -10,6 +10,116 @@ MOODLE_TOKEN = "MOODLE TOKEN"
 DISCOURSE_URL = "DISCOURE URL"
 DISCOURSE_API_KEY = "API KEY"
 DISCOURSE_API_USER = "user"  # Usuario admin que genera la API key
+DISCOURSE_SSO_ENABLED = False  # True si Discourse usa DiscourseConnect con el ID de Moodle como external_id
+
+# Usuarios que nunca se crean ni actualizan (un username por línea). Sin definir se usa
+# excluded_users.txt del directorio actual, creado con una lista por defecto si falta
+# EXCLUDED_USERS_FILE = "/etc/moodle-discourse/excluded_users.txt"
 
 # Configuración de procesamiento por lotes
-BATCH_SIZE = 10  # Número de usuarios a procesar en cada ejecución (por defecto: 10)
\ No newline at end of file
+BATCH_SIZE = 10  # Número de usuarios a procesar en cada ejecución (por defecto: 10)
+MOODLE_BY_FIELD_CHUNK_SIZE = 100  # Valores por llamada a core_user_get_users_by_field (--users-file, eventos)
+MOODLE_FETCH_CONCURRENCY = 4  # Llamadas simultáneas a Moodle al pedir usuarios por bloques o cursos
+MOODLE_ENROL_PAGE_SIZE = 200  # Usuarios por página de core_enrol_get_enrolled_users (--courses)
+
+# Lectura directa de la base de datos de Moodle (--from-db), usar una réplica de solo lectura
+MOODLE_DB = None
+# MOODLE_DB = {
+#     'engine': 'postgres',  # 'postgres' (requiere psycopg2) o 'sqlite'
+#     'dsn': 'host=replica.example.org dbname=moodle user=readonly password=...',
+#     # 'path': 'moodle_fixture.db',  # con engine 'sqlite'
+#     'prefix': 'mdl_',  # Prefijo de las tablas de Moodle
+#     'fetch_size': 2000,  # Filas por viaje al servidor
+# }
+
+# Mapeo de campos Moodle -> Discourse (ver field_map.py)
+# policy: 'if_empty' (solo completa campos vacíos en Discourse), 'always' (sobrescribe) o 'never'
+# source admite campos de perfil personalizados ('profile_field_<shortname>') y target
+# campos de usuario personalizados de Discourse ('user_fields.<id>')
+FIELD_MAP = [
+    {'source': 'fullname', 'target': 'name'},
+    {'source': ['city', 'country'], 'target': 'location', 'transform': 'location'},
+    {'source': 'description', 'target': 'bio_raw'},
+    {'source': 'email', 'target': 'email'},
+    # {'source': 'profile_field_dni', 'target': 'user_fields.1', 'policy': 'always'},
+]
+
+# Modo daemon (--daemon)
+DAEMON_INTERVAL = 900  # Segundos entre sincronizaciones incrementales
+DAEMON_STATUS_PORT = 8765  # Puerto local del endpoint de estado (0 para desactivarlo)
+
+# Receptor de eventos de Moodle (--listen-events)
+EVENTS_PORT = 8770  # Puerto local donde se reciben los eventos
+EVENTS_DEBOUNCE = 5  # Segundos sin eventos nuevos antes de sincronizar un usuario
+EVENTS_SECRET = None  # Si se define, los eventos deben incluir la cabecera X-Sync-Token
+
+# Cola de reintentos (errores transitorios: timeouts, 5xx, 429)
+RETRY_MAX_ATTEMPTS = 5  # Intentos antes de mover la operación al archivo dead-letter
+RETRY_BASE_DELAY = 60  # Segundos del primer reintento (se duplica en cada intento, con jitter)
+RETRY_MAX_DELAY = 21600  # Tope del retardo entre reintentos (6 horas)
+RETRY_SAVE_EVERY = 50  # Cambios en la cola de reintentos entre escrituras a disco (y al terminar cada etapa)
+
+# Timeouts y circuit breaker
+HTTP_TIMEOUTS = {
+    'moodle': (5, 120),  # (conexión, lectura) en segundos
+    'discourse': (5, 30),
+}
+CIRCUIT_FAILURE_THRESHOLD = 5  # Fallos consecutivos que abren el circuito
+CIRCUIT_RECOVERY_TIMEOUT = 60  # Segundos de pausa antes de probar la recuperación
+CIRCUIT_MAX_PAUSES = 3  # Pausas antes de encolar a los usuarios restantes
+RUN_DEADLINE = None  # Tiempo máximo de una ejecución en segundos (None = sin límite)
+RATE_LIMITS = {}  # Peticiones por segundo por servicio, ej: {'discourse': 8} o {'discourse': (8, 20)} con ráfaga
+
+# Varias API keys de Discourse: las peticiones se reparten entre ellas (vacío = solo DISCOURSE_API_KEY)
+DISCOURSE_API_KEYS = [
+    # ("api-key-1", "admin"),
+    # {'key': "api-key-2", 'username': "sync_bot", 'rate': 2, 'burst': 20},
+]
+API_KEY_RATE = (1.0, 10)  # Presupuesto por key por defecto: (peticiones por segundo, ráfaga); reemplaza a RATE_LIMITS['discourse']
+API_KEY_THROTTLE_DEFAULT = 10  # Pausa (segundos) de una key tras un 429 sin wait_seconds/Retry-After
+
+# Hedging de lecturas idempotentes (--hedge)
+HEDGE_ENABLED = False  # Activar sin necesidad de --hedge
+HEDGE_PERCENTILE = 95  # Si no hay respuesta en este percentil de latencia, enviar un duplicado
+HEDGE_MIN_SAMPLES = 20  # Muestras necesarias antes de usar el percentil
+HEDGE_DEFAULT_DELAY = 1.0  # Espera (segundos) antes de tener suficientes muestras
+
+# Caché de consultas a Discourse
+LOOKUP_NEGATIVE_TTL = 300  # Segundos durante los que se recuerda un 404 (usuario inexistente)
+DISCOURSE_INDEX_TTL = 900  # Segundos de validez del listado completo de usuarios (username/email)
+DISCOURSE_SNAPSHOT_STRATEGY = 'list'  # 'list' (/admin/users/list) o 'csv_export' (exportación CSV, foros grandes)
+DISCOURSE_EXPORT_TIMEOUT = 600  # Segundos máximos de espera de la exportación CSV
+DISCOURSE_EXPORT_POLL_INTERVAL = 10  # Segundos entre consultas mientras se genera la exportación
+
+# Usuarios huérfanos: cuentas de Discourse sin usuario vivo en Moodle (--reconcile)
+ORPHAN_ACTION = 'report'  # 'report' (solo log CSV), 'suspend' o 'deactivate'
+ORPHAN_SCOPE = 'mapped'  # 'mapped' (solo usuarios del mapa de IDs) o 'all' (todos los de Discourse)
+ORPHAN_BATCH_SIZE = 50  # Usuarios suspendidos/desactivados por lote (el estado se guarda tras cada lote)
+ORPHAN_MAX_FRACTION = 0.1  # Si los huérfanos superan esta fracción de Discourse no se aplica ninguna acción
+ORPHAN_SUSPEND_REASON = "Usuario dado de baja o suspendido en Moodle"
+
+# Avatares: foto de perfil de Moodle como avatar de Discourse (--avatars)
+AVATAR_SYNC = False  # Activar sin necesidad de --avatars
+AVATAR_CONCURRENCY = 2  # Descargas/subidas de imágenes en paralelo (etapa separada de los perfiles)
+AVATAR_MAX_BYTES = 5 * 1024 * 1024  # Las imágenes más grandes no se suben
+AVATAR_SAVE_EVERY = 50  # Avatares procesados entre guardados de sync_avatars_{ENV}.json
+
+# Snapshot local de usuarios de Discourse para los reportes (discourse_snapshot.py)
+SNAPSHOT_TTL = 3600  # Segundos antes de actualizar el snapshot de forma incremental
+SNAPSHOT_FULL_INTERVAL = 604800  # Segundos entre regeneraciones completas (refleja bajas)
+SNAPSHOT_CONCURRENCY = 8  # Perfiles pedidos en paralelo al actualizar el snapshot
+SNAPSHOT_FROM_SYNC = True  # La sincronización guarda el snapshot cuando usa la exportación CSV
+REPORT_CONCURRENCY = 8  # Perfiles pedidos en paralelo por discourse_users_by_country.py --live
+REPORT_FLUSH_EVERY = 500  # Con --stream, registros escritos entre cada volcado a disco
+DATA_EXPLORER_QUERY_ID = None  # ID de la consulta queries/users_by_country.sql en Data Explorer (--data-explorer)
+
+# Varios pares Moodle/Discourse en un solo proceso (sync_tenants.py)
+# Cada perfil: 'name', opcionalmente 'settings_module' (un settings.py existente)
+# y cualquier valor de esta configuración que cambie para ese tenant
+TENANTS = [
+    # {'name': 'campus-a', 'MOODLE_ENDPOINT': '...', 'MOODLE_TOKEN': '...',
+    #  'DISCOURSE_URL': '...', 'DISCOURSE_API_KEY': '...', 'RATE_LIMITS': {'discourse': 5}},
+    # {'name': 'campus-b', 'settings_module': 'settings_campus_b'},
+]
+TENANT_CONCURRENCY = 2  # Tenants sincronizados a la vez
+TENANT_SLICE = 300  # Segundos por turno cuando hay tenants esperando lugar
@@ -1,41 +1,91 @@
-import requests
 import argparse
 import settings  # importamos la config desde settings.py
+import http_client
+import requests
 import os
 import time
 import re
 import csv
+import json
+import zlib
+import itertools
+import signal
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from datetime import datetime
-from country_codes import get_country_name
+from user_records import MoodleUser, DiscourseUser
+from sync_state import StateStore, IdMap, default_orphans_filename
+from moodle_events import UserEventQueue, start_event_server
+from moodle_export import iter_export_users
+from moodle_db import iter_db_users
+from retry_queue import RetryQueue, is_transient_error
+from discourse_cache import DiscourseUserCache, DiscourseUserIndex, NOT_FOUND
+from discourse_export import iter_user_list_export
+from discourse_snapshot import UserSnapshot
+from preflight import analyze_batch
+from reconcile import find_orphans
+from field_map import get_field_map, build_profile_payload, is_field_empty
+from avatar_sync import AvatarStage
 from tqdm import tqdm
 
 
-def create_log_filename(dry_run=True):
+LOG_FIELDNAMES = [
+    'timestamp', 'original_username', 'normalized_username', 'fullname', 'email',
+    'action', 'status', 'message', 'location', 'country', 'description', 'activated'
+]
+
+ORPHAN_LOG_FIELDNAMES = [
+    'timestamp', 'discourse_id', 'discourse_username', 'email', 'moodle_id', 'reason', 'action', 'status'
+]
+
+# Cada cuántos usuarios se guarda el checkpoint de un shard
+CHECKPOINT_INTERVAL = 25
+
+# Cola de reintentos de la ejecución actual (None en dry-run: no hay escrituras que reintentar)
+retry_queue = None
+
+# Caché de consultas a Discourse compartido por toda la ejecución (hits y 404 confirmados)
+discourse_cache = DiscourseUserCache()
+
+# Índice de todos los usuarios de Discourse por username y email (se carga con load_discourse_index)
+discourse_index = DiscourseUserIndex()
+
+# Mapa persistente ID de Moodle -> usuario de Discourse (None hasta init_id_map)
+id_map = None
+
+# Sincronizar la foto de perfil de Moodle como avatar de Discourse (settings.AVATAR_SYNC o --avatars)
+avatar_sync_enabled = getattr(settings, 'AVATAR_SYNC', False)
+
+# True cuando los usuarios vienen de una exportación (--from-export): no se consulta el web service de Moodle
+offline_source = False
+
+
+def shard_suffix(shard):
+    """Devuelve el sufijo de archivo para un shard (K, N), o cadena vacía si no hay shard"""
+    if not shard:
+        return ""
+    return f"_shard{shard[0]}of{shard[1]}"
+
+def create_log_filename(dry_run=True, shard=None):
     """Crea un nombre de archivo único para el log basado en fecha y hora"""
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     mode = "dryrun" if dry_run else "apply"
     env = getattr(settings, 'ENV', 'unknown')
-    return f"sync_log_{env}_{mode}_{timestamp}.csv"
+    return f"sync_log_{env}_{mode}{shard_suffix(shard)}_{timestamp}.csv"
 
 def write_log_header(filename):
     """Escribe el encabezado del archivo CSV de log"""
     with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
-        fieldnames = [
-            'timestamp', 'original_username', 'normalized_username', 'fullname', 'email',
-            'action', 'status', 'message', 'location', 'country', 'description', 'activated'
-        ]
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer = csv.DictWriter(csvfile, fieldnames=LOG_FIELDNAMES)
         writer.writeheader()
 
 def log_user_action(filename, original_username, normalized_username, fullname, email, 
                    action, status, message, location=None, country=None, description=None, activated=False):
     """Registra una acción de usuario en el archivo CSV de log"""
     with open(filename, 'a', newline='', encoding='utf-8') as csvfile:
-        fieldnames = [
-            'timestamp', 'original_username', 'normalized_username', 'fullname', 'email',
-            'action', 'status', 'message', 'location', 'country', 'description', 'activated'
-        ]
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer = csv.DictWriter(csvfile, fieldnames=LOG_FIELDNAMES)
         writer.writerow({
             'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
             'original_username': original_username,
@@ -51,42 +101,184 @@ def log_user_action(filename, original_username, normalized_username, fullname,
             'activated': 'YES' if activated else 'NO'
         })
 
+def create_preflight_report_filename(dry_run=True, shard=None):
+    """Nombre del reporte CSV de conflictos del análisis previo"""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    mode = "dryrun" if dry_run else "apply"
+    env = getattr(settings, 'ENV', 'unknown')
+    return f"sync_preflight_{env}_{mode}{shard_suffix(shard)}_{timestamp}.csv"
+
+def create_orphans_log_filename(dry_run=True):
+    """Nombre del log CSV de la reconciliación de usuarios huérfanos"""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    mode = "dryrun" if dry_run else "apply"
+    env = getattr(settings, 'ENV', 'unknown')
+    return f"sync_orphans_{env}_{mode}_{timestamp}.csv"
+
+def create_checkpoint_filename(dry_run=True, shard=None):
+    """Nombre del checkpoint de un shard (estable entre ejecuciones para poder reanudar)"""
+    mode = "dryrun" if dry_run else "apply"
+    env = getattr(settings, 'ENV', 'unknown')
+    return f"sync_checkpoint_{env}_{mode}{shard_suffix(shard)}.ndjson"
+
+def load_checkpoint(filename):
+    """
+    Carga los IDs de Moodle ya procesados de una ejecución anterior interrumpida.
+
+    El checkpoint es un NDJSON: una línea de cabecera y una línea por cada tanda
+    de IDs procesados. Si no existe o la ejecución anterior terminó completa,
+    devuelve un conjunto vacío y la nueva ejecución empieza desde cero.
+    """
+    if not os.path.exists(filename):
+        return set()
+    processed_ids = set()
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Última línea a medio escribir (ejecución cortada): se ignora
+                    continue
+                if record.get('completed'):
+                    return set()
+                processed_ids.update(record.get('ids', ()))
+    except Exception as e:
+        print(f"[WARNING] Error leyendo checkpoint {filename}: {e}")
+        return set()
+    return processed_ids
+
+def start_checkpoint(filename, shard):
+    """Empieza un checkpoint nuevo (descarta el de una ejecución ya completada)"""
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write(json.dumps({
+            'shard': f"{shard[0]}/{shard[1]}" if shard else None,
+            'started_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }) + "\n")
+
+def save_checkpoint(filename, new_ids, stats, completed=False):
+    """Agrega al checkpoint solo los IDs procesados desde el último guardado"""
+    record = {
+        'updated_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'ids': list(new_ids),
+        'stats': {key: value for key, value in stats.items() if not isinstance(value, dict)}
+    }
+    if completed:
+        record['completed'] = True
+    with open(filename, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def merge_shard_logs(log_filenames, output_filename=None):
+    """
+    Combina los logs CSV de varios shards en un único reporte ordenado por timestamp.
+
+    Agrega la columna 'source_log' para saber de qué shard proviene cada fila e
+    imprime un resumen de acciones y estados por shard y total.
+    """
+    rows = []
+    per_log = {}
+    for log_filename in log_filenames:
+        counts = {}
+        with open(log_filename, 'r', newline='', encoding='utf-8') as csvfile:
+            for row in csv.DictReader(csvfile):
+                row['source_log'] = os.path.basename(log_filename)
+                rows.append(row)
+                key = f"{row.get('action')},{row.get('status')}"
+                counts[key] = counts.get(key, 0) + 1
+        per_log[log_filename] = counts
+
+    rows.sort(key=lambda row: row.get('timestamp') or '')
+
+    if not output_filename:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        env = getattr(settings, 'ENV', 'unknown')
+        output_filename = f"sync_report_{env}_merged_{timestamp}.csv"
+
+    with open(output_filename, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=LOG_FIELDNAMES + ['source_log'])
+        writer.writeheader()
+        writer.writerows(rows)
+
+    totals = {}
+    print(f"[MERGE] Reporte combinado: {output_filename}")
+    for log_filename, counts in per_log.items():
+        print(f"   {log_filename}: {sum(counts.values())} filas")
+        for key, count in sorted(counts.items()):
+            print(f"      {key}: {count}")
+            totals[key] = totals.get(key, 0) + count
+    print(f"[STATS] Total combinado: {len(rows)} filas")
+    for key, count in sorted(totals.items()):
+        print(f"   {key}: {count}")
+    return output_filename
+
+def init_retry_queue(dry_run=True):
+    """Inicializa la cola persistente de reintentos (solo cuando se aplican cambios)"""
+    global retry_queue
+    retry_queue = None if dry_run else RetryQueue()
+    return retry_queue
+
+def init_id_map():
+    """Carga el mapa persistente de IDs Moodle ↔ Discourse"""
+    global id_map
+    id_map = IdMap()
+    return id_map
+
+def save_id_map():
+    if id_map is not None:
+        id_map.save()
+
+def link_user_ids(moodle_user, discourse_user):
+    """Registra en el mapa de IDs la correspondencia de un usuario ya resuelto o creado"""
+    if id_map is not None and discourse_user:
+        id_map.link(moodle_user.get("id"), discourse_user.get("id"), discourse_user.get("username"))
+
+def save_retry_queue():
+    if retry_queue is not None:
+        retry_queue.flush()
+
+def schedule_retry(operation, args, status_code=None, exception=None):
+    """
+    Programa el reintento de una operación fallida si el error es transitorio
+    (timeout, error de conexión, 5xx o 429). Devuelve True si quedó programado.
+    Si la operación ya era un reintento y el error es permanente, pasa
+    directamente al archivo dead-letter.
+    """
+    if retry_queue is None:
+        return False
+    error = exception if exception is not None else f"HTTP {status_code}"
+    if not is_transient_error(status_code, exception):
+        retry_queue.record_permanent_failure(operation, args, error)
+        return False
+    if retry_queue.record_failure(operation, args, error):
+        print(f"   [RETRY] Reintento programado para {operation}")
+        return True
+    print(f"   [DEAD-LETTER] {operation} agotó sus reintentos, registrado en {retry_queue.dead_letter_filename}")
+    return False
+
 def build_discourse_url(path):
     """Construye una URL de Discourse correctamente, evitando dobles barras"""
     base_url = settings.DISCOURSE_URL.rstrip('/')
     return f"{base_url}{path}"
 
 def check_email_exists(email, debug=False):
-    """Verifica si un email ya existe en Discourse"""
-    url = build_discourse_url("/admin/users/list/active.json?show_emails=true")
-    headers = {
-        "Api-Key": settings.DISCOURSE_API_KEY,
-        "Api-Username": settings.DISCOURSE_API_USER
-    }
-    
+    """Verifica si un email ya existe en Discourse (en el índice de usuarios de la ejecución)"""
     if debug:
         print(f"   [INFO] Verificando si el email {email} ya existe en Discourse...")
     
-    try:
-        r = requests.get(url, headers=headers)
-        if r.status_code == 200:
-            users = r.json()
-            for user in users:
-                if user.get('email') == email:
-                    if debug:
-                        print(f"   [WARNING] Email {email} ya existe para el usuario: {user.get('username')}")
-                    return user
-            if debug:
-                print(f"   [OK] Email {email} no existe en Discourse")
-            return None
-        else:
-            if debug:
-                print(f"   [ERROR] Error verificando email: {r.status_code}")
-            return None
-    except Exception as e:
+    if not load_discourse_index():
         if debug:
-            print(f"   [ERROR] Excepción verificando email: {e}")
+            print("   [ERROR] No se pudo cargar la lista de usuarios para verificar el email")
         return None
+    
+    user = discourse_index.by_email(email)
+    if debug:
+        if user:
+            print(f"   [WARNING] Email {email} ya existe para el usuario: {user.get('username')}")
+        else:
+            print(f"   [OK] Email {email} no existe en Discourse")
+    return user
 
 def normalize_username(username):
     """
@@ -144,10 +336,19 @@ def normalize_username(username):
 
 
 def load_excluded_users():
-    """Carga la lista de usuarios excluidos desde el archivo excluded_users.txt"""
+    """
+    Carga la lista de usuarios excluidos desde EXCLUDED_USERS_FILE.
+
+    Sin ese valor se usa excluded_users.txt en el directorio actual, que se crea
+    con una lista por defecto si no existe; si EXCLUDED_USERS_FILE está definido
+    y el archivo no existe se lanza FileNotFoundError en lugar de inventar una lista.
+    """
     excluded_users = set()
-    excluded_file = "excluded_users.txt"
-    
+    excluded_file = getattr(settings, 'EXCLUDED_USERS_FILE', None)
+    if excluded_file and not os.path.exists(excluded_file):
+        raise FileNotFoundError(f"EXCLUDED_USERS_FILE: no existe el archivo {excluded_file}")
+    excluded_file = excluded_file or "excluded_users.txt"
+
     if not os.path.exists(excluded_file):
         print(f"[WARNING] Archivo {excluded_file} no encontrado, creando uno por defecto...")
         # Crear archivo por defecto
@@ -184,8 +385,33 @@ def is_user_excluded(username, excluded_users):
     return username.lower() in excluded_users
 
 
-def get_moodle_users(filter_username=None, limit=None, offset=0):
-    """Obtiene usuarios desde Moodle. Si filter_username está definido, solo devuelve ese."""
+def parse_shard(value):
+    """Convierte 'K/N' en la tupla (K, N), con 1 <= K <= N (tipo para argparse)"""
+    try:
+        k, n = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Formato de shard inválido '{value}', se esperaba K/N (ej: 1/4)")
+    if n < 1 or not 1 <= k <= n:
+        raise argparse.ArgumentTypeError(f"Shard inválido '{value}': se requiere 1 <= K <= N")
+    return k, n
+
+
+def user_in_shard(moodle_id, shard):
+    """
+    Indica si un usuario de Moodle pertenece al shard (K, N).
+
+    Usa un hash estable (CRC32) del ID de Moodle, de modo que N procesos en
+    hosts distintos se reparten los usuarios en porciones disjuntas sin
+    coordinarse entre sí.
+    """
+    if not shard:
+        return True
+    k, n = shard
+    return zlib.crc32(str(moodle_id).encode('utf-8')) % n == k - 1
+
+
+def _fetch_all_moodle_users():
+    """Todos los usuarios de Moodle tal como los devuelve core_user_get_users (JSON)"""
     params = {
         "wstoken": settings.MOODLE_TOKEN,
         "wsfunction": "core_user_get_users",
@@ -193,13 +419,27 @@ def get_moodle_users(filter_username=None, limit=None, offset=0):
         "criteria[0][key]": "email",
         "criteria[0][value]": "%"
     }
-    r = requests.get(settings.MOODLE_ENDPOINT, params=params)
+    r = http_client.get(settings.MOODLE_ENDPOINT, params=params)
     r.raise_for_status()
-    users = r.json().get("users", [])
+    return r.json().get("users", [])
+
+
+def get_moodle_users(filter_username=None, limit=None, offset=0, shard=None):
+    """Obtiene usuarios desde Moodle. Si filter_username está definido, solo devuelve ese."""
+    users = [MoodleUser.from_json(u) for u in _fetch_all_moodle_users()]
 
     if filter_username:
         return [u for u in users if u.get("username") == filter_username]
     
+    return select_users(users, limit=limit, offset=offset, shard=shard)
+
+
+def select_users(users, limit=None, offset=0, shard=None):
+    """Aplica shard, offset y límite (en ese orden) a una lista de usuarios de Moodle"""
+    # Quedarse solo con la porción de este shard (antes de offset y límite)
+    if shard:
+        users = [u for u in users if user_in_shard(u.get("id"), shard)]
+    
     # Aplicar offset y límite si se especifican
     if offset > 0:
         users = users[offset:]
@@ -210,13 +450,236 @@ def get_moodle_users(filter_username=None, limit=None, offset=0):
     return users
 
 
-def get_discourse_user(username, user_cache=None, debug=False):
-    """Obtiene datos actuales del usuario en Discourse"""
-    # Si tenemos caché, usarlo primero
-    if user_cache and username in user_cache:
-        if debug:
-            print(f"   [CACHE] Usuario {username} encontrado en caché")
-        return user_cache[username]
+def select_users_lazily(users, filter_username=None, limit=None, offset=0, shard=None):
+    """
+    Como select_users, pero sobre un iterador de usuarios: shard, offset y límite
+    se aplican mientras se lee y solo se conservan los usuarios seleccionados.
+    """
+    if filter_username:
+        return [u for u in users if u.get("username") == filter_username][:1]
+    if shard:
+        users = (u for u in users if user_in_shard(u.get("id"), shard))
+    stop = offset + limit if limit and limit > 0 else None
+    return list(itertools.islice(users, offset, stop))
+
+
+def get_moodle_users_from_export(filename, filter_username=None, limit=None, offset=0, shard=None):
+    """
+    Obtiene los usuarios desde una exportación de Moodle (CSV o NDJSON) en lugar
+    del web service. El archivo se recorre de forma perezosa.
+    """
+    selected = select_users_lazily(iter_export_users(filename), filter_username, limit, offset, shard)
+    print(f"[EXPORT] {len(selected)} usuarios leídos de {filename}")
+    return selected
+
+
+def get_moodle_users_from_db(filter_username=None, limit=None, offset=0, shard=None, modified_since=None):
+    """
+    Obtiene los usuarios leyendo directamente la base de datos de Moodle
+    (settings.MOODLE_DB, solo lectura) con un cursor en streaming.
+    """
+    selected = select_users_lazily(iter_db_users(modified_since=modified_since), filter_username, limit, offset, shard)
+    since = f" modificados desde {datetime.fromtimestamp(modified_since)}" if modified_since else ""
+    print(f"[DB] {len(selected)} usuarios leídos de la base de datos de Moodle{since}")
+    return selected
+
+
+def iter_live_moodle_users(export_file=None, from_db=False):
+    """
+    Todos los usuarios vivos de Moodle (ni eliminados ni suspendidos), desde la
+    exportación, la base de datos o el web service. Para la reconciliación.
+    """
+    if export_file:
+        return iter_export_users(export_file)
+    if from_db:
+        return iter_db_users()
+    # core_user_get_users no devuelve los eliminados, pero sí los suspendidos
+    return (MoodleUser.from_json(u) for u in _fetch_all_moodle_users() if not u.get("suspended"))
+
+
+def parse_timestamp(value):
+    """Convierte un timestamp Unix o una fecha ISO (2024-05-01[T10:00]) en timestamp (para argparse)"""
+    if value.isdigit():
+        return int(value)
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Fecha inválida: {value} (usar timestamp Unix o fecha ISO, ej: 2024-05-01)")
+
+
+def get_course_enrolled_users(course_id, page_size=None):
+    """
+    Obtiene los usuarios matriculados (con matrícula activa) en un curso de Moodle,
+    paginando core_enrol_get_enrolled_users con limitfrom/limitnumber.
+    """
+    page_size = page_size or getattr(settings, 'MOODLE_ENROL_PAGE_SIZE', 200)
+    users = []
+    limitfrom = 0
+    while True:
+        params = {
+            "wstoken": settings.MOODLE_TOKEN,
+            "wsfunction": "core_enrol_get_enrolled_users",
+            "moodlewsrestformat": "json",
+            "courseid": course_id,
+            "options[0][name]": "onlyactive",
+            "options[0][value]": 1,
+            "options[1][name]": "limitfrom",
+            "options[1][value]": limitfrom,
+            "options[2][name]": "limitnumber",
+            "options[2][value]": page_size,
+            # Pedir solo los campos que usa la sincronización
+            "options[3][name]": "userfields",
+            "options[3][value]": "id,username,fullname,email,city,country,description,profileimageurl,customfields",
+        }
+        r = http_client.get(settings.MOODLE_ENDPOINT, params=params)
+        r.raise_for_status()
+        data = r.json()
+        if isinstance(data, dict) and data.get("exception"):
+            raise RuntimeError(f"Error de Moodle en core_enrol_get_enrolled_users (curso {course_id}): {data.get('message')}")
+        users.extend(MoodleUser.from_json(u) for u in data)
+        if len(data) < page_size:
+            return users
+        limitfrom += page_size
+
+
+def get_moodle_users_by_courses(course_ids, limit=None, offset=0, shard=None, max_workers=None):
+    """
+    Obtiene los usuarios matriculados en uno o varios cursos, pidiendo los cursos
+    en paralelo y sin duplicar a los usuarios matriculados en más de un curso.
+    """
+    max_workers = max_workers or getattr(settings, 'MOODLE_FETCH_CONCURRENCY', 4)
+    users = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(course_ids))), thread_name_prefix="moodle") as executor:
+        for course_id, course_users in zip(course_ids, executor.map(get_course_enrolled_users, course_ids)):
+            print(f"[COURSES] Curso {course_id}: {len(course_users)} usuarios matriculados")
+            for user in course_users:
+                users.setdefault(user.get("id"), user)
+    print(f"[COURSES] {len(users)} usuarios únicos en {len(course_ids)} cursos")
+    return select_users(sorted(users.values(), key=lambda u: u.get("id")), limit=limit, offset=offset, shard=shard)
+
+
+def parse_course_ids(value):
+    """Convierte '12,34,56' en [12, 34, 56] (para argparse)"""
+    try:
+        course_ids = [int(part) for part in value.split(",") if part.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Lista de cursos inválida: {value} (usar IDs separados por coma, ej: 12,34)")
+    if not course_ids:
+        raise argparse.ArgumentTypeError("--courses requiere al menos un ID de curso")
+    return course_ids
+
+
+def _fetch_moodle_users_chunk(field, values):
+    """Una llamada a core_user_get_users_by_field con varios valores"""
+    params = {
+        "wstoken": settings.MOODLE_TOKEN,
+        "wsfunction": "core_user_get_users_by_field",
+        "moodlewsrestformat": "json",
+        "field": field
+    }
+    for i, value in enumerate(values):
+        params[f"values[{i}]"] = value
+    r = http_client.hedged_get(settings.MOODLE_ENDPOINT, params=params)
+    r.raise_for_status()
+    data = r.json()
+    if isinstance(data, dict) and data.get("exception"):
+        raise RuntimeError(f"Error de Moodle en core_user_get_users_by_field: {data.get('message')}")
+    return [MoodleUser.from_json(u) for u in data]
+
+
+def get_moodle_users_by_field(field, values, chunk_size=None, max_workers=None):
+    """
+    Obtiene de Moodle los usuarios cuyo campo (id, username, email...) esté en values.
+
+    Los valores se agrupan en bloques de MOODLE_BY_FIELD_CHUNK_SIZE por llamada y
+    los bloques se piden en paralelo (MOODLE_FETCH_CONCURRENCY), de modo que
+    sincronizar cualquier subconjunto de usuarios cuesta unas pocas llamadas.
+    """
+    values = list(dict.fromkeys(values))  # sin duplicados, conservando el orden
+    if not values:
+        return []
+    chunk_size = chunk_size or getattr(settings, 'MOODLE_BY_FIELD_CHUNK_SIZE', 100)
+    max_workers = max_workers or getattr(settings, 'MOODLE_FETCH_CONCURRENCY', 4)
+    chunks = [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+
+    if len(chunks) == 1:
+        return _fetch_moodle_users_chunk(field, chunks[0])
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(chunks)), thread_name_prefix="moodle") as executor:
+        results = executor.map(lambda chunk: _fetch_moodle_users_chunk(field, chunk), chunks)
+        return [user for chunk_users in results for user in chunk_users]
+
+
+# Prefijos aceptados en las líneas del archivo de --users-file
+USERS_FILE_FIELDS = ('id', 'username', 'email')
+
+
+def read_users_file(filename):
+    """
+    Lee un archivo con un usuario por línea (ID, username o email) y los agrupa
+    por campo de búsqueda de Moodle: {'id': [...], 'username': [...], 'email': [...]}.
+
+    Cada línea puede indicar el campo con un prefijo (id:, username: o email:),
+    necesario por ejemplo para usernames numéricos. Sin prefijo se deduce: solo
+    dígitos es un ID, con @ es un email y el resto un username. Las líneas
+    vacías y las que empiezan con # se ignoran.
+    """
+    values_by_field = {}
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            value = line.strip()
+            if not value or value.startswith('#'):
+                continue
+            prefix, separator, rest = value.partition(':')
+            if separator and prefix.strip().lower() in USERS_FILE_FIELDS:
+                field, value = prefix.strip().lower(), rest.strip()
+                if field == 'id':
+                    if not value.isdigit():
+                        raise ValueError(f"{filename}:{line_number}: ID no válido: {value!r}")
+                    value = int(value)
+            elif value.isdigit():
+                field, value = 'id', int(value)
+            elif '@' in value:
+                field = 'email'
+            else:
+                field = 'username'
+            values_by_field.setdefault(field, []).append(value)
+    return values_by_field
+
+
+def get_moodle_users_from_file(filename, shard=None):
+    """Obtiene de Moodle, con llamadas agrupadas, los usuarios listados en un archivo"""
+    values_by_field = read_users_file(filename)
+    users = {}
+    for field, values in values_by_field.items():
+        for user in get_moodle_users_by_field(field, values):
+            users.setdefault(user.get("id"), user)
+    requested = sum(len(set(values)) for values in values_by_field.values())
+    print(f"[USERS-FILE] {len(users)} de {requested} usuarios de {filename} encontrados en Moodle")
+    users = list(users.values())
+    if shard:
+        users = [u for u in users if user_in_shard(u.get("id"), shard)]
+    return users
+
+
+def get_discourse_user(username, debug=False, refresh=False, raise_errors=False):
+    """
+    Obtiene datos actuales del usuario en Discourse.
+
+    Consulta primero el caché de la ejecución (incluidos los 404 ya confirmados);
+    con refresh=True ignora el caché y lo actualiza con la respuesta. Devuelve {}
+    si el usuario no existe o la consulta falla; con raise_errors=True solo
+    devuelve {} ante un 404 y los demás errores se propagan como excepción.
+    """
+    if not refresh:
+        cached = discourse_cache.lookup(username)
+        if cached is NOT_FOUND:
+            if debug:
+                print(f"   [CACHE] Usuario {username} ya confirmado como inexistente")
+            return {}
+        if cached is not None:
+            if debug:
+                print(f"   [CACHE] Usuario {username} encontrado en caché")
+            return cached
     
     url = build_discourse_url(f"/u/{username}.json")
     headers = {
@@ -228,102 +691,198 @@ def get_discourse_user(username, user_cache=None, debug=False):
         print(f"   [INFO] Buscando usuario {username} en {url}")
     
     try:
-        r = requests.get(url, headers=headers)
+        r = http_client.hedged_get(url, headers=headers)
         if debug:
             print(f"   [RESPONSE] Respuesta: {r.status_code}")
         
         if r.status_code == 200:
-            user_data = r.json().get("user", {})
+            user_data = discourse_cache.store(username, r.json().get("user", {}))
             if debug:
                 print(f"   [OK] Usuario {username} encontrado: {user_data.get('id', 'sin ID')}")
-            # Guardar en caché si se proporciona
-            if user_cache is not None:
-                user_cache[username] = user_data
             return user_data
         elif r.status_code == 404:
+            discourse_cache.store_missing(username)
             if debug:
                 print(f"   [ERROR] Usuario {username} no encontrado (404)")
         else:
             if debug:
                 print(f"   [WARNING] Error inesperado para {username}: {r.status_code} - {r.text[:100]}")
+            if raise_errors:
+                raise requests.HTTPError(f"HTTP {r.status_code} consultando el usuario de Discourse {username}",
+                                         response=r)
     except Exception as e:
         if debug:
             print(f"   [ERROR] Excepción buscando {username}: {e}")
+        if raise_errors:
+            raise
     
     return {}
 
 
-def is_field_empty(value):
-    """Verifica si un campo está vacío (None, string vacío, o solo espacios)"""
-    if value is None:
-        return True
-    if isinstance(value, str):
-        return value.strip() == ""
-    return False
+def get_discourse_user_by_external_id(external_id, debug=False):
+    """
+    Busca un usuario de Discourse por su external_id de SSO (el ID de Moodle).
 
+    Solo es útil con DiscourseConnect activado (DISCOURSE_SSO_ENABLED); el
+    resultado se guarda en el caché de la ejecución bajo su username.
+    """
+    url = build_discourse_url(f"/u/by-external/{external_id}.json")
+    headers = {
+        "Api-Key": settings.DISCOURSE_API_KEY,
+        "Api-Username": settings.DISCOURSE_API_USER
+    }
+    try:
+        r = http_client.hedged_get(url, headers=headers)
+        if r.status_code == 200:
+            user = r.json().get("user", {})
+            if user.get("username"):
+                if debug:
+                    print(f"   [OK] Usuario con external_id {external_id} encontrado: {user.get('username')}")
+                return discourse_cache.store(user["username"], user)
+        elif debug:
+            print(f"   [INFO] Sin usuario con external_id {external_id} ({r.status_code})")
+    except Exception as e:
+        if debug:
+            print(f"   [ERROR] Excepción buscando external_id {external_id}: {e}")
+    return {}
+
+
+def get_discourse_username_by_id(user_id, debug=False):
+    """
+    Obtiene el username actual de un usuario de Discourse a partir de su ID.
+
+    Devuelve None solo si Discourse confirma que el usuario no existe (404);
+    cualquier otro error (timeout, 5xx, 429, 403...) se propaga como excepción,
+    porque no dice nada sobre si el usuario sigue existiendo.
+    """
+    url = build_discourse_url(f"/admin/users/{user_id}.json")
+    headers = {
+        "Api-Key": settings.DISCOURSE_API_KEY,
+        "Api-Username": settings.DISCOURSE_API_USER
+    }
+    r = http_client.hedged_get(url, headers=headers)
+    if r.status_code == 200:
+        return r.json().get("username")
+    if r.status_code == 404:
+        if debug:
+            print(f"   [INFO] Usuario de Discourse {user_id} no encontrado (404)")
+        return None
+    raise requests.HTTPError(f"HTTP {r.status_code} consultando el usuario de Discourse {user_id}", response=r)
+
+
+def resolve_discourse_user(moodle_user, debug=False):
+    """
+    Encuentra al usuario de Discourse que corresponde a un usuario de Moodle.
+
+    Orden de búsqueda:
+    1. Mapa persistente de IDs (sin peticiones extra si el username no cambió;
+       si cambió en Discourse, una consulta por ID para obtener el nuevo).
+    2. external_id de SSO, si DISCOURSE_SSO_ENABLED está activado.
+    3. Username normalizado, como hasta ahora.
+
+    Devuelve el DiscourseUser o {} si no existe; los usuarios encontrados
+    quedan registrados en el mapa de IDs. Un usuario mapeado solo se quita del
+    mapa si Discourse confirma que no existe (404 a su ID, o a su username
+    actual); si alguna consulta falla por otro motivo se propaga la excepción
+    y el mapa queda como estaba.
+    """
+    moodle_id = moodle_user.get("id")
+    normalized_username = normalize_username(moodle_user.get("username"))
+
+    mapped = id_map.lookup(moodle_id) if id_map is not None and moodle_id is not None else None
+    if mapped:
+        current_username = None
+        discourse_user = get_discourse_user(mapped['username'], debug=debug)
+        if not discourse_user or discourse_user.get("id") != mapped['discourse_id']:
+            # El username cambió en Discourse (o la consulta falló): obtener el actual por ID
+            current_username = get_discourse_username_by_id(mapped['discourse_id'], debug=debug)
+            discourse_user = {}
+            if current_username:
+                discourse_user = get_discourse_user(current_username, debug=debug, raise_errors=True)
+        if discourse_user and discourse_user.get("id") == mapped['discourse_id']:
+            if discourse_user.get("username") != normalized_username:
+                print(f"   [IDMAP] {moodle_user.get('username')} corresponde a {discourse_user.get('username')} en Discourse")
+            link_user_ids(moodle_user, discourse_user)
+            return discourse_user
+        if current_username and discourse_cache.lookup(current_username) is not NOT_FOUND:
+            # Respuesta inconsistente (otro ID con ese username): no se puede confirmar la baja
+            raise requests.HTTPError(f"El usuario de Discourse {mapped['discourse_id']} ({current_username}) "
+                                     f"no coincide con el mapa de IDs")
+        print(f"   [IDMAP] El usuario de Discourse {mapped['discourse_id']} ya no existe, se elimina del mapa")
+        id_map.unlink(moodle_id)
+
+    if getattr(settings, 'DISCOURSE_SSO_ENABLED', False) and moodle_id is not None:
+        discourse_user = get_discourse_user_by_external_id(moodle_id, debug=debug)
+        if discourse_user:
+            link_user_ids(moodle_user, discourse_user)
+            return discourse_user
+
+    discourse_user = get_discourse_user(normalized_username, debug=debug)
+    link_user_ids(moodle_user, discourse_user)
+    return discourse_user
 
-def should_update_field(moodle_value, discourse_value):
-    """Determina si un campo debe ser actualizado basado en si está vacío en Discourse"""
-    # Si el campo en Discourse está vacío y tenemos un valor en Moodle, actualizar
-    if is_field_empty(discourse_value) and not is_field_empty(moodle_value):
-        return True
-    # Si ambos campos tienen contenido, no actualizar (preservar el de Discourse)
-    if not is_field_empty(discourse_value) and not is_field_empty(moodle_value):
-        return False
-    # Si ambos están vacíos, no actualizar
-    if is_field_empty(discourse_value) and is_field_empty(moodle_value):
-        return False
-    # Si Discourse tiene contenido pero Moodle está vacío, no actualizar
-    if not is_field_empty(discourse_value) and is_field_empty(moodle_value):
-        return False
-    return False
 
 
 def update_discourse_user_profile(username, updates, discourse_user=None, dry_run=True):
-    """Actualiza el perfil del usuario en Discourse usando el endpoint correcto"""
+    """
+    Actualiza el perfil del usuario en Discourse con una sola escritura.
+
+    updates son los cambios calculados por el mapeo de campos (ver
+    field_map.py); todos se envían juntos en un único PUT /u/{username}.json.
+    Devuelve True si la escritura se aplicó (o se simuló en dry-run).
+    """
     if dry_run:
         if not discourse_user:
             print(f"[WARNING] Usuario {username} no encontrado en Discourse")
-            return
+            return False
 
         print(f"\n[DRY-RUN] Comparando usuario: {username}")
         for key, new_value in updates.items():
-            old_value = discourse_user.get(key)
-            if should_update_field(new_value, old_value):
-                print(f"   - {key}: '{old_value}' → '{new_value}' (actualizando campo vacío)")
-            elif old_value != new_value:
-                print(f"   - {key}: '{old_value}' → '{new_value}' (NO actualizando - campo ya tiene contenido)")
-        return
+            print(f"   - {key}: '{field_value(discourse_user, key)}' → '{new_value}'")
+        return True
 
-    # Para actualizar el perfil, usamos la estructura correcta descubierta
-    # Los campos deben enviarse directamente, no envueltos en {'user': ...}
+    # Los campos se envían directamente, no envueltos en {'user': ...}
     url = build_discourse_url(f"/u/{username}.json")
     headers = {
         "Api-Key": settings.DISCOURSE_API_KEY,
         "Api-Username": settings.DISCOURSE_API_USER,
         "Content-Type": "application/json"
     }
-    
-    # Enviar cada campo por separado para asegurar que se aplique
-    for key, value in updates.items():
-        data = {key: value}
-        print(f"Actualizando {key} para {username}...")
-        
-        r = requests.put(url, headers=headers, json=data)
-        if r.status_code == 200:
-            print(f"[OK] {key} actualizado para {username}")
-        else:
-            print(f"[ERROR] Error actualizando {key} de {username}: {r.status_code} - {r.text}")
+    data = build_profile_payload(updates, discourse_user)
+    print(f"Actualizando {', '.join(updates)} para {username}...")
+
+    retry_args = {'username': username, 'updates': data}
+    try:
+        r = http_client.put(url, headers=headers, json=data)
+    except Exception as e:
+        print(f"[ERROR] Excepción actualizando el perfil de {username}: {e}")
+        schedule_retry('update_profile', retry_args, exception=e)
+        return False
+    if r.status_code == 200:
+        print(f"[OK] {', '.join(updates)} actualizado para {username}")
+        discourse_cache.update_fields(username, data)
+    else:
+        print(f"[ERROR] Error actualizando el perfil de {username}: {r.status_code} - {r.text}")
+        schedule_retry('update_profile', retry_args, status_code=r.status_code)
+        return False
 
     # Verificar que los cambios se aplicaron
-    verify_changes(username, updates)
+    verify_changes(username, data)
+    return True
+
+
+def field_value(discourse_user, key):
+    """Valor actual de un campo de Discourse (incluye 'user_fields.<id>')"""
+    if key.startswith("user_fields."):
+        return (discourse_user.get("user_fields") or {}).get(key[len("user_fields."):])
+    return discourse_user.get(key)
 
 
 def update_discourse_user_bio(username, bio_raw, discourse_user=None, dry_run=True):
-    """Actualiza la biografía del usuario en Discourse"""
+    """Actualiza la biografía del usuario en Discourse. Devuelve True si se aplicó (o en dry-run)"""
     if not discourse_user:
         print(f"[WARNING] Usuario {username} no encontrado en Discourse, saltando biografía")
-        return
+        return False
         
     url = build_discourse_url(f"/u/{username}/preferences/about")
     headers = {
@@ -333,23 +892,24 @@ def update_discourse_user_bio(username, bio_raw, discourse_user=None, dry_run=Tr
     }
 
     if dry_run:
-        old_bio = discourse_user.get("bio_raw", "")
-        if should_update_field(bio_raw, old_bio):
-            print(f"   - bio_raw: '{old_bio}' → '{bio_raw}' (actualizando campo vacío)")
-        elif old_bio != bio_raw:
-            print(f"   - bio_raw: '{old_bio}' → '{bio_raw}' (NO actualizando - campo ya tiene contenido)")
-        return
+        print(f"   - bio_raw: '{discourse_user.get('bio_raw', '')}' → '{bio_raw}'")
+        return True
 
     try:
-        r = requests.put(url, headers=headers, json={"bio_raw": bio_raw})
+        r = http_client.put(url, headers=headers, json={"bio_raw": bio_raw})
         if r.status_code == 200:
             print(f"[OK] Biografía actualizada para {username}")
-        elif r.status_code == 403:
+            discourse_cache.update_fields(username, {"bio_raw": bio_raw})
+            return True
+        if r.status_code == 403:
             print(f"[WARNING] Sin permisos para actualizar biografía de {username} (403)")
         else:
             print(f"[ERROR] Error actualizando biografía de {username}: {r.status_code} - {r.text[:200]}")
+            schedule_retry('update_bio', {'username': username, 'bio_raw': bio_raw}, status_code=r.status_code)
     except Exception as e:
         print(f"[ERROR] Excepción actualizando biografía de {username}: {e}")
+        schedule_retry('update_bio', {'username': username, 'bio_raw': bio_raw}, exception=e)
+    return False
 
 
 def activate_discourse_user(user_id, dry_run=True):
@@ -368,7 +928,7 @@ def activate_discourse_user(user_id, dry_run=True):
     
     try:
         # Aprobar usuario
-        r = requests.put(approve_url, headers=headers)
+        r = http_client.put(approve_url, headers=headers)
         if r.status_code == 200:
             print(f"   [OK] Usuario {user_id} aprobado exitosamente")
         else:
@@ -376,23 +936,73 @@ def activate_discourse_user(user_id, dry_run=True):
         
         # Luego activar usuario
         activate_url = build_discourse_url(f"/admin/users/{user_id}/activate")
-        r = requests.put(activate_url, headers=headers)
+        r = http_client.put(activate_url, headers=headers)
         if r.status_code == 200:
             print(f"   [OK] Usuario {user_id} activado exitosamente")
+            discourse_cache.update_fields_by_id(user_id, {"active": True})
             return True
         else:
             print(f"   [ERROR] Error activando usuario {user_id}: {r.status_code} - {r.text}")
+            schedule_retry('activate_user', {'user_id': user_id}, status_code=r.status_code)
             return False
             
     except Exception as e:
         print(f"   [ERROR] Excepción activando usuario {user_id}: {e}")
+        schedule_retry('activate_user', {'user_id': user_id}, exception=e)
+        return False
+
+def suspend_discourse_user(user_id, reason, dry_run=True):
+    """Suspende (sin fecha de fin) un usuario de Discourse"""
+    if dry_run:
+        print(f"   - [Dry-run] SUSPENDERÍA usuario ID: {user_id}")
+        return True
+
+    url = build_discourse_url(f"/admin/users/{user_id}/suspend.json")
+    headers = {
+        "Api-Key": settings.DISCOURSE_API_KEY,
+        "Api-Username": settings.DISCOURSE_API_USER,
+        "Content-Type": "application/json"
+    }
+    try:
+        r = http_client.put(url, headers=headers, json={"suspend_until": "3000-01-01", "reason": reason})
+        if r.status_code == 200:
+            print(f"   [OK] Usuario {user_id} suspendido")
+            return True
+        print(f"   [ERROR] Error suspendiendo usuario {user_id}: {r.status_code} - {r.text}")
+        return False
+    except Exception as e:
+        print(f"   [ERROR] Excepción suspendiendo usuario {user_id}: {e}")
+        return False
+
+def deactivate_discourse_user(user_id, dry_run=True):
+    """Desactiva un usuario de Discourse (deberá volver a confirmar su email)"""
+    if dry_run:
+        print(f"   - [Dry-run] DESACTIVARÍA usuario ID: {user_id}")
+        return True
+
+    url = build_discourse_url(f"/admin/users/{user_id}/deactivate.json")
+    headers = {
+        "Api-Key": settings.DISCOURSE_API_KEY,
+        "Api-Username": settings.DISCOURSE_API_USER,
+        "Content-Type": "application/json"
+    }
+    try:
+        r = http_client.put(url, headers=headers)
+        if r.status_code == 200:
+            print(f"   [OK] Usuario {user_id} desactivado")
+            discourse_cache.update_fields_by_id(user_id, {"active": False})
+            return True
+        print(f"   [ERROR] Error desactivando usuario {user_id}: {r.status_code} - {r.text}")
+        return False
+    except Exception as e:
+        print(f"   [ERROR] Excepción desactivando usuario {user_id}: {e}")
         return False
 
 def update_discourse_email(username, new_email, discourse_user=None, dry_run=True):
-    """Actualiza el email en Discourse (requiere confirmación del usuario)"""
+    """Actualiza el email en Discourse (requiere confirmación del usuario). Devuelve True si se aplicó (o en dry-run)"""
     if not discourse_user:
         print(f"[WARNING] Usuario {username} no encontrado en Discourse, saltando email")
-        return
+        return False
         
     url = build_discourse_url(f"/u/{username}/preferences/email")
     headers = {
@@ -402,29 +1012,32 @@ def update_discourse_email(username, new_email, discourse_user=None, dry_run=Tru
     }
 
     if dry_run:
-        discourse_email = discourse_user.get("email", "")
-        if should_update_field(new_email, discourse_email):
-            print(f"   - [Dry-run] Email cambiaría a: {new_email} (requiere confirmación del usuario)")
-        elif discourse_email != new_email:
-            print(f"   - [Dry-run] Email NO cambiaría: {discourse_email} (ya tiene contenido)")
-        return
+        print(f"   - [Dry-run] Email cambiaría a: {new_email} (requiere confirmación del usuario)")
+        return True
 
     try:
-        r = requests.put(url, headers=headers, json={"email": new_email})
+        r = http_client.put(url, headers=headers, json={"email": new_email})
         if r.status_code == 200:
             print(f"[OK] Email actualizado para {username} → {new_email} (pendiente confirmación)")
-        elif r.status_code == 403:
+            # El email no cambia hasta que el usuario lo confirma: volver a consultarlo la próxima vez
+            discourse_cache.invalidate(username)
+            return True
+        if r.status_code == 403:
             print(f"[WARNING] Sin permisos para actualizar email de {username} (403)")
         else:
             print(f"[ERROR] Error actualizando email de {username}: {r.status_code} - {r.text[:200]}")
+            schedule_retry('update_email', {'username': username, 'email': new_email}, status_code=r.status_code)
     except Exception as e:
         print(f"[ERROR] Excepción actualizando email de {username}: {e}")
+        schedule_retry('update_email', {'username': username, 'email': new_email}, exception=e)
+    return False
 
 
 def verify_changes(username, expected_updates):
     """Verifica que los cambios se hayan aplicado correctamente"""
     print(f"[INFO] Verificando cambios para {username}...")
-    discourse_user = get_discourse_user(username)
+    # Verificar contra Discourse (no contra la copia cacheada que ya incluye los cambios)
+    discourse_user = get_discourse_user(username, refresh=True)
     
     if not discourse_user:
         print(f"[WARNING] No se pudo verificar {username} - usuario no encontrado")
@@ -432,6 +1045,9 @@ def verify_changes(username, expected_updates):
     
     for key, expected_value in expected_updates.items():
         actual_value = discourse_user.get(key)
+        if isinstance(expected_value, dict):
+            # user_fields: basta con que estén los valores escritos
+            actual_value = {k: (actual_value or {}).get(k) for k in expected_value}
         if actual_value == expected_value:
             print(f"   [OK] {key}: '{actual_value}' (correcto)")
         else:
@@ -439,15 +1055,15 @@ def verify_changes(username, expected_updates):
 
 
 def get_all_discourse_users():
-    """Obtiene todos los usuarios de Discourse para comparación"""
-    url = build_discourse_url("/admin/users/list/active.json")
+    """Obtiene todos los usuarios de Discourse (con email) desde el listado de administración"""
+    url = build_discourse_url("/admin/users/list/active.json?show_emails=true")
     headers = {
         "Api-Key": settings.DISCOURSE_API_KEY,
         "Api-Username": settings.DISCOURSE_API_USER
     }
     
     try:
-        r = requests.get(url, headers=headers)
+        r = http_client.get(url, headers=headers)
         if r.status_code == 200:
             return r.json()
         else:
@@ -458,53 +1074,94 @@ def get_all_discourse_users():
         return []
 
 
+def load_discourse_index(force=False):
+    """
+    Carga (una vez por ejecución, o al expirar DISCOURSE_INDEX_TTL) el índice de
+    usuarios de Discourse por username y email.
+
+    Con DISCOURSE_SNAPSHOT_STRATEGY = 'csv_export' el índice se arma desde la
+    exportación CSV de administración (pocas peticiones aunque el foro sea
+    grande); si falla, o con 'list', desde /admin/users/list/active.json.
+    Devuelve True si el índice quedó cargado.
+    """
+    if discourse_index.is_fresh() and not force:
+        return True
+    if getattr(settings, 'DISCOURSE_SNAPSHOT_STRATEGY', 'list') == 'csv_export':
+        try:
+            users = list(iter_user_list_export())
+            discourse_index.load(users)
+            print(f"[SNAPSHOT] Índice de Discourse cargado desde la exportación CSV: {len(discourse_index)} usuarios")
+            if getattr(settings, 'SNAPSHOT_FROM_SYNC', True):
+                # La exportación trae todos los campos de los reportes: reutilizarla como snapshot
+                snapshot = UserSnapshot()
+                snapshot.replace_all(user.to_dict() for user in users)
+                snapshot.save()
+                print(f"[SNAPSHOT] Snapshot de reportes actualizado: {snapshot.filename}")
+            return True
+        except Exception as e:
+            print(f"[WARNING] Error usando la exportación CSV de Discourse ({e}), se usa el listado de usuarios")
+    users = get_all_discourse_users()
+    if not users:
+        return False
+    discourse_index.load(users)
+    return True
+
+
 def build_discourse_user_cache(moodle_usernames):
-    """Construye un caché de usuarios de Discourse solo para los usuarios de Moodle"""
+    """
+    Precarga en el caché de la ejecución los usuarios de Discourse de un lote de Moodle.
+
+    Los usuarios que no aparecen en el listado de Discourse se registran como
+    inexistentes, para no consultarlos uno por uno antes de crearlos.
+    """
     print("[INFO] Construyendo caché de usuarios de Discourse...")
-    user_cache = {}
+    found = 0
     
     # Obtener todos los usuarios de Discourse una vez
-    all_discourse_users = get_all_discourse_users()
-    if not all_discourse_users:
-        return user_cache
-    
-    # Crear un diccionario de usuarios de Discourse por username
-    discourse_users_dict = {}
-    for user in all_discourse_users:
-        username = user.get("username")
-        if username:
-            discourse_users_dict[username] = user
+    if not load_discourse_index():
+        return discourse_cache
     
     # Para cada usuario de Moodle, verificar si existe en Discourse y obtener datos completos
     for username in moodle_usernames:
-        if username in discourse_users_dict:
+        if discourse_index.by_username(username):
             # Intentar obtener datos completos del usuario
             try:
                 user_data = get_discourse_user(username)
                 if user_data and user_data.get("id"):  # Verificar que tiene ID válido
-                    user_cache[username] = user_data
+                    found += 1
                     print(f"   [OK] Usuario {username} encontrado en Discourse con datos completos")
                 else:
+                    discourse_cache.invalidate(username)
                     print(f"   [WARNING] Usuario {username} existe pero sin datos completos, se creará nuevo")
             except Exception as e:
                 print(f"   [WARNING] Usuario {username} existe pero error al obtener datos: {e}, se creará nuevo")
         else:
+            discourse_cache.store_missing(username)
             print(f"   [WARNING] Usuario {username} no encontrado en Discourse")
     
-    print(f"[OK] Caché construido: {len(user_cache)} usuarios de Discourse encontrados")
-    return user_cache
+    print(f"[OK] Caché construido: {found} usuarios de Discourse encontrados")
+    return discourse_cache
+
+
+def refresh_discourse_user_cache(moodle_usernames, debug=False):
+    """Vuelve a consultar en Discourse solo los usuarios indicados, manteniendo el resto del caché"""
+    for username in moodle_usernames:
+        get_discourse_user(username, debug=debug, refresh=True)
 
 
 def user_exists_in_discourse(username, discourse_users=None):
     """Verifica si un usuario existe en Discourse"""
     if discourse_users is None:
-        discourse_users = get_all_discourse_users()
+        load_discourse_index()
+        return discourse_index.by_username(username) is not None
     
     return any(user.get("username") == username for user in discourse_users)
 
 
 def get_moodle_groups_for_user(username):
     """Obtiene los grupos de Moodle para un usuario específico"""
+    if offline_source:
+        return []
     params = {
         "wstoken": settings.MOODLE_TOKEN,
         "wsfunction": "core_group_get_course_user_groups",
@@ -513,7 +1170,7 @@ def get_moodle_groups_for_user(username):
     }
     
     try:
-        r = requests.get(settings.MOODLE_ENDPOINT, params=params)
+        r = http_client.hedged_get(settings.MOODLE_ENDPOINT, params=params)
         if r.status_code == 200:
             groups = r.json().get("groups", [])
             return [group.get("name") for group in groups]
@@ -549,38 +1206,14 @@ def update_existing_user_with_conflict(existing_username, moodle_data, dry_run=T
         print(f"   [ERROR] No se pudo obtener datos del usuario {existing_username}")
         return False
     
-    # Actualizar campos
+    # Mismo mapeo de campos que el resto de la sincronización (el email es el que coincide)
     updated = False
-    
-    # Preparar actualizaciones
-    updates = {}
-    
-    # Actualizar nombre
-    if moodle_data.get('fullname') and moodle_data.get('fullname') != discourse_user.get('name'):
-        updates['name'] = moodle_data.get('fullname')
-    
-    # Actualizar ubicación (combinar ciudad y país)
-    location_parts = []
-    if moodle_data.get('city'):
-        location_parts.append(moodle_data.get('city'))
-    if moodle_data.get('country'):
-        country_name = get_country_name(moodle_data.get('country'))
-        if country_name:
-            location_parts.append(country_name)
-    
-    if location_parts:
-        new_location = ', '.join(location_parts)
-        if new_location != discourse_user.get('location'):
-            updates['location'] = new_location
-    
-    # Actualizar biografía
-    if moodle_data.get('description') and moodle_data.get('description') != discourse_user.get('bio_raw'):
-        updates['bio_raw'] = moodle_data.get('description')
-    
-    # Aplicar actualizaciones si hay alguna
-    if updates:
-        if update_discourse_user_profile(existing_username, updates, discourse_user, dry_run=dry_run):
-            updated = True
+    diff = get_field_map().diff(moodle_data, discourse_user, skip_targets=("email",))
+    for key, (old_value, new_value) in diff.preserved.items():
+        print(f"   - {key}: se conserva '{old_value}' (en Moodle: '{new_value}')")
+
+    if diff.changes:
+        updated = update_discourse_user_profile(existing_username, diff.changes, discourse_user, dry_run=dry_run)
     else:
         print(f"   ℹ️ No hay cambios necesarios para {existing_username}")
     
@@ -615,11 +1248,8 @@ def create_discourse_user(username, moodle_data, dry_run=True, log_filename=None
     if email:
         existing_user = check_email_exists(email, debug=debug)
         if existing_user:
-            print(f"   [WARNING] Email {email} ya existe para el usuario: {existing_user.get('username')}")
-            print(f"   [INFO] Opciones:")
-            print(f"     1. Actualizar el usuario existente {existing_user.get('username')}")
-            print(f"     2. Usar un email diferente")
-            print(f"     3. Saltar este usuario")
+            print(f"   [CONFLICT] Email {email} ya existe para el usuario {existing_user.get('username')}: "
+                  f"se actualiza ese usuario en lugar de crear uno nuevo")
             
             # Log del conflicto
             if log_filename:
@@ -656,17 +1286,21 @@ def create_discourse_user(username, moodle_data, dry_run=True, log_filename=None
         "Content-Type": "application/json"
     }
 
-    # Construir datos del usuario usando el username normalizado
+    # Construir datos del usuario usando el username normalizado (un campo vacío
+    # se decide con la misma regla que el mapeo de campos)
+    fullname = moodle_data.get("fullname")
     user_data = {
-        "name": moodle_data.get("fullname", normalized_username),
+        "name": normalized_username if is_field_empty(fullname) else fullname,
         "username": normalized_username,
-        "email": moodle_data.get("email", f"{normalized_username}@example.com"),
+        "email": f"{normalized_username}@example.com" if is_field_empty(email) else email,
         "password": f"TempPass{normalized_username}123!"  # Password temporal para SSO
     }
+    # Si la creación falla de forma transitoria se reintenta la sincronización completa del usuario
+    retry_args = {'moodle_user': MoodleUser.from_json(moodle_data).to_dict(), 'activate_users': activate_users}
     
     try:
         print(f"[CREATE] Creando usuario: {normalized_username}")
-        r = requests.post(url, headers=headers, json=user_data)
+        r = http_client.post(url, headers=headers, json=user_data)
         
         if r.status_code == 200:
             response = r.json()
@@ -678,6 +1312,12 @@ def create_discourse_user(username, moodle_data, dry_run=True, log_filename=None
                 if original_username != normalized_username:
                     print(f"   Username original: {original_username}")
                 print(f"   Nota: Usuario creado inactivo, requiere activación por email")
+                # El caché puede tener el 404 previo a la creación
+                discourse_cache.invalidate(normalized_username)
+                if id_map is not None and response.get("user_id"):
+                    id_map.link(moodle_data.get("id"), response.get("user_id"), normalized_username)
+                discourse_index.add({"id": response.get("user_id"), "username": normalized_username,
+                                     "name": user_data["name"], "email": user_data["email"]})
                 
                 # Obtener información del usuario creado para activación
                 user_id = None
@@ -725,7 +1365,7 @@ def create_discourse_user(username, moodle_data, dry_run=True, log_filename=None
                     # Intentar una vez más después de otro delay
                     print(f"   [INFO] Esperando más tiempo para verificación...")
                     time.sleep(5)
-                    verification_user2 = get_discourse_user(normalized_username, debug=debug)
+                    verification_user2 = get_discourse_user(normalized_username, debug=debug, refresh=True)
                     if verification_user2 and verification_user2.get("id"):
                         print(f"   [OK] Usuario {normalized_username} verificado en segundo intento")
                     else:
@@ -752,6 +1392,8 @@ def create_discourse_user(username, moodle_data, dry_run=True, log_filename=None
         else:
             error_msg = f"{r.status_code} - {r.text}"
             print(f"[ERROR] Error creando usuario {normalized_username}: {error_msg}")
+            if schedule_retry('sync_user', retry_args, status_code=r.status_code):
+                error_msg += " (reintento programado)"
             
             # Log de error
             if log_filename:
@@ -765,13 +1407,16 @@ def create_discourse_user(username, moodle_data, dry_run=True, log_filename=None
             
     except Exception as e:
         print(f"[ERROR] Excepción creando usuario {normalized_username}: {e}")
+        error_msg = str(e)
+        if schedule_retry('sync_user', retry_args, exception=e):
+            error_msg += " (reintento programado)"
         
         # Log de excepción
         if log_filename:
             log_user_action(
                 log_filename, original_username, normalized_username,
                 moodle_data.get('fullname'), moodle_data.get('email'),
-                'CREATE', 'EXCEPTION', f'Excepción: {str(e)}',
+                'CREATE', 'EXCEPTION', f'Excepción: {error_msg}',
                 moodle_data.get('city'), moodle_data.get('country'), moodle_data.get('description')
             )
         return False
@@ -792,75 +1437,351 @@ def sync_user_groups(username, moodle_groups, dry_run=True):
     print(f"   Nota: Sincronización de grupos requiere implementación adicional")
 
 
-def main(dry_run=True, filter_username=None, force_recreate=False, batch_size=None, offset=0, debug=False, activate_users=False):
-    # Crear archivo de log
-    log_filename = create_log_filename(dry_run)
-    write_log_header(log_filename)
-    print(f"[LOG] Log de ejecución: {log_filename}")
-    
-    if debug:
-        print(f"[DEBUG] Modo debug activado - información detallada habilitada")
-    
-    if activate_users:
-        print(f"[ACTIVATE] Activación automática de usuarios habilitada")
-    
-    # Cargar lista de usuarios excluidos
-    excluded_users = load_excluded_users()
-    if excluded_users:
-        print(f"[EXCLUDE] Usuarios excluidos: {', '.join(sorted(excluded_users))}")
-    
-    # Usar batch_size y offset si no se especifica un usuario específico
-    limit = batch_size if not filter_username else None
-    moodle_users = get_moodle_users(filter_username, limit=limit, offset=offset)
-    
-    if not moodle_users:
-        if filter_username:
-            print(f"[WARNING] No se encontró el usuario {filter_username} en Moodle")
-        else:
-            print(f"[WARNING] No se encontraron usuarios en Moodle")
-        return
+def apply_field_changes(discourse_username, mu, discourse_user, dry_run=True):
+    """
+    Calcula con el mapeo de campos (FIELD_MAP) qué cambia para un usuario y lo
+    escribe: el perfil en una sola petición y el email por su endpoint propio.
+    """
+    diff = get_field_map().diff(mu, discourse_user)
+    if dry_run:
+        for key, (old_value, new_value) in diff.preserved.items():
+            print(f"   - {key}: '{old_value}' → '{new_value}' (NO actualizando - campo ya tiene contenido)")
+    changes = dict(diff.changes)
+    new_email = changes.pop("email", None)
+    if changes:
+        update_discourse_user_profile(discourse_username, changes, discourse_user, dry_run=dry_run)
+    if new_email:
+        update_discourse_email(discourse_username, new_email, discourse_user, dry_run=dry_run)
+    return diff
+
+
+def merge_into_existing_user(mu, existing_user, stats, log_filename, dry_run=True, debug=False, activate_users=False):
+    """Actualiza con los datos de Moodle al usuario de Discourse que ya tiene su email. Devuelve True si se actualizó"""
+    original_username = mu.get("username")
+    existing_username = existing_user['username']
+    link_user_ids(mu, existing_user)
+    print(f"   [UPDATE] Actualizando usuario existente {existing_username} con datos de {original_username}")
+    if update_existing_user_with_conflict(existing_username, mu, dry_run=dry_run, log_filename=log_filename, debug=debug, activate_users=activate_users):
+        stats['actualizados'] += 1
+        # Obtener grupos de Moodle para este usuario (usar username original)
+        moodle_groups = get_moodle_groups_for_user(original_username)
+        sync_user_groups(existing_username, moodle_groups, dry_run=dry_run)
+        return True
+    stats['errores'] += 1
+    return False
 
-    # Obtener usuarios de Discourse para comparación
-    discourse_users = get_all_discourse_users()
-    print(f"[STATS] Usuarios en Moodle: {len(moodle_users)}")
-    print(f"[STATS] Usuarios en Discourse: {len(discourse_users)}")
-    
-    # Mostrar información del lote
-    if batch_size and not filter_username:
-        print(f"[BATCH] Procesando lote de {len(moodle_users)} usuarios (límite: {batch_size}, offset: {offset})")
-    elif filter_username:
-        print(f"👤 Procesando usuario específico: {filter_username}")
+
+def process_moodle_user(mu, excluded_users, stats, log_filename, dry_run=True,
+                        force_recreate=False, debug=False, activate_users=False, route=None):
+    """
+    Sincroniza un único usuario de Moodle con Discourse y actualiza las estadísticas.
+
+    route es la ruta decidida por el análisis previo (ver preflight.py), como
+    (ruta, username de destino, conflicto); sin ella se decide aquí como antes.
+
+    Devuelve True si el usuario quedó resuelto o creado en Discourse (no si se
+    excluyó, se saltó por un conflicto o falló).
+    """
+    original_username = mu.get("username")
+    normalized_username = normalize_username(original_username)
+    fullname = mu.get("fullname")
+    city = mu.get("city")
+    country = mu.get("country")
+    description = mu.get("description")
+    email = mu.get("email")
+
+    # Verificar si el usuario está en la lista de excluidos (usar username original)
+    if is_user_excluded(original_username, excluded_users):
+        stats['excluidos'] += 1
+        # Log de usuario excluido
+        log_user_action(
+            log_filename, original_username, normalized_username,
+            fullname, email, 'EXCLUDE', 'EXCLUDED', 'Usuario en lista de excluidos',
+            city, country, description, activated=False
+        )
+        return False
+
+    if route and route[0] == "skip":
+        # Conflicto detectado en el análisis previo (email repetido en Moodle, username ya usado)
+        stats['conflictos'] += 1
+        print(f"[SKIP] {original_username}: {route[2]}")
+        log_user_action(
+            log_filename, original_username, normalized_username,
+            fullname, email, 'SKIP', route[2], 'Conflicto detectado en el análisis previo',
+            city, country, description, activated=False
+        )
+        return False
+
+    if route and route[0] == "merge" and not force_recreate:
+        existing_user = discourse_index.by_username(route[1])
+        if existing_user:
+            print(f"[MERGE] El email de {original_username} pertenece a {route[1]} en Discourse")
+            log_user_action(
+                log_filename, original_username, normalized_username, fullname, email,
+                'CONFLICT', 'EMAIL_EXISTS', f'Email ya existe para usuario {route[1]}',
+                city, country, description, activated=False
+            )
+            return merge_into_existing_user(mu, existing_user, stats, log_filename, dry_run=dry_run,
+                                            debug=debug, activate_users=activate_users)
+
+    # Obtener datos del usuario de Discourse (mapa de IDs, SSO o username normalizado)
+    try:
+        discourse_user = resolve_discourse_user(mu, debug=debug)
+    except requests.RequestException as e:
+        # No se sabe si el usuario mapeado sigue existiendo: ni crear ni desvincular
+        stats['errores'] += 1
+        error_msg = str(e)
+        print(f"[ERROR] No se pudo resolver {original_username} en Discourse: {error_msg}")
+        retry_args = {'moodle_user': MoodleUser.from_json(mu).to_dict(), 'activate_users': activate_users}
+        status_code = e.response.status_code if e.response is not None else None
+        if schedule_retry('sync_user', retry_args, status_code=status_code,
+                          exception=None if status_code is not None else e):
+            error_msg += " (reintento programado)"
+        log_user_action(
+            log_filename, original_username, normalized_username,
+            fullname, email, 'RESOLVE', 'ERROR', error_msg,
+            city, country, description, activated=False
+        )
+        return False
+    user_exists = bool(discourse_user)
+    # Las actualizaciones van al username actual en Discourse (puede diferir si se renombró)
+    discourse_username = discourse_user.get("username") or normalized_username
+
+    if not user_exists or force_recreate:
+        # Usuario no existe en Discourse o forzar recreación
+        if force_recreate and user_exists:
+            print(f"[FORCE] Forzando recreación del usuario {normalized_username}...")
+        else:
+            print(f"[CREATE] Usuario {normalized_username} no existe en Discourse, creando...")
+            if original_username != normalized_username:
+                print(f"   Username original: {original_username}")
+        
+        result = create_discourse_user(original_username, mu, dry_run=dry_run, log_filename=log_filename, debug=debug, activate_users=activate_users)
+        if result is True:
+            stats['creados'] += 1
+            # Obtener grupos de Moodle para este usuario (usar username original)
+            moodle_groups = get_moodle_groups_for_user(original_username)
+            sync_user_groups(normalized_username, moodle_groups, dry_run=dry_run)
+        elif isinstance(result, DiscourseUser) and result.username:
+            # Conflicto de email - actualizar usuario existente
+            return merge_into_existing_user(mu, result, stats, log_filename, dry_run=dry_run,
+                                            debug=debug, activate_users=activate_users)
+        elif result is False:
+            # Usuario no creado por conflicto de email
+            stats['errores'] += 1
+            print(f"   [SKIP] Saltando usuario {normalized_username} debido a conflicto de email")
+            return False
+        else:
+            stats['errores'] += 1
+            return False
     else:
-        print(f"📦 Procesando todos los usuarios disponibles")
+        # Usuario existe, procesar actualizaciones
+        print(f"[UPDATE] Usuario {discourse_username} existe en Discourse, actualizando...")
+        stats['actualizados'] += 1
+        
+        # Log de usuario existente
+        log_user_action(
+            log_filename, original_username, discourse_username,
+            fullname, email, 'UPDATE', 'EXISTS', 'Usuario existe en Discourse, procesando actualizaciones',
+            city, country, description, activated=False
+        )
+
+    apply_field_changes(discourse_username, mu, discourse_user, dry_run=dry_run)
+
+    stats['procesados'] += 1
+    return True
+
+
+def replay_operation(entry, log_filename, debug=False):
+    """Vuelve a ejecutar una operación de la cola de reintentos. Devuelve True si se completó"""
+    operation = entry['operation']
+    args = entry['args']
+    if operation == 'sync_user':
+        mu = MoodleUser.from_json(args['moodle_user'])
+        normalized_username = normalize_username(mu.get("username"))
+        get_discourse_user(normalized_username, debug=debug, refresh=True)
+        stats = new_sync_stats(1)
+        process_moodle_user(mu, load_excluded_users(), stats, log_filename,
+                            dry_run=False, debug=debug, activate_users=args.get('activate_users', False))
+        return stats['errores'] == 0
+    if operation == 'update_profile':
+        return update_discourse_user_profile(args['username'], args['updates'], dry_run=False)
+    if operation == 'update_bio':
+        discourse_user = get_discourse_user(args['username'], debug=debug)
+        return update_discourse_user_bio(args['username'], args['bio_raw'], discourse_user, dry_run=False)
+    if operation == 'update_email':
+        discourse_user = get_discourse_user(args['username'], debug=debug)
+        return update_discourse_email(args['username'], args['email'], discourse_user, dry_run=False)
+    if operation == 'activate_user':
+        return activate_discourse_user(args['user_id'], dry_run=False)
+    print(f"[WARNING] Operación desconocida en la cola de reintentos: {operation}")
+    return False
 
-    # Construir caché de usuarios de Discourse (usar usernames normalizados)
-    moodle_usernames = [normalize_username(mu.get("username")) for mu in moodle_users if mu.get("username")]
-    user_cache = build_discourse_user_cache(moodle_usernames)
 
-    # Inicializar estadísticas
-    stats = {
-        'total': len(moodle_users),
+def drain_retry_queue(log_filename, debug=False):
+    """Reintenta las operaciones vencidas de la cola antes de procesar usuarios nuevos"""
+    if retry_queue is None:
+        return
+    due_entries = retry_queue.pop_due()
+    if not due_entries:
+        return
+
+    print(f"[RETRY] Reintentando {len(due_entries)} operaciones pendientes...")
+    results = {}
+    for entry in due_entries:
+        args = entry['args']
+        username = args.get('username') or args.get('moodle_user', {}).get('username') or str(args.get('user_id', ''))
+        print(f"[RETRY] {entry['operation']} para {username} (intento {entry['attempts'] + 1})")
+        # Los fallos dentro del reintento se registran sobre esta misma entrada
+        with retry_queue.replaying(entry):
+            try:
+                if not replay_operation(entry, log_filename, debug=debug):
+                    # Los errores transitorios ya se registraron con schedule_retry; si no se
+                    # registró nada, el fallo no fue transitorio (conflicto, validación...)
+                    retry_queue.record_permanent_failure(entry['operation'], args, "el reintento volvió a fallar")
+            except Exception as e:
+                print(f"[ERROR] Excepción reintentando {entry['operation']} para {username}: {e}")
+                if is_transient_error(exception=e):
+                    retry_queue.record_failure(entry['operation'], args, e)
+                else:
+                    retry_queue.record_permanent_failure(entry['operation'], args, e)
+        status = retry_queue.finish(entry)
+        results[status] = results.get(status, 0) + 1
+        log_user_action(
+            log_filename, username, normalize_username(username), None, None,
+            'RETRY', status, f"{entry['operation']} (intento {entry['attempts'] + 1}, último error: {entry['last_error']})"
+        )
+
+    print("[RETRY] Resultado: " + ", ".join(f"{status}: {count}" for status, count in sorted(results.items())))
+    save_retry_queue()
+    save_id_map()
+    if len(retry_queue):
+        print(f"[RETRY] Operaciones pendientes en la cola: {len(retry_queue)}")
+
+
+def resolve_avatar_target(moodle_user):
+    """(ID, username) en Discourse de un usuario ya sincronizado, según el mapa de IDs"""
+    mapped = id_map.lookup(moodle_user.get("id")) if id_map is not None else None
+    return (mapped['discourse_id'], mapped['username']) if mapped else None
+
+
+def new_sync_stats(total):
+    """Diccionario de estadísticas que actualiza process_moodle_user"""
+    return {
+        'total': total,
         'procesados': 0,
         'creados': 0,
         'actualizados': 0,
         'excluidos': 0,
-        'errores': 0
+        'errores': 0,
+        'conflictos': 0,
+        'en_cola': 0
     }
+
+
+def defer_moodle_users(moodle_users, reason, log_filename, activate_users=False):
+    """
+    Encola usuarios sin procesarlos (circuito de Discourse abierto o deadline de
+    la ejecución vencido) para que la próxima ejecución los sincronice primero.
+    """
+    if retry_queue is None:
+        print(f"[WARNING] {len(moodle_users)} usuarios sin procesar ({reason}); en dry-run no se encolan")
+        return 0
+    for mu in moodle_users:
+        retry_args = {'moodle_user': MoodleUser.from_json(mu).to_dict(), 'activate_users': activate_users}
+        retry_queue.defer('sync_user', retry_args, reason, save=False)
+        log_user_action(
+            log_filename, mu.get("username"), normalize_username(mu.get("username")),
+            mu.get("fullname"), mu.get("email"), 'QUEUE', 'DEFERRED', reason,
+            mu.get("city"), mu.get("country"), mu.get("description")
+        )
+    retry_queue.save()
+    print(f"[RETRY] {len(moodle_users)} usuarios encolados para la próxima ejecución ({reason})")
+    return len(moodle_users)
+
+
+def run_sync(moodle_users, excluded_users, log_filename, dry_run=True, force_recreate=False,
+             debug=False, activate_users=False, checkpoint_filename=None, shard=None, processed_ids=None,
+             stop_event=None, progress_callback=None, deadline=None, plan=None):
+    """
+    Sincroniza una lista de usuarios de Moodle y devuelve las estadísticas de la ejecución.
+
+    plan (PreflightPlan, opcional) indica la ruta de cada usuario decidida por
+    el análisis previo.
+
+    Con avatar_sync_enabled, cada usuario procesado se encola en una etapa de
+    avatares (AvatarStage) con sus propios hilos, para que las descargas y
+    subidas de imágenes no frenen la actualización de perfiles.
+
+    Si se indica stop_event (threading.Event), la sincronización se detiene de forma
+    ordenada al terminar el usuario en curso. progress_callback(procesados, stats)
+    se invoca después de cada usuario.
+
+    Si el circuito de Discourse se abre, la sincronización hace una pausa hasta la
+    siguiente prueba de recuperación; si sigue caído tras CIRCUIT_MAX_PAUSES pausas,
+    o si se alcanza `deadline` (timestamp), los usuarios restantes se encolan en la
+    cola de reintentos en lugar de procesarse.
+    """
+    # Inicializar estadísticas
+    stats = new_sync_stats(len(moodle_users))
     
     start_time = time.time()
     last_summary_time = start_time
+    interrupted = False
+    discourse_breaker = http_client.get_breaker('discourse')
+    max_circuit_pauses = getattr(settings, 'CIRCUIT_MAX_PAUSES', 3)
+    circuit_pauses = 0
+
+    avatar_stage = AvatarStage(resolve_avatar_target, dry_run=dry_run) if avatar_sync_enabled else None
+
+    # IDs procesados desde el último guardado del checkpoint
+    unsaved_ids = []
 
     # Crear barra de progreso
     progress_bar = tqdm(total=stats['total'], desc="Sincronizando usuarios", unit="usuario")
 
     for i, mu in enumerate(moodle_users):
-        original_username = mu.get("username")
-        normalized_username = normalize_username(original_username)
-        fullname = mu.get("fullname")
-        city = mu.get("city")
-        country = mu.get("country")
-        description = mu.get("description")
-        email = mu.get("email")
+        # Parada ordenada (modo daemon): terminar después del usuario en curso
+        if stop_event is not None and stop_event.is_set():
+            interrupted = True
+            print(f"\n[STOP] Sincronización interrumpida tras {i} usuarios")
+            break
+
+        if deadline is not None and time.time() >= deadline:
+            print(f"\n[DEADLINE] Tiempo máximo de ejecución alcanzado tras {i} usuarios")
+            deferred = defer_moodle_users(moodle_users[i:], "deadline de la ejecución alcanzado",
+                                          log_filename, activate_users=activate_users)
+            stats['en_cola'] += deferred
+            if checkpoint_filename and deferred:
+                # Ya están en la cola: --resume no debe volver a procesarlos
+                unsaved_ids.extend(mu.get("id") for mu in moodle_users[i:])
+            interrupted = True
+            break
+
+        if discourse_breaker.is_open():
+            if circuit_pauses >= max_circuit_pauses:
+                print(f"\n[CIRCUIT] Discourse sigue sin responder tras {circuit_pauses} pausas")
+                deferred = defer_moodle_users(moodle_users[i:], "circuito de Discourse abierto",
+                                              log_filename, activate_users=activate_users)
+                stats['en_cola'] += deferred
+                if checkpoint_filename and deferred:
+                    unsaved_ids.extend(mu.get("id") for mu in moodle_users[i:])
+                interrupted = True
+                break
+            circuit_pauses += 1
+            wait_time = discourse_breaker.seconds_until_probe()
+            if deadline is not None:
+                wait_time = min(wait_time, max(0, deadline - time.time()))
+            print(f"\n[CIRCUIT] Pausa de {wait_time:.0f}s antes de probar la recuperación de Discourse")
+            if stop_event is not None:
+                stop_event.wait(wait_time)
+            else:
+                time.sleep(wait_time)
+            # El siguiente usuario hace de petición de prueba
+        elif discourse_breaker.state == "closed":
+            circuit_pauses = 0
+
+        normalized_username = normalize_username(mu.get("username"))
 
         # Actualizar barra de progreso
         progress_bar.set_postfix({
@@ -868,102 +1789,31 @@ def main(dry_run=True, filter_username=None, force_recreate=False, batch_size=No
             'Procesados': f"{i+1}/{stats['total']}"
         })
 
-        # Verificar si el usuario está en la lista de excluidos (usar username original)
-        if is_user_excluded(original_username, excluded_users):
-            stats['excluidos'] += 1
-            # Log de usuario excluido
-            log_user_action(
-                log_filename, original_username, normalized_username,
-                fullname, email, 'EXCLUDE', 'EXCLUDED', 'Usuario en lista de excluidos',
-                city, country, description, activated=False
-            )
-            progress_bar.update(1)
-            continue
-
-        # Obtener datos del usuario de Discourse desde el caché (usar username normalizado)
-        discourse_user = user_cache.get(normalized_username, {})
-        user_exists = bool(discourse_user)
-
-        if not user_exists or force_recreate:
-            # Usuario no existe en Discourse o forzar recreación
-            if force_recreate and user_exists:
-                print(f"[FORCE] Forzando recreación del usuario {normalized_username}...")
-            else:
-                print(f"[CREATE] Usuario {normalized_username} no existe en Discourse, creando...")
-                if original_username != normalized_username:
-                    print(f"   Username original: {original_username}")
-            
-            result = create_discourse_user(original_username, mu, dry_run=dry_run, log_filename=log_filename, debug=debug, activate_users=activate_users)
-            if result is True:
-                stats['creados'] += 1
-                # Obtener grupos de Moodle para este usuario (usar username original)
-                moodle_groups = get_moodle_groups_for_user(original_username)
-                sync_user_groups(normalized_username, moodle_groups, dry_run=dry_run)
-            elif isinstance(result, dict) and 'username' in result:
-                # Conflicto de email - actualizar usuario existente
-                existing_username = result['username']
-                print(f"   [UPDATE] Actualizando usuario existente {existing_username} con datos de {original_username}")
-                if update_existing_user_with_conflict(existing_username, mu, dry_run=dry_run, log_filename=log_filename, debug=debug, activate_users=activate_users):
-                    stats['actualizados'] += 1
-                    # Obtener grupos de Moodle para este usuario (usar username original)
-                    moodle_groups = get_moodle_groups_for_user(original_username)
-                    sync_user_groups(existing_username, moodle_groups, dry_run=dry_run)
-                else:
-                    stats['errores'] += 1
-                progress_bar.update(1)
-                continue
-            elif result is False:
-                # Usuario no creado por conflicto de email
-                stats['errores'] += 1
-                print(f"   [SKIP] Saltando usuario {normalized_username} debido a conflicto de email")
-            else:
-                stats['errores'] += 1
-                progress_bar.update(1)
-                continue
-        else:
-            # Usuario existe, procesar actualizaciones
-            print(f"[UPDATE] Usuario {normalized_username} existe en Discourse, actualizando...")
-            stats['actualizados'] += 1
-            
-            # Log de usuario existente
-            log_user_action(
-                log_filename, original_username, normalized_username,
-                fullname, email, 'UPDATE', 'EXISTS', 'Usuario existe en Discourse, procesando actualizaciones',
-                city, country, description, activated=False
-            )
-
-        # Construcción del location con conversión de código de país
-        location = None
-        country_name = get_country_name(country) if country else None
-        
-        if city and country_name:
-            location = f"{city}, {country_name}"
-        elif country_name:
-            location = country_name
-        elif city:
-            location = city
-
-        # Solo actualizar campos que estén vacíos en Discourse
-        profile_updates = {}
-        if fullname and should_update_field(fullname, discourse_user.get("name")):
-            profile_updates["name"] = fullname
-        if location and should_update_field(location, discourse_user.get("location")):
-            profile_updates["location"] = location
-
-        if profile_updates:
-            update_discourse_user_profile(normalized_username, profile_updates, discourse_user, dry_run=dry_run)
-
-        # Actualizar biografía solo si está vacía en Discourse
-        if description and should_update_field(description, discourse_user.get("bio_raw")):
-            update_discourse_user_bio(normalized_username, description, discourse_user, dry_run=dry_run)
-
-        # Actualizar email solo si está vacío en Discourse
-        discourse_email = discourse_user.get("email")
-        if email and should_update_field(email, discourse_email):
-            update_discourse_email(normalized_username, email, discourse_user, dry_run=dry_run)
-
-        stats['procesados'] += 1
+        errors_before = stats['errores']
+        scheduled_before = retry_queue.scheduled_count if retry_queue is not None else 0
+        synced = process_moodle_user(mu, excluded_users, stats, log_filename, dry_run=dry_run,
+                                     force_recreate=force_recreate, debug=debug, activate_users=activate_users,
+                                     route=plan.route_for(mu) if plan else None)
+        # Un usuario con error cuenta como hecho solo si su reintento quedó en la cola
+        user_done = stats['errores'] == errors_before or (
+            retry_queue is not None and retry_queue.scheduled_count > scheduled_before)
+        # El avatar solo se sube a un usuario resuelto o creado en Discourse
+        if avatar_stage is not None and synced:
+            avatar_stage.submit(mu)
         progress_bar.update(1)
+        if progress_callback:
+            progress_callback(i + 1, stats)
+
+        if checkpoint_filename:
+            if user_done:
+                processed_ids.add(mu.get("id"))
+                unsaved_ids.append(mu.get("id"))
+            if (i + 1) % CHECKPOINT_INTERVAL == 0:
+                # La cola primero: el checkpoint da por hechos a los usuarios con reintento encolado
+                save_retry_queue()
+                save_checkpoint(checkpoint_filename, unsaved_ids, stats)
+                unsaved_ids = []
+                save_id_map()
 
         # Mostrar resumen cada 50 usuarios o cada 5 minutos
         current_time = time.time()
@@ -985,10 +1835,23 @@ def main(dry_run=True, filter_username=None, force_recreate=False, batch_size=No
 
     # Cerrar barra de progreso
     progress_bar.close()
+    if avatar_stage is not None:
+        print("[AVATAR] Esperando las subidas de avatares pendientes...")
+        stats['avatares'] = avatar_stage.close()
+    save_retry_queue()
+    save_id_map()
+    
+    if checkpoint_filename:
+        save_checkpoint(checkpoint_filename, unsaved_ids, stats, completed=not interrupted)
+        if not interrupted:
+            print(f"[CHECKPOINT] Shard completado: {checkpoint_filename}")
     
     # Mostrar resumen final
     total_time = time.time() - start_time
-    print(f"\n[SUCCESS] SINCRONIZACIÓN COMPLETADA")
+    if interrupted:
+        print("\n[STOP] SINCRONIZACIÓN INTERRUMPIDA")
+    else:
+        print("\n[SUCCESS] SINCRONIZACIÓN COMPLETADA")
     print(f"[TIME] Tiempo total: {total_time/60:.1f} minutos")
     print(f"[STATS] Estadísticas finales:")
     print(f"   Total procesados: {stats['procesados']}")
@@ -996,11 +1859,592 @@ def main(dry_run=True, filter_username=None, force_recreate=False, batch_size=No
     print(f"   Usuarios actualizados: {stats['actualizados']}")
     print(f"   Usuarios excluidos: {stats['excluidos']}")
     print(f"   Errores: {stats['errores']}")
+    if stats['conflictos']:
+        print(f"   Omitidos por conflictos: {stats['conflictos']}")
+    if stats['en_cola']:
+        print(f"   Encolados para la próxima ejecución: {stats['en_cola']}")
+    if stats.get('avatares'):
+        print("   Avatares: " + ", ".join(f"{result}: {count}" for result, count in sorted(stats['avatares'].items())))
+    hedge = http_client.hedge_metrics()
+    if hedge['requests']:
+        print(f"   Lecturas con hedging: {hedge['requests']} "
+              f"(duplicadas: {hedge['hedged']} = {hedge['hedged'] / hedge['requests'] * 100:.1f}%, "
+              f"ganadas por el duplicado: {hedge['hedge_wins']}, ahorro: {hedge['saved_seconds']:.1f}s)")
+        stats['hedging'] = hedge
+    credentials = http_client.credential_metrics()
+    if credentials:
+        print("   Peticiones por API key: " + ", ".join(
+            f"{label}: {metrics['requests']}" + (f" ({metrics['throttles']} pausas por 429)" if metrics['throttles'] else "")
+            + (" [revocada]" if metrics['revoked'] else "")
+            for label, metrics in credentials.items()))
+        stats['api_keys'] = credentials
+    lookups = dict(discourse_cache.stats)
+    if sum(lookups.values()):
+        print(f"   Consultas a Discourse evitadas por el caché: {lookups['hits'] + lookups['negative_hits']} "
+              f"(encontrados: {lookups['hits']}, 404 cacheados: {lookups['negative_hits']}, "
+              f"consultas reales: {lookups['misses']})")
+        stats['lookup_cache'] = lookups
     if stats['procesados'] > 0:
         print(f"   Tiempo promedio por usuario: {total_time/stats['procesados']:.2f} segundos")
     else:
         print(f"   Tiempo promedio por usuario: N/A (no se procesaron usuarios)")
 
+    stats['tiempo_total'] = total_time
+    stats['interrumpido'] = interrupted
+    return stats
+
+
+def run_preflight(moodle_users, excluded_users, dry_run=True, shard=None):
+    """
+    Analiza el lote completo contra el índice de Discourse antes de escribir nada:
+    muestra cuántos usuarios se crearán, actualizarán, fusionarán u omitirán y
+    guarda los conflictos en un reporte CSV. Devuelve el PreflightPlan.
+    """
+    plan = analyze_batch(moodle_users, excluded_users, discourse_index, normalize_username, id_map=id_map)
+    print(f"[PREFLIGHT] Crear: {plan.counts['create']}, actualizar: {plan.counts['update']}, "
+          f"fusionar por email: {plan.counts['merge']}, omitir: {plan.counts['skip']}")
+    conflict_counts = plan.conflict_counts()
+    if conflict_counts:
+        print("[PREFLIGHT] Conflictos: " + ", ".join(f"{conflict}: {count}" for conflict, count in sorted(conflict_counts.items())))
+        report_filename = create_preflight_report_filename(dry_run, shard)
+        plan.write_report(report_filename)
+        print(f"[PREFLIGHT] Reporte de conflictos: {report_filename}")
+    return plan
+
+
+def run_reconcile(live_moodle_users, excluded_users, dry_run=True, action=None, scope=None):
+    """
+    Busca las cuentas de Discourse cuyo usuario de Moodle ya no existe o está
+    suspendido (ver reconcile.py) y, según `action`, solo las reporta
+    ('report') o las suspende/desactiva ('suspend'/'deactivate') en lotes de
+    ORPHAN_BATCH_SIZE. Todo queda en un log CSV propio.
+
+    Las cuentas ya tratadas en ejecuciones anteriores se recuerdan en
+    sync_orphans_{ENV}.json y no se vuelven a tocar. Si los huérfanos superan
+    ORPHAN_MAX_FRACTION de los usuarios de Discourse no se aplica ninguna
+    acción (probable listado incompleto de Moodle).
+    """
+    action = action or getattr(settings, 'ORPHAN_ACTION', 'report')
+    scope = scope or getattr(settings, 'ORPHAN_SCOPE', 'mapped')
+    batch_size = getattr(settings, 'ORPHAN_BATCH_SIZE', 50)
+    max_fraction = getattr(settings, 'ORPHAN_MAX_FRACTION', 0.1)
+    reason = getattr(settings, 'ORPHAN_SUSPEND_REASON', "Usuario dado de baja o suspendido en Moodle")
+
+    if not load_discourse_index(force=True):
+        print("[ERROR] No se pudo cargar el listado de usuarios de Discourse")
+        return None
+    try:
+        orphans = find_orphans(live_moodle_users, discourse_index.users(), normalize_username,
+                               id_map=id_map, excluded_users=excluded_users, scope=scope)
+    except RuntimeError as e:
+        print(f"[ERROR] {e}")
+        return None
+
+    state = StateStore(default_orphans_filename())
+    handled = state.section('orphans')
+    orphan_ids = {str(orphan['discourse_id']) for orphan in orphans}
+    for discourse_id in [key for key in handled if key not in orphan_ids]:
+        # Volvió a estar vivo en Moodle (o ya no existe en Discourse): revisar a mano
+        print(f"[ORPHANS] {handled[discourse_id]['username']} ya no es huérfano "
+              f"(tratado con '{handled[discourse_id]['action']}'), revisar si hay que reactivarlo")
+        del handled[discourse_id]
+    pending = [orphan for orphan in orphans if str(orphan['discourse_id']) not in handled]
+
+    print(f"[ORPHANS] Usuarios de Discourse sin usuario vivo en Moodle: {len(orphans)} "
+          f"(alcance: {scope}, ya tratados: {len(orphans) - len(pending)}, pendientes: {len(pending)})")
+
+    if action != 'report' and len(discourse_index) and len(pending) > max_fraction * len(discourse_index):
+        print(f"[ERROR] {len(pending)} huérfanos superan el {max_fraction:.0%} de los usuarios de Discourse: "
+              f"no se aplica '{action}' (revisar el listado de Moodle o subir ORPHAN_MAX_FRACTION)")
+        action = 'report'
+
+    log_filename = create_orphans_log_filename(dry_run)
+    results = {}
+    with open(log_filename, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=ORPHAN_LOG_FIELDNAMES)
+        writer.writeheader()
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            if action != 'report':
+                print(f"[ORPHANS] Lote {start // batch_size + 1}: {len(batch)} usuarios ({action})")
+            for orphan in batch:
+                indexed = discourse_index.by_username(orphan['username'])
+                email = orphan['email'] or (indexed.email if indexed else None)
+                if action == 'suspend':
+                    ok = suspend_discourse_user(orphan['discourse_id'], reason, dry_run=dry_run)
+                elif action == 'deactivate':
+                    ok = deactivate_discourse_user(orphan['discourse_id'], dry_run=dry_run)
+                else:
+                    ok = True
+                status = 'REPORTED' if action == 'report' else ('DRY_RUN' if dry_run else ('SUCCESS' if ok else 'ERROR'))
+                results[status] = results.get(status, 0) + 1
+                if action != 'report' and ok and not dry_run:
+                    handled[str(orphan['discourse_id'])] = {
+                        'username': orphan['username'], 'action': action,
+                        'at': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    }
+                writer.writerow({
+                    'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    'discourse_id': orphan['discourse_id'],
+                    'discourse_username': orphan['username'],
+                    'email': email,
+                    'moodle_id': orphan['moodle_id'],
+                    'reason': orphan['reason'],
+                    'action': action.upper(),
+                    'status': status,
+                })
+            csvfile.flush()
+            if not dry_run:
+                state.save()
+
+    if not dry_run:
+        state.save()
+    print("[ORPHANS] Resultado: " + (", ".join(f"{status}: {count}" for status, count in sorted(results.items())) or "sin huérfanos pendientes"))
+    print(f"[LOG] Log de huérfanos: {log_filename}")
+    return results
+
+
+def install_stop_handlers(stop_event, label):
+    """Hace que SIGTERM/SIGINT activen stop_event para una parada ordenada"""
+    def handle_signal(signum, frame):
+        print(f"\n[{label}] Señal {signum} recibida, deteniendo tras el usuario en curso...")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+
+class DaemonStatus:
+    """Estado del modo daemon expuesto por el endpoint local de estado"""
+
+    def __init__(self, interval):
+        self._lock = threading.Lock()
+        self.interval = interval
+        self.started_at = datetime.now()
+        self.state = "starting"
+        self.runs = 0
+        self.last_run_started = None
+        self.last_run_finished = None
+        self.last_run_stats = None
+        self.last_error = None
+        self.queue_depth = 0
+        self.total_processed = 0
+        self.total_sync_seconds = 0.0
+        self._run_start_time = None
+
+    def start_run(self, queued):
+        with self._lock:
+            self.state = "running"
+            self.last_run_started = datetime.now()
+            self.queue_depth = queued
+            self._run_start_time = time.time()
+
+    def progress(self, processed, stats):
+        with self._lock:
+            self.queue_depth = stats['total'] - processed
+
+    def finish_run(self, stats):
+        with self._lock:
+            self.state = "idle"
+            self.runs += 1
+            self.last_run_finished = datetime.now()
+            self.last_run_stats = stats
+            self.queue_depth = 0
+            if stats:
+                self.total_processed += stats['procesados']
+                self.total_sync_seconds += stats.get('tiempo_total', 0)
+
+    def record_error(self, error):
+        with self._lock:
+            self.state = "idle"
+            self.last_error = f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}: {error}"
+            self.queue_depth = 0
+
+    def to_dict(self):
+        def fmt(value):
+            return value.strftime("%Y-%m-%d %H:%M:%S") if value else None
+
+        with self._lock:
+            throughput = None
+            if self.total_sync_seconds > 0:
+                throughput = round(self.total_processed / (self.total_sync_seconds / 60), 2)
+            return {
+                'state': self.state,
+                'env': getattr(settings, 'ENV', 'unknown'),
+                'started_at': fmt(self.started_at),
+                'interval_seconds': self.interval,
+                'runs': self.runs,
+                'last_run_started': fmt(self.last_run_started),
+                'last_run_finished': fmt(self.last_run_finished),
+                'last_run_stats': self.last_run_stats,
+                'last_error': self.last_error,
+                'queue_depth': self.queue_depth,
+                'total_processed': self.total_processed,
+                'throughput_users_per_minute': throughput,
+            }
+
+
+class StatusRequestHandler(BaseHTTPRequestHandler):
+    """Responde GET /status con el estado del daemon en JSON"""
+
+    def do_GET(self):
+        if self.path.rstrip('/') not in ('', '/status'):
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.daemon_status.to_dict(), ensure_ascii=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # No ensuciar la salida del daemon con cada consulta de estado
+        pass
+
+
+def start_status_server(daemon_status, port):
+    """Inicia el endpoint de estado en 127.0.0.1:port en un hilo en segundo plano"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), StatusRequestHandler)
+    server.daemon_status = daemon_status
+    thread = threading.Thread(target=server.serve_forever, name="status-server", daemon=True)
+    thread.start()
+    print(f"[DAEMON] Endpoint de estado en http://127.0.0.1:{port}/status")
+    return server
+
+
+def run_daemon(dry_run=True, force_recreate=False, debug=False, activate_users=False, shard=None,
+               interval=None, status_port=None, from_db=True):
+    """
+    Ejecuta la sincronización como proceso de larga duración.
+
+    Mantiene en memoria la sesión HTTP, el caché de usuarios de Discourse y el
+    almacén de estado, y cada `interval` segundos sincroniza solo los usuarios de
+    Moodle modificados (timemodified) desde la última ejecución completa.
+    SIGTERM/SIGINT detienen el daemon de forma ordenada al terminar el usuario en curso.
+
+    Necesita la lectura desde la base de datos (from_db): el web service no
+    devuelve timemodified, y sin él cada ciclo sería una sincronización completa
+    con una consulta a Discourse por usuario. Lanza ValueError sin from_db.
+    """
+    if not from_db:
+        raise ValueError("el modo daemon necesita --from-db (el web service no devuelve timemodified)")
+    if interval is None:
+        interval = getattr(settings, 'DAEMON_INTERVAL', 900)
+    if status_port is None:
+        status_port = getattr(settings, 'DAEMON_STATUS_PORT', 8765)
+
+    stop_event = threading.Event()
+    install_stop_handlers(stop_event, "DAEMON")
+
+    mode = "dryrun" if dry_run else "apply"
+    last_sync_key = f"last_sync_time_{mode}{shard_suffix(shard)}"
+    state = StateStore()
+    init_retry_queue(dry_run)
+    init_id_map()
+    daemon_status = DaemonStatus(interval)
+    server = start_status_server(daemon_status, status_port) if status_port else None
+    cache_warm = False
+
+    print(f"[DAEMON] Sincronización incremental cada {interval} segundos (modo: {mode})")
+
+    while not stop_event.is_set():
+        run_started = int(time.time())
+        try:
+            excluded_users = load_excluded_users()
+            last_sync = state.get(last_sync_key)
+            # El filtro por timemodified se aplica en la propia consulta
+            moodle_users = get_moodle_users_from_db(shard=shard, modified_since=last_sync)
+            changed_users = moodle_users
+            if last_sync:
+                print(f"[DAEMON] {len(changed_users)} usuarios modificados desde {datetime.fromtimestamp(last_sync)}")
+            else:
+                print(f"[DAEMON] Primera ejecución: sincronización completa de {len(changed_users)} usuarios")
+
+            changed_usernames = [normalize_username(mu.get("username")) for mu in changed_users if mu.get("username")]
+            if not cache_warm:
+                # Primera vez: construir el caché completo y mantenerlo caliente
+                build_discourse_user_cache(
+                    [normalize_username(mu.get("username")) for mu in moodle_users if mu.get("username")]
+                )
+                cache_warm = True
+            elif changed_usernames:
+                refresh_discourse_user_cache(changed_usernames, debug=debug)
+
+            stats = None
+            daemon_status.start_run(len(changed_users))
+            if changed_users or (retry_queue is not None and retry_queue.due_count()):
+                log_filename = create_log_filename(dry_run, shard)
+                write_log_header(log_filename)
+                print(f"[LOG] Log de ejecución: {log_filename}")
+                drain_retry_queue(log_filename, debug=debug)
+            if changed_users:
+                stats = run_sync(changed_users, excluded_users, log_filename, dry_run=dry_run,
+                                 force_recreate=force_recreate, debug=debug, activate_users=activate_users,
+                                 stop_event=stop_event, progress_callback=daemon_status.progress)
+            daemon_status.finish_run(stats)
+
+            # Solo avanzar la marca incremental si la ejecución terminó completa
+            if not stop_event.is_set():
+                state.set(last_sync_key, run_started)
+                state.save()
+        except Exception as e:
+            print(f"[ERROR] Error en la ejecución del daemon: {e}")
+            daemon_status.record_error(e)
+
+        stop_event.wait(interval)
+
+    # Apagado ordenado
+    print("[DAEMON] Deteniendo daemon...")
+    if server:
+        server.shutdown()
+        server.server_close()
+    state.save()
+    http_client.close_session()
+    sys.stdout.flush()
+    print("[DAEMON] Daemon detenido")
+
+
+def run_event_receiver(dry_run=True, force_recreate=False, debug=False, activate_users=False,
+                       port=None, debounce=None):
+    """
+    Sincroniza usuarios casi en tiempo real a partir de eventos de Moodle.
+
+    Levanta el receptor local de eventos (moodle_events) y, a medida que vencen
+    los debounces, trae de Moodle solo los usuarios afectados y los sincroniza
+    con process_moodle_user, sin recorrer la lista completa de usuarios.
+    """
+    if port is None:
+        port = getattr(settings, 'EVENTS_PORT', 8770)
+    if debounce is None:
+        debounce = getattr(settings, 'EVENTS_DEBOUNCE', 5)
+    host = getattr(settings, 'EVENTS_HOST', '127.0.0.1')
+
+    stop_event = threading.Event()
+    install_stop_handlers(stop_event, "EVENTS")
+
+    event_queue = UserEventQueue(debounce=debounce)
+    server = start_event_server(event_queue, port, secret=getattr(settings, 'EVENTS_SECRET', None), host=host)
+    print(f"[EVENTS] Recibiendo eventos de Moodle en http://{host}:{port}/events (debounce: {debounce}s)")
+
+    log_filename = create_log_filename(dry_run)
+    write_log_header(log_filename)
+    print(f"[LOG] Log de ejecución: {log_filename}")
+
+    stats = new_sync_stats(0)
+    init_retry_queue(dry_run)
+    init_id_map()
+
+    while not stop_event.is_set():
+        drain_retry_queue(log_filename, debug=debug)
+        due_events = event_queue.pop_due(timeout=1.0)
+        if not due_events:
+            continue
+
+        deleted_ids = [user_id for event_type, user_id in due_events if event_type == "user_deleted"]
+        sync_ids = [user_id for event_type, user_id in due_events if event_type != "user_deleted"]
+
+        for user_id in deleted_ids:
+            # La baja en Discourse no se aplica automáticamente, solo se registra
+            print(f"[EVENTS] Usuario de Moodle {user_id} eliminado, registrado en el log")
+            log_user_action(
+                log_filename, str(user_id), None, None, None,
+                'DELETE', 'SKIPPED', f'Evento user_deleted para el ID de Moodle {user_id}'
+            )
+
+        if not sync_ids:
+            continue
+
+        try:
+            excluded_users = load_excluded_users()
+            moodle_users = get_moodle_users_by_field("id", sync_ids)
+        except Exception as e:
+            print(f"[ERROR] Error obteniendo usuarios {sync_ids} de Moodle: {e}")
+            for user_id in sync_ids:
+                event_queue.put("user_updated", user_id)
+            continue
+
+        missing_ids = set(sync_ids) - {mu.get("id") for mu in moodle_users}
+        for user_id in missing_ids:
+            print(f"[WARNING] Usuario de Moodle {user_id} no encontrado, se ignora el evento")
+
+        usernames = [normalize_username(mu.get("username")) for mu in moodle_users if mu.get("username")]
+        # Incluir el username mapeado en Discourse de los usuarios renombrados
+        usernames += [entry['username'] for entry in (id_map.lookup(mu.get("id")) for mu in moodle_users)
+                      if entry and entry['username'] not in usernames]
+        refresh_discourse_user_cache(usernames, debug=debug)
+        stats['total'] += len(moodle_users)
+        for mu in moodle_users:
+            print(f"[EVENTS] Sincronizando usuario {mu.get('username')} (ID {mu.get('id')})")
+            process_moodle_user(mu, excluded_users, stats, log_filename, dry_run=dry_run,
+                                force_recreate=force_recreate, debug=debug, activate_users=activate_users)
+        save_retry_queue()
+        save_id_map()
+
+    print("[EVENTS] Deteniendo receptor de eventos...")
+    server.shutdown()
+    server.server_close()
+    http_client.close_session()
+    print(f"[STATS] Usuarios sincronizados: {stats['procesados']}, creados: {stats['creados']}, "
+          f"actualizados: {stats['actualizados']}, errores: {stats['errores']}")
+    if len(event_queue):
+        print(f"[WARNING] {len(event_queue)} eventos pendientes no se procesaron")
+    sys.stdout.flush()
+
+
+def main(dry_run=True, filter_username=None, force_recreate=False, batch_size=None, offset=0, debug=False, activate_users=False,
+         shard=None, retry_failed=False, deadline_seconds=None, users_file=None, courses=None,
+         export_file=None, from_db=False, modified_since=None, preflight_only=False,
+         reconcile=False, orphan_action=None, orphan_scope=None, resume=False, stop_event=None,
+         progress_callback=None):
+    """
+    Ejecución completa desde la línea de comandos. Devuelve las estadísticas de
+    la sincronización (None si no se llegó a sincronizar).
+
+    resume guarda un checkpoint como con --shard, para que una ejecución
+    detenida con stop_event continúe la próxima vez donde quedó (sync_tenants.py).
+    """
+    global offline_source
+    # Deadline total de la ejecución (timestamp), desde --deadline o settings.RUN_DEADLINE
+    if deadline_seconds is None:
+        deadline_seconds = getattr(settings, 'RUN_DEADLINE', None)
+    deadline = time.time() + deadline_seconds if deadline_seconds else None
+
+    # Crear archivo de log
+    log_filename = create_log_filename(dry_run, shard)
+    write_log_header(log_filename)
+    print(f"[LOG] Log de ejecución: {log_filename}")
+    
+    if shard:
+        print(f"[SHARD] Procesando shard {shard[0]}/{shard[1]}")
+    
+    if debug:
+        print("[DEBUG] Modo debug activado - información detallada habilitada")
+    
+    if activate_users:
+        print("[ACTIVATE] Activación automática de usuarios habilitada")
+    
+    # Validar el mapeo de campos (FIELD_MAP) antes de leer usuarios
+    get_field_map()
+
+    # Cargar lista de usuarios excluidos
+    excluded_users = load_excluded_users()
+    if excluded_users:
+        print(f"[EXCLUDE] Usuarios excluidos: {', '.join(sorted(excluded_users))}")
+    
+    init_id_map()
+
+    # Reintentar primero las operaciones fallidas de ejecuciones anteriores
+    if init_retry_queue(dry_run) is not None:
+        if retry_failed:
+            requeued = retry_queue.requeue_dead_letters()
+            print(f"[RETRY] {requeued} operaciones recuperadas de {retry_queue.dead_letter_filename}")
+        drain_retry_queue(log_filename, debug=debug)
+        if retry_failed:
+            return
+    elif retry_failed:
+        print("[WARNING] --retry-failed requiere --apply, no se reintentará nada en modo dry-run")
+        return
+
+    if reconcile:
+        # Bajas: cuentas de Discourse sin usuario vivo en Moodle (se necesita el listado completo)
+        run_reconcile(iter_live_moodle_users(export_file, from_db), excluded_users, dry_run=dry_run,
+                      action=orphan_action, scope=orphan_scope)
+        return
+    
+    if export_file:
+        # Carga sin web service: usuarios leídos de una exportación de Moodle
+        offline_source = True
+        moodle_users = get_moodle_users_from_export(export_file, filter_username, limit=batch_size if not filter_username else None,
+                                                    offset=offset, shard=shard)
+    elif from_db:
+        # Lectura directa de la réplica de la base de datos de Moodle
+        moodle_users = get_moodle_users_from_db(filter_username, limit=batch_size if not filter_username else None,
+                                                offset=offset, shard=shard, modified_since=modified_since)
+    elif users_file:
+        # Lista explícita de usuarios: sin lote ni offset
+        try:
+            moodle_users = get_moodle_users_from_file(users_file, shard=shard)
+        except ValueError as e:
+            print(f"[ERROR] {e}")
+            return
+    elif courses:
+        # Solo usuarios matriculados en los cursos indicados
+        moodle_users = get_moodle_users_by_courses(courses, limit=batch_size, offset=offset, shard=shard)
+    else:
+        # Usar batch_size y offset si no se especifica un usuario específico
+        limit = batch_size if not filter_username else None
+        moodle_users = get_moodle_users(filter_username, limit=limit, offset=offset, shard=shard)
+    
+    # Reanudar un shard interrumpido saltando los usuarios ya procesados
+    checkpoint_filename = None
+    processed_ids = set()
+    if (shard or resume) and not filter_username and not users_file and not courses:
+        checkpoint_filename = create_checkpoint_filename(dry_run, shard)
+        processed_ids = load_checkpoint(checkpoint_filename)
+        if not processed_ids:
+            start_checkpoint(checkpoint_filename, shard)
+        else:
+            before = len(moodle_users)
+            moodle_users = [mu for mu in moodle_users if mu.get("id") not in processed_ids]
+            print(f"[CHECKPOINT] Reanudando desde {checkpoint_filename}: {before - len(moodle_users)} usuarios ya procesados")
+    
+    if not moodle_users:
+        if filter_username:
+            print(f"[WARNING] No se encontró el usuario {filter_username} en Moodle")
+        else:
+            print("[WARNING] No se encontraron usuarios en Moodle")
+        return
+
+    # Obtener usuarios de Discourse para comparación
+    index_loaded = load_discourse_index()
+    print(f"[STATS] Usuarios en Moodle: {len(moodle_users)}")
+    if index_loaded:
+        print(f"[STATS] Usuarios en Discourse: {len(discourse_index)}")
+    else:
+        print("[ERROR] No se pudo cargar el índice de usuarios de Discourse")
+    
+    # Mostrar información del lote
+    if from_db and not filter_username:
+        print(f"🗄️ Procesando {len(moodle_users)} usuarios de la base de datos de Moodle "
+              f"(límite: {batch_size}, offset: {offset})")
+    elif export_file and not filter_username:
+        print(f"📄 Procesando {len(moodle_users)} usuarios de la exportación {export_file} "
+              f"(límite: {batch_size}, offset: {offset})")
+    elif users_file:
+        print(f"📄 Procesando {len(moodle_users)} usuarios de {users_file}")
+    elif courses:
+        print(f"🎓 Procesando {len(moodle_users)} usuarios de los cursos {', '.join(map(str, courses))} "
+              f"(límite: {batch_size}, offset: {offset})")
+    elif batch_size and not filter_username:
+        print(f"[BATCH] Procesando lote de {len(moodle_users)} usuarios (límite: {batch_size}, offset: {offset})")
+    elif filter_username:
+        print(f"👤 Procesando usuario específico: {filter_username}")
+    else:
+        print("📦 Procesando todos los usuarios disponibles")
+
+    # Análisis previo de conflictos: decide la ruta de cada usuario antes de escribir.
+    # Sin índice todos los usuarios parecerían nuevos, así que no se arma el plan
+    # y cada usuario se resuelve con sus propias consultas, como antes del análisis.
+    plan = None
+    if index_loaded:
+        plan = run_preflight(moodle_users, excluded_users, dry_run=dry_run, shard=shard)
+    elif preflight_only:
+        print("[ERROR] El análisis previo necesita el índice de Discourse, no se analizó nada")
+        return
+    else:
+        print("[WARNING] Se omite el análisis previo: cada usuario se resolverá con sus propias consultas")
+    if preflight_only:
+        return
+
+    # Construir caché de usuarios de Discourse (usar usernames normalizados)
+    moodle_usernames = [normalize_username(mu.get("username")) for mu in moodle_users if mu.get("username")]
+    build_discourse_user_cache(moodle_usernames)
+
+    return run_sync(moodle_users, excluded_users, log_filename, dry_run=dry_run,
+                    force_recreate=force_recreate, debug=debug, activate_users=activate_users,
+                    checkpoint_filename=checkpoint_filename, shard=shard, processed_ids=processed_ids,
+                    stop_event=stop_event, progress_callback=progress_callback, deadline=deadline, plan=plan)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Sincroniza datos de usuarios Moodle -> Discourse")
@@ -1013,6 +2457,51 @@ if __name__ == "__main__":
         "--user",
         help="Sincroniza solo un usuario específico (por username)"
     )
+    parser.add_argument(
+        "--users-file",
+        help="Sincroniza solo los usuarios listados en un archivo (un ID, username o email por línea; "
+             "prefijos id:, username: o email: para indicar el campo)"
+    )
+    parser.add_argument(
+        "--courses",
+        type=parse_course_ids,
+        help="Sincroniza solo los usuarios matriculados en estos cursos (IDs separados por coma, ej: 12,34)"
+    )
+    parser.add_argument(
+        "--from-export",
+        metavar="FILE",
+        help="Lee los usuarios de una exportación de Moodle (CSV de descarga masiva o NDJSON, admite .gz) en lugar del web service"
+    )
+    parser.add_argument(
+        "--from-db",
+        action="store_true",
+        help="Lee los usuarios directamente de la base de datos de Moodle (settings.MOODLE_DB, solo lectura)"
+    )
+    parser.add_argument(
+        "--modified-since",
+        type=parse_timestamp,
+        help="Con --from-db, solo usuarios modificados desde esta fecha (timestamp Unix o ISO, ej: 2024-05-01)"
+    )
+    parser.add_argument(
+        "--preflight",
+        action="store_true",
+        help="Solo analiza los conflictos del lote (emails repetidos, usernames ya usados) y termina, sin escribir"
+    )
+    parser.add_argument(
+        "--reconcile",
+        action="store_true",
+        help="Busca usuarios de Discourse cuyo usuario de Moodle fue eliminado o suspendido (huérfanos) y termina"
+    )
+    parser.add_argument(
+        "--orphan-action",
+        choices=["report", "suspend", "deactivate"],
+        help="Con --reconcile: solo reportar, suspender o desactivar los huérfanos (por defecto: settings.ORPHAN_ACTION o report)"
+    )
+    parser.add_argument(
+        "--orphan-scope",
+        choices=["mapped", "all"],
+        help="Con --reconcile: solo usuarios del mapa de IDs (mapped) o todos los de Discourse (all)"
+    )
     parser.add_argument(
         "--force-recreate",
         action="store_true",
@@ -1040,9 +2529,89 @@ if __name__ == "__main__":
         action="store_true",
         help="Activa y aprueba automáticamente los usuarios creados"
     )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        help="Procesa solo la porción K de N (ej: 1/4), repartiendo usuarios por hash estable de su ID de Moodle"
+    )
+    parser.add_argument(
+        "--merge-logs",
+        nargs="+",
+        metavar="LOG",
+        help="Combina los logs CSV de varios shards en un reporte único y termina"
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Ejecuta como proceso de larga duración con sincronizaciones incrementales periódicas (requiere --from-db)"
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        help="Segundos entre sincronizaciones en modo daemon (por defecto: settings.DAEMON_INTERVAL o 900)"
+    )
+    parser.add_argument(
+        "--status-port",
+        type=int,
+        help="Puerto local del endpoint de estado en modo daemon, 0 para desactivarlo (por defecto: 8765)"
+    )
+    parser.add_argument(
+        "--listen-events",
+        action="store_true",
+        help="Recibe eventos de usuario de Moodle por HTTP y sincroniza solo los usuarios afectados"
+    )
+    parser.add_argument(
+        "--events-port",
+        type=int,
+        help="Puerto del receptor de eventos (por defecto: settings.EVENTS_PORT o 8770)"
+    )
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="Reintenta solo las operaciones del archivo dead-letter (y los reintentos vencidos) y termina"
+    )
+    parser.add_argument(
+        "--deadline",
+        type=int,
+        help="Tiempo máximo de la ejecución en segundos; los usuarios restantes se encolan (por defecto: settings.RUN_DEADLINE)"
+    )
+    parser.add_argument(
+        "--hedge",
+        action="store_true",
+        help="Activa el hedging de lecturas (duplica peticiones lentas por encima del percentil HEDGE_PERCENTILE)"
+    )
+    parser.add_argument(
+        "--avatars",
+        action="store_true",
+        help="Sincroniza también la foto de perfil de Moodle como avatar de Discourse (por defecto: settings.AVATAR_SYNC)"
+    )
     args = parser.parse_args()
 
-    main(dry_run=not args.apply, filter_username=args.user, force_recreate=args.force_recreate, 
-         batch_size=args.batch_size, offset=args.offset, debug=args.debug, activate_users=args.activate_users)
+    if args.hedge:
+        http_client.hedging_enabled = True
+    if args.avatars:
+        avatar_sync_enabled = True
+
+    if args.merge_logs:
+        merge_shard_logs(args.merge_logs)
+    elif args.listen_events:
+        run_event_receiver(dry_run=not args.apply, force_recreate=args.force_recreate, debug=args.debug,
+                           activate_users=args.activate_users, port=args.events_port)
+    elif args.daemon:
+        if not args.from_db:
+            print("[ERROR] --daemon necesita --from-db: el web service no devuelve timemodified y cada ciclo "
+                  "volvería a sincronizar todos los usuarios")
+            sys.exit(1)
+        run_daemon(dry_run=not args.apply, force_recreate=args.force_recreate, debug=args.debug,
+                   activate_users=args.activate_users, shard=args.shard,
+                   interval=args.interval, status_port=args.status_port, from_db=args.from_db)
+    else:
+        # --preflight nunca escribe: se ejecuta siempre como dry-run
+        main(dry_run=not args.apply or args.preflight, filter_username=args.user, force_recreate=args.force_recreate, 
+             batch_size=args.batch_size, offset=args.offset, debug=args.debug, activate_users=args.activate_users,
+             shard=args.shard, retry_failed=args.retry_failed, deadline_seconds=args.deadline,
+             users_file=args.users_file, courses=args.courses, export_file=args.from_export,
+             from_db=args.from_db, modified_since=args.modified_since, preflight_only=args.preflight,
+             reconcile=args.reconcile, orphan_action=args.orphan_action, orphan_scope=args.orphan_scope)
 
  
\ No newline at end of file
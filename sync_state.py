@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Almacén de estado persistente de la sincronización.
+
+Guarda en un archivo JSON la información que debe sobrevivir entre
+ejecuciones (por ejemplo, la fecha de la última sincronización incremental).
+El contenido se mantiene en memoria y solo se escribe a disco al llamar a
+save(), de forma atómica (archivo temporal + rename).
+
+IdMap usa el mismo mecanismo para guardar la correspondencia entre los IDs de
+usuario de Moodle y los de Discourse.
+"""
+
+import json
+import os
+import threading
+
+import settings
+
+
+def default_state_filename():
+    """Nombre del archivo de estado para el entorno actual"""
+    env = getattr(settings, 'ENV', 'unknown')
+    return getattr(settings, 'STATE_FILE', f"sync_state_{env}.json")
+
+
+class StateStore:
+    """Estado clave/valor persistido en JSON y protegido para uso entre hilos"""
+
+    def __init__(self, filename=None):
+        self.filename = filename or default_state_filename()
+        self._lock = threading.RLock()
+        self._data = {}
+        self._dirty = False
+        self.load()
+
+    def load(self):
+        """Carga el estado desde disco (si el archivo no existe, empieza vacío)"""
+        with self._lock:
+            if not os.path.exists(self.filename):
+                self._data = {}
+                return
+            try:
+                with open(self.filename, 'r', encoding='utf-8') as f:
+                    self._data = json.load(f)
+            except Exception as e:
+                print(f"[WARNING] Error leyendo estado {self.filename}: {e}")
+                self._data = {}
+            self._dirty = False
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._data.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._dirty = True
+
+    def section(self, name):
+        """Devuelve (creándolo si hace falta) un sub-diccionario del estado"""
+        with self._lock:
+            self._dirty = True
+            return self._data.setdefault(name, {})
+
+    def save(self, force=False):
+        """Escribe el estado a disco si hubo cambios"""
+        with self._lock:
+            if not self._dirty and not force:
+                return
+            tmp_filename = f"{self.filename}.tmp"
+            with open(tmp_filename, 'w', encoding='utf-8') as f:
+                json.dump(self._data, f, ensure_ascii=False)
+            os.replace(tmp_filename, self.filename)
+            self._dirty = False
+
+
+def default_id_map_filename():
+    """Nombre del archivo con el mapa de IDs Moodle ↔ Discourse para el entorno actual"""
+    env = getattr(settings, 'ENV', 'unknown')
+    return getattr(settings, 'ID_MAP_FILE', f"sync_id_map_{env}.json")
+
+
+def default_orphans_filename():
+    """Nombre del archivo con los usuarios huérfanos ya suspendidos o desactivados"""
+    env = getattr(settings, 'ENV', 'unknown')
+    return getattr(settings, 'ORPHANS_STATE_FILE', f"sync_orphans_{env}.json")
+
+
+def default_avatar_state_filename():
+    """Nombre del archivo con la última foto de perfil sincronizada por usuario"""
+    env = getattr(settings, 'ENV', 'unknown')
+    return getattr(settings, 'AVATAR_STATE_FILE', f"sync_avatars_{env}.json")
+
+
+class IdMap(StateStore):
+    """
+    Mapa persistente ID de Moodle -> usuario de Discourse (ID y username).
+
+    Permite resolver a un usuario ya sincronizado aunque haya cambiado su
+    username en Moodle o en Discourse, sin volver a buscarlo por email.
+    """
+
+    def __init__(self, filename=None):
+        super().__init__(filename or default_id_map_filename())
+        self._by_discourse_id = {}
+        with self._lock:
+            for moodle_id, entry in self._data.items():
+                self._by_discourse_id[entry['discourse_id']] = moodle_id
+
+    def lookup(self, moodle_id):
+        """Devuelve {'discourse_id', 'username'} para un ID de Moodle, o None si no está mapeado"""
+        return self.get(str(moodle_id))
+
+    def link(self, moodle_id, discourse_id, username):
+        """Registra (o actualiza) la correspondencia de un usuario de Moodle con uno de Discourse"""
+        if moodle_id is None or discourse_id is None:
+            return
+        key = str(moodle_id)
+        entry = {'discourse_id': discourse_id, 'username': username}
+        with self._lock:
+            if self._data.get(key) == entry:
+                return
+            # Un usuario de Discourse corresponde a un único usuario de Moodle
+            previous = self._by_discourse_id.get(discourse_id)
+            if previous is not None and previous != key:
+                self._data.pop(previous, None)
+            old_entry = self._data.get(key)
+            if old_entry is not None:
+                self._by_discourse_id.pop(old_entry['discourse_id'], None)
+            self.set(key, entry)
+            self._by_discourse_id[discourse_id] = key
+
+    def unlink(self, moodle_id):
+        """Elimina la correspondencia de un usuario de Moodle (ej: el usuario de Discourse ya no existe)"""
+        with self._lock:
+            entry = self._data.pop(str(moodle_id), None)
+            if entry is not None:
+                self._by_discourse_id.pop(entry['discourse_id'], None)
+                self._dirty = True
+
+    def entries(self):
+        """Lista de (ID de Moodle, {'discourse_id', 'username'}) de todo el mapa"""
+        with self._lock:
+            return list(self._data.items())
+
+    def discourse_ids(self):
+        """IDs de Discourse vinculados a algún usuario de Moodle"""
+        with self._lock:
+            return set(self._by_discourse_id)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sincronización de varios pares Moodle/Discourse (tenants) desde un solo proceso.
+
+Los tenants se definen en settings.TENANTS como una lista de perfiles:
+
+    TENANTS = [
+        {'name': 'campus-a', 'MOODLE_ENDPOINT': '...', 'MOODLE_TOKEN': '...',
+         'DISCOURSE_URL': '...', 'DISCOURSE_API_KEY': '...'},
+        {'name': 'campus-b', 'settings_module': 'settings_campus_b'},
+    ]
+
+Cada perfil parte de los valores de settings.py, aplica los de
+`settings_module` (un settings.py existente, si se indica) y por último sus
+propias claves. ENV toma por defecto el nombre del tenant.
+
+El código de sincronización lee la configuración y guarda su estado (mapa de
+IDs, cola de reintentos, cachés, sesión HTTP, circuit breakers) en variables de
+módulo, así que cada tenant corre en su propio proceso hijo, con su propio
+`settings` ya resuelto. Así cada tenant tiene su pool de conexiones, su
+presupuesto de peticiones (RATE_LIMITS), y sus logs y estado en su directorio
+(TENANT_DIR, por defecto tenants/<name>/). EXCLUDED_USERS_FILE se resuelve a
+una ruta absoluta antes de entrar en ese directorio (por defecto, el
+excluded_users.txt desde donde se lanza el script) y debe existir.
+
+El planificador ejecuta como máximo TENANT_CONCURRENCY tenants a la vez. Si
+hay más tenants que lugares, cada uno corre por turnos de TENANT_SLICE
+segundos. El proceso de cada tenant vive toda la ejecución: al terminar el
+turno (tras el usuario en curso) avisa por su Pipe y queda en pausa, con los
+usuarios de Moodle, el índice y los cachés ya cargados, hasta que el
+planificador le da otro turno. La preparación inicial (descarga de usuarios,
+índice, análisis previo) cuenta dentro del primer turno.
+
+Uso:
+    python sync_tenants.py                    # dry-run de todos los tenants
+    python sync_tenants.py --apply            # aplicar cambios
+    python sync_tenants.py --tenant campus-a  # solo algunos tenants
+"""
+
+import argparse
+import importlib
+import os
+import re
+import signal
+import sys
+import threading
+import time
+import types
+from collections import deque
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+
+import settings
+
+# Código de salida de un tenant detenido antes de sincronizar todos sus usuarios
+EXIT_PENDING = 3
+
+# Mensajes por el Pipe entre el planificador y el proceso de cada tenant
+MSG_PAUSED = "paused"
+MSG_RESUME = "resume"
+
+# Cada cuántos segundos un tenant en pausa revisa si se pidió detener la ejecución
+PAUSE_POLL_SECONDS = 1
+
+TENANT_NAME_RE = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+# Claves del perfil que no son valores de settings
+PROFILE_KEYS = ("name", "settings_module")
+
+
+def get_tenants(names=None):
+    """Perfiles de settings.TENANTS (solo los indicados en `names`, si se pasa)"""
+    profiles = getattr(settings, 'TENANTS', None) or []
+    seen = set()
+    for profile in profiles:
+        name = profile.get("name")
+        if not name or not TENANT_NAME_RE.match(name):
+            raise ValueError(f"TENANTS: nombre de tenant no válido: {name!r}")
+        if name in seen:
+            raise ValueError(f"TENANTS: tenant repetido: {name}")
+        seen.add(name)
+    if names:
+        unknown = set(names) - seen
+        if unknown:
+            raise ValueError(f"Tenants no definidos en TENANTS: {', '.join(sorted(unknown))}")
+        profiles = [profile for profile in profiles if profile["name"] in names]
+    return profiles
+
+
+def tenant_workdir(profile):
+    """Directorio (absoluto) con los logs y el estado del tenant"""
+    return os.path.abspath(profile.get("TENANT_DIR") or os.path.join("tenants", profile["name"]))
+
+
+def build_tenant_settings(profile):
+    """Módulo `settings` del tenant: settings.py + settings_module + claves del perfil"""
+    tenant_settings = types.ModuleType("settings", f"Configuración del tenant {profile['name']}")
+    layers = [settings]
+    if profile.get("settings_module"):
+        layers.append(importlib.import_module(profile["settings_module"]))
+    for layer in layers:
+        tenant_settings.__dict__.update({key: value for key, value in vars(layer).items() if key.isupper()})
+    tenant_settings.__dict__.update({key: value for key, value in profile.items() if key not in PROFILE_KEYS})
+    if "ENV" not in profile and not profile.get("settings_module"):
+        tenant_settings.ENV = profile["name"]
+    tenant_settings.__dict__.pop("TENANTS", None)
+    # Ruta absoluta: el proceso del tenant trabaja en su propio directorio
+    tenant_settings.EXCLUDED_USERS_FILE = os.path.abspath(
+        getattr(tenant_settings, 'EXCLUDED_USERS_FILE', None) or "excluded_users.txt")
+    return tenant_settings
+
+
+def check_tenant_settings(profile):
+    """Errores de configuración que impiden lanzar el tenant (lista vacía si no hay)"""
+    errors = []
+    excluded_file = build_tenant_settings(profile).EXCLUDED_USERS_FILE
+    if not os.path.exists(excluded_file):
+        errors.append(f"{profile['name']}: no existe EXCLUDED_USERS_FILE ({excluded_file})")
+    return errors
+
+
+def run_tenant(profile, dry_run, activate_users, slice_seconds, conn):
+    """
+    Proceso hijo: sincroniza un tenant. Al agotar su turno avisa con MSG_PAUSED
+    por `conn` y espera MSG_RESUME para seguir. Sale con EXIT_PENDING si se
+    recibió SIGTERM/SIGINT antes de procesar todos los usuarios.
+    """
+    # Reemplazar settings antes de importar el código de sincronización
+    sys.modules["settings"] = build_tenant_settings(profile)
+    workdir = tenant_workdir(profile)
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    console = open(f"sync_console_{profile['name']}.log", 'a', encoding='utf-8', buffering=1)
+    sys.stdout = sys.stderr = console
+
+    import http_client
+    import sync_moodle_discourse as sync
+
+    stop_event = threading.Event()
+    sync.install_stop_handlers(stop_event, "TENANT")
+    # El primer turno empieza ya: la descarga y la preparación cuentan dentro del turno
+    turn_started = [time.monotonic()]
+
+    def end_of_turn(processed, stats):
+        if stop_event.is_set() or time.monotonic() - turn_started[0] < slice_seconds:
+            return
+        print(f"\n[TENANT] {profile['name']}: fin del turno tras {processed} usuarios, en pausa")
+        conn.send(MSG_PAUSED)
+        # En pausa hasta el próximo turno, atento a SIGTERM/SIGINT
+        while not conn.poll(PAUSE_POLL_SECONDS):
+            if stop_event.is_set():
+                return
+        conn.recv()
+        turn_started[0] = time.monotonic()
+        print(f"[TENANT] {profile['name']}: nuevo turno {time.strftime('%Y-%m-%d %H:%M:%S')}")
+
+    print(f"\n[TENANT] {profile['name']}: inicio {time.strftime('%Y-%m-%d %H:%M:%S')}")
+    try:
+        # Todos los usuarios del tenant, salvo que el perfil defina su propio BATCH_SIZE
+        stats = sync.main(dry_run=dry_run, batch_size=profile.get("BATCH_SIZE"), activate_users=activate_users,
+                          resume=True, stop_event=stop_event,
+                          progress_callback=end_of_turn if slice_seconds else None)
+    finally:
+        http_client.close_session()
+        console.flush()
+        conn.close()
+    sys.exit(EXIT_PENDING if stop_event.is_set() and stats and stats.get('interrumpido') else 0)
+
+
+class TenantWorker:
+    """Proceso de un tenant y el extremo del planificador de su Pipe"""
+
+    __slots__ = ("profile", "process", "conn", "started")
+
+    def __init__(self, profile, process, conn):
+        self.profile = profile
+        self.process = process
+        self.conn = conn
+        self.started = time.time()
+
+
+class TenantScheduler:
+    """
+    Ejecuta los tenants en procesos hijos que viven toda la ejecución, como
+    máximo `concurrency` a la vez; cuando hay tenants esperando, los procesos
+    se turnan pausándose y reanudándose.
+    """
+
+    def __init__(self, profiles, concurrency=None, slice_seconds=None, dry_run=True, activate_users=False):
+        self.profiles = profiles
+        self.concurrency = max(1, concurrency or getattr(settings, 'TENANT_CONCURRENCY', 2))
+        if slice_seconds is None:
+            slice_seconds = getattr(settings, 'TENANT_SLICE', 300)
+        # Los turnos solo tienen sentido si algún tenant tiene que esperar lugar
+        self.slice_seconds = slice_seconds if len(profiles) > self.concurrency else None
+        self.dry_run = dry_run
+        self.activate_users = activate_users
+        self.results = {}
+        self.turns = {profile["name"]: 0 for profile in profiles}
+        self._context = get_context("spawn")
+        self._workers = {}  # nombre -> TenantWorker (en turno o en pausa)
+        self._active = set()  # nombres de los tenants en turno
+        self._stopping = False
+
+    def _give_turn(self, profile):
+        """Lanza el proceso del tenant (primer turno) o reanuda el que está en pausa"""
+        name = profile["name"]
+        self.turns[name] += 1
+        worker = self._workers.get(name)
+        if worker is None:
+            conn, child_conn = self._context.Pipe()
+            process = self._context.Process(
+                target=run_tenant, name=f"tenant-{name}",
+                args=(profile, self.dry_run, self.activate_users, self.slice_seconds, child_conn))
+            process.start()
+            child_conn.close()
+            self._workers[name] = worker = TenantWorker(profile, process, conn)
+        else:
+            try:
+                worker.conn.send(MSG_RESUME)
+            except OSError:
+                pass  # el proceso terminó mientras estaba en pausa: lo informa su sentinel
+        self._active.add(name)
+        print(f"[TENANT] {name}: turno {self.turns[name]} "
+              f"(PID {worker.process.pid}, log: {tenant_workdir(profile)})")
+
+    def _finish(self, name):
+        """Registra el resultado de un tenant cuyo proceso terminó"""
+        worker = self._workers.pop(name)
+        self._active.discard(name)
+        worker.process.join()
+        worker.conn.close()
+        elapsed = time.time() - worker.started
+        exitcode = worker.process.exitcode
+        if exitcode == EXIT_PENDING:
+            self.results[name] = "INTERRUMPIDO"
+        elif exitcode == 0:
+            print(f"[TENANT] {name}: sincronización completa ({elapsed:.0f}s, {self.turns[name]} turnos)")
+            self.results[name] = "OK"
+        else:
+            print(f"[ERROR] {name}: el proceso terminó con código {exitcode} "
+                  f"(ver sync_console_{name}.log en {tenant_workdir(worker.profile)})")
+            self.results[name] = f"ERROR ({exitcode})"
+
+    def stop(self, signum=None, frame=None):
+        """Parada ordenada: no se dan más turnos y cada tenant termina su usuario actual y guarda su checkpoint"""
+        self._stopping = True
+        print("\n[TENANT] Deteniendo: se espera a que los tenants en curso terminen el usuario actual...")
+        # También los que están en pausa: lo notan en menos de PAUSE_POLL_SECONDS y terminan
+        for worker in list(self._workers.values()):
+            if worker.process.is_alive():
+                worker.process.terminate()
+
+    def run(self):
+        pending = deque(self.profiles)
+        while self._workers or (pending and not self._stopping):
+            while pending and not self._stopping and len(self._active) < self.concurrency:
+                self._give_turn(pending.popleft())
+            # Se espera el fin de cualquier proceso y el aviso de pausa de los que están en turno
+            waitables = {}
+            for name, worker in self._workers.items():
+                waitables[worker.process.sentinel] = name
+                if name in self._active:
+                    waitables[worker.conn] = name
+            for ready in wait(list(waitables)):
+                name = waitables[ready]
+                worker = self._workers.get(name)
+                if worker is None:
+                    continue
+                if ready is worker.process.sentinel:
+                    if worker.profile in pending:
+                        pending.remove(worker.profile)
+                    self._finish(name)
+                    continue
+                try:
+                    message = worker.conn.recv()
+                except EOFError:
+                    continue  # el proceso terminó: lo informa su sentinel
+                if message == MSG_PAUSED and name in self._active:
+                    self._active.discard(name)
+                    pending.append(worker.profile)
+                    print(f"[TENANT] {name}: fin del turno {self.turns[name]}, en pausa hasta el próximo")
+        for profile in pending:
+            self.results.setdefault(profile["name"], "INTERRUMPIDO")
+        return self.results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sincroniza varios pares Moodle/Discourse definidos en settings.TENANTS")
+    parser.add_argument("--apply", action="store_true",
+                        help="Aplica los cambios en lugar de solo mostrar (por defecto es dry-run)")
+    parser.add_argument("--tenant", action="append", dest="tenants",
+                        help="Sincroniza solo este tenant (se puede repetir)")
+    parser.add_argument("--concurrency", type=int,
+                        help="Tenants sincronizados a la vez (por defecto: settings.TENANT_CONCURRENCY o 2)")
+    parser.add_argument("--slice", type=int,
+                        help="Segundos por turno cuando hay tenants esperando (por defecto: settings.TENANT_SLICE o 300)")
+    parser.add_argument("--activate-users", action="store_true",
+                        help="Activa y aprueba automáticamente los usuarios creados")
+    args = parser.parse_args()
+
+    try:
+        profiles = get_tenants(args.tenants)
+    except ValueError as e:
+        print(f"[ERROR] {e}")
+        sys.exit(1)
+    if not profiles:
+        print("[ERROR] No hay tenants definidos en settings.TENANTS")
+        sys.exit(1)
+    errors = [error for profile in profiles for error in check_tenant_settings(profile)]
+    if errors:
+        for error in errors:
+            print(f"[ERROR] {error}")
+        sys.exit(1)
+
+    scheduler = TenantScheduler(profiles, concurrency=args.concurrency, slice_seconds=args.slice,
+                                dry_run=not args.apply, activate_users=args.activate_users)
+    signal.signal(signal.SIGTERM, scheduler.stop)
+    signal.signal(signal.SIGINT, scheduler.stop)
+
+    mode = "dry-run" if not args.apply else "apply"
+    slice_info = f", turnos de {scheduler.slice_seconds}s" if scheduler.slice_seconds else ""
+    print(f"[TENANT] {len(profiles)} tenants, {scheduler.concurrency} a la vez{slice_info} (modo: {mode})")
+    start = time.time()
+    results = scheduler.run()
+
+    print(f"\n[STATS] Tenants sincronizados en {(time.time() - start) / 60:.1f} minutos:")
+    for profile in profiles:
+        name = profile["name"]
+        print(f"   {name}: {results.get(name, 'INTERRUMPIDO')} ({scheduler.turns[name]} turnos)")
+    if any(result != "OK" for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
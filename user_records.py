@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Registros compactos de usuarios de Moodle y Discourse.
+
+Las APIs devuelven cada usuario como un diccionario JSON con decenas de campos
+que nunca se leen. Estas clases usan __slots__ y conservan solo los campos que
+utilizan la sincronización y los reportes, de modo que cachés e índices ocupan
+una fracción de la memoria de los diccionarios originales.
+
+Los registros exponen get() y acceso por índice para seguir siendo compatibles
+con el código que antes trabajaba con diccionarios.
+"""
+
+
+class SlottedRecord:
+    """Base común para registros con __slots__ y acceso tipo diccionario"""
+
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for field in self.__slots__:
+            setattr(self, field, fields.get(field))
+
+    @classmethod
+    def from_json(cls, data):
+        """Crea un registro a partir de un dict JSON, descartando campos no usados"""
+        if isinstance(data, cls):
+            return data
+        return cls(**{field: data.get(field) for field in cls.__slots__})
+
+    def get(self, key, default=None):
+        """Equivalente a dict.get: devuelve default si el campo no existe o es None"""
+        if key not in self.__slots__:
+            return default
+        value = getattr(self, key)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def to_dict(self):
+        """Convierte el registro a un dict (para exportar a JSON)"""
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __repr__(self):
+        fields = ", ".join(f"{field}={getattr(self, field)!r}" for field in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class MoodleUser(SlottedRecord):
+    """Usuario de Moodle con los campos que usa la sincronización"""
+
+    __slots__ = ("id", "username", "fullname", "email", "city", "country", "description", "timemodified",
+                 "customfields", "profileimageurl")
+
+
+class DiscourseUser(SlottedRecord):
+    """Usuario de Discourse con los campos que se comparan y actualizan"""
+
+    __slots__ = ("id", "username", "name", "email", "location", "bio_raw", "active", "user_fields")
+
+
+class ReportUser(SlottedRecord):
+    """Usuario de Discourse tal como aparece en el reporte por país"""
+
+    __slots__ = ("username", "name", "email", "location", "active", "country")
@@ -1,23 +1,38 @@
+import sys
 import requests
 import settings
+from discourse_snapshot import get_snapshot
 
-# Verificar usuario, agregar el nombre de usuario en la siguiente linea
+# Verificar usuario, agregar el nombre de usuario en la siguiente linea (o pasarlo como argumento)
 username = 'usuario'
-url = f'{settings.DISCOURSE_URL}/u/{username}.json'
-headers = {
-    'Api-Key': settings.DISCOURSE_API_KEY,
-    'Api-Username': settings.DISCOURSE_API_USER
-}
+args = [arg for arg in sys.argv[1:] if arg != '--live']
+if args:
+    username = args[0]
 
-r = requests.get(url, headers=headers)
-if r.status_code == 200:
+# Por defecto usa el snapshot local (discourse_snapshot.py); con --live consulta la API
+# (la biografía solo está disponible con --live)
+if '--live' in sys.argv:
+    url = f'{settings.DISCOURSE_URL}/u/{username}.json'
+    headers = {
+        'Api-Key': settings.DISCOURSE_API_KEY,
+        'Api-Username': settings.DISCOURSE_API_USER
+    }
+
+    r = requests.get(url, headers=headers)
+    if r.status_code != 200:
+        print(f'Error: {r.status_code} - {r.text}')
+        sys.exit(1)
     user = r.json().get('user', {})
-    print(f'  Username: {user.get("username")}')
-    print(f'  Name: {user.get("name")}')
-    print(f'  Location: {user.get("location")}')
-    print(f'  Bio: {user.get("bio_ra")}')
-    print(f'  Email: {user.get("email")}')
-    print(f'  Active: {user.get("active")}')
-    print(f'  ID: {user.get("id")}')
 else:
-    print(f'Error: {r.status_code} - {r.text}')
+    user = get_snapshot().users.get(username)
+    if user is None:
+        print(f'Error: {username} no está en el snapshot (usar --live para consultar la API)')
+        sys.exit(1)
+
+print(f'  Username: {user.get("username")}')
+print(f'  Name: {user.get("name")}')
+print(f'  Location: {user.get("location")}')
+print(f'  Bio: {user.get("bio_raw")}')
+print(f'  Email: {user.get("email")}')
+print(f'  Active: {user.get("active")}')
+print(f'  ID: {user.get("id")}')